@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the stages on a synthetic tree, with the in-memory sqlite cache :
+python -m benchmarks.run_benchmarks --files 5000 --output results.json
+python -m benchmarks.run_benchmarks --compare results.json
+The files are read from the page cache after the first run : generate the tree on
+the drive to measure with --folder, with as many files as needed to fill the memory
+to measure the reads from the drive.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+from datetime import datetime
+from tempfile import mkdtemp
+from typing import Callable
+from typing import Dict
+from typing import List
+from unittest import mock
+
+from sqlalchemy import create_engine
+
+from benchmarks.synthetic_tree import copy_share
+from benchmarks.synthetic_tree import generate_tree
+from src.db_cache.db_cache_manager import DbCacheManager
+from src.files_cleaners import copy_recursive
+from src.io_files.hash_functions import FileHashManager
+from src.io_files.hash_functions import get_hashs_for_file
+from src.io_files.io_wrappers import iter_file_entries
+from src.metrics import METRICS
+
+# Bump when the benchmarks or the layout of the results change
+VERSION = 1
+# Settings changing the results, saved with them
+SETTINGS = [
+    "CACHE_INDEX",
+    "HASH_ALGORITHM",
+    "SCAN_WORKERS",
+    "HASH_WORKERS",
+    "COPY_WORKERS",
+    "COPY_ORDER",
+    "HASH_EXECUTOR",
+]
+
+
+def run_benchmarks(
+    folder: str,
+    nb_files: int = 1000,
+    duplicate_ratio: float = 0.2,
+    collision_ratio: float = 0.1,
+    depth: int = 3,
+    overlap_ratio: float = 0.5,
+    repeat: int = 3,
+    seed: int = 0,
+) -> Dict:
+    """
+    Generate folder/src, and folder/dst with overlap_ratio of the files of src and
+    nb_files / 2 other files. Each benchmark is run `repeat` times, the best is kept.
+    """
+    folder_src = os.path.join(folder, "src")
+    folder_dst = os.path.join(folder, "dst")
+    tree_args = dict(
+        duplicate_ratio=duplicate_ratio, collision_ratio=collision_ratio, depth=depth
+    )
+    src_files = generate_tree(folder_src, nb_files, seed=seed, **tree_args)
+    generate_tree(folder_dst, nb_files // 2, seed=seed + 1, **tree_args)
+    copy_share(folder_src, src_files, folder_dst, overlap_ratio, seed=seed)
+
+    benchmarks = {
+        "scan": partial_scan(folder_src),
+        "hash": partial_hash(folder_src, src_files),
+        "cache_build": partial_cache_build(folder_dst),
+        "cache_lookup": partial_cache_lookup(folder_src, folder_dst),
+        "copy_recursive": partial_copy_recursive(folder, folder_src, folder_dst),
+    }
+    results = {name: _measure(func, repeat) for name, func in benchmarks.items()}
+    results["copy_recursive"]["metrics"] = METRICS.report()["stages"]
+
+    return {
+        "version": VERSION,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "settings": {key: os.getenv(key) for key in SETTINGS if os.getenv(key)},
+        },
+        "config": dict(
+            tree_args,
+            nb_files=nb_files,
+            overlap_ratio=overlap_ratio,
+            repeat=repeat,
+            seed=seed,
+        ),
+        "results": results,
+    }
+
+
+def partial_scan(folder_src: str) -> Callable[[], Dict]:
+    def scan():
+        entries = list(iter_file_entries(folder_src))
+        return {"files": len(entries), "bytes": 0}
+
+    return scan
+
+
+def partial_hash(folder_src: str, src_files: List[str]) -> Callable[[], Dict]:
+    def hash_files():
+        nb_bytes = 0
+        for relative_path in src_files:
+            file_path = os.path.join(folder_src, relative_path)
+            nb_bytes += get_hashs_for_file(file_path)["size"]
+        return {"files": len(src_files), "bytes": nb_bytes}
+
+    return hash_files
+
+
+def partial_cache_build(folder_dst: str) -> Callable[[], Dict]:
+    def cache_build():
+        with _in_memory_cache(), contextlib.redirect_stdout(io.StringIO()):
+            db_cache = DbCacheManager(FileHashManager(folder_dst))
+            return {"files": len(db_cache.index), "bytes": 0}
+
+    return cache_build
+
+
+def partial_cache_lookup(folder_src: str, folder_dst: str) -> Callable[[], Dict]:
+    def cache_lookup():
+        entries = list(iter_file_entries(folder_src))
+        with _in_memory_cache(), contextlib.redirect_stdout(io.StringIO()):
+            db_cache = DbCacheManager(FileHashManager(folder_dst))
+            # the cache is built outside of the measure, the source files are hashed
+            # during the lookups, as needed
+            len(db_cache.index)
+            hash_gen = FileHashManager(folder_src)
+            start = time.perf_counter()
+            found = sum(
+                bool(db_cache.find_file(entry.path, hash_gen, {"size": entry.size})[1])
+                for entry in entries
+            )
+            seconds = time.perf_counter() - start
+        return {"files": len(entries), "bytes": 0, "found": found, "seconds": seconds}
+
+    return cache_lookup
+
+
+def partial_copy_recursive(
+    folder: str, folder_src: str, folder_dst: str
+) -> Callable[[], Dict]:
+    def copy():
+        # copy in a copy of folder_dst, the same for each run
+        work_folder = os.path.join(folder, "work")
+        shutil.rmtree(work_folder, ignore_errors=True)
+        shutil.copytree(folder_dst, work_folder)
+        nb_before = len(list(iter_file_entries(work_folder)))
+        try:
+            with _in_memory_cache(), contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                copy_recursive(folder_src, work_folder)
+                seconds = time.perf_counter() - start
+            nb_copied = len(list(iter_file_entries(work_folder))) - nb_before
+        finally:
+            shutil.rmtree(work_folder, ignore_errors=True)
+        return {"files": nb_copied, "bytes": 0, "seconds": seconds}
+
+    return copy
+
+
+def compare(baseline: Dict, results: Dict, max_regression: float = 0.1) -> List[str]:
+    """Print the ratio of the durations, return the benchmarks slower than allowed"""
+    if baseline["config"] != results["config"]:
+        print("Warning : the results were measured with another config")
+    regressions = []
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["seconds"]
+        ratio = result["seconds"] / before if before else float("inf")
+        print(
+            f"  {name:<15} : {before:8.3f} s -> {result['seconds']:8.3f} s  x{ratio:.2f}"
+        )
+        if ratio > 1 + max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def display(results: Dict) -> None:
+    for name, result in results["results"].items():
+        print(
+            f"  {name:<15} : {result['seconds']:8.3f} s, {result['files']:>8} files, "
+            f"{result['files_per_second']:>10.0f} files/s, "
+            f"{result['bytes_per_second'] / 1024 ** 2:>8.1f} MiB/s"
+        )
+
+
+def _measure(func: Callable[[], Dict], repeat: int) -> Dict:
+    """
+    Best duration of the runs. The benchmarks can return their own duration, to
+    exclude their set up
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        runs.append(result.pop("seconds", time.perf_counter() - start))
+    seconds = min(runs)
+    return dict(
+        result,
+        seconds=seconds,
+        runs=runs,
+        files_per_second=result["files"] / seconds if seconds else 0.0,
+        bytes_per_second=result["bytes"] / seconds if seconds else 0.0,
+    )
+
+
+@contextlib.contextmanager
+def _in_memory_cache():
+    """Cache in a new in-memory sqlite database, without snapshot"""
+    engine = create_engine("sqlite://")
+    snapshot_folder = mkdtemp()
+    try:
+        with mock.patch(
+            "src.db_cache.db_cache_manager.create_engine", lambda _: engine
+        ), mock.patch("src.db_cache.db_cache_manager.SNAPSHOT_FOLDER", snapshot_folder):
+            yield
+    finally:
+        engine.dispose()
+        shutil.rmtree(snapshot_folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=1000, help="files in src")
+    parser.add_argument("--duplicates", type=float, default=0.2)
+    parser.add_argument("--collisions", type=float, default=0.1)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--overlap", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--folder", help="where to generate the trees, default tmp")
+    parser.add_argument("--output", help="JSON file of the results")
+    parser.add_argument("--compare", help="JSON file of previous results")
+    parser.add_argument("--max-regression", type=float, default=0.1)
+    args = parser.parse_args()
+
+    folder = mkdtemp(dir=args.folder)
+    try:
+        results = run_benchmarks(
+            folder,
+            nb_files=args.files,
+            duplicate_ratio=args.duplicates,
+            collision_ratio=args.collisions,
+            depth=args.depth,
+            overlap_ratio=args.overlap,
+            repeat=args.repeat,
+            seed=args.seed,
+        )
+    finally:
+        shutil.rmtree(folder)
+
+    display(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.max_regression)
+        if regressions:
+            print("Regressions :", ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
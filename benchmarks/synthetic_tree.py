@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import os
+import random
+import shutil
+from typing import List
+from typing import Tuple
+
+# (size, weight) : the size of a file is drawn between size / 2 and size
+SIZE_DISTRIBUTION = [
+    (4 * 1024, 0.5),
+    (64 * 1024, 0.3),
+    (1024 * 1024, 0.15),
+    (8 * 1024 * 1024, 0.05),
+]
+# Timestamp of the files generated, for the same cache between 2 runs
+MTIME = 1577836800  # 2020-01-01
+
+
+def generate_tree(
+    folder: str,
+    nb_files: int = 1000,
+    size_distribution: List[Tuple[int, float]] = None,
+    duplicate_ratio: float = 0.2,
+    collision_ratio: float = 0.1,
+    depth: int = 3,
+    nb_sub_folders: int = 4,
+    seed: int = 0,
+) -> List[str]:
+    """
+    Write nb_files files in folder/**, the same tree for the same arguments.
+    duplicate_ratio : share of the files with the content of another file
+    collision_ratio : share of the files with the name of a file of another folder,
+        and another content
+    depth : maximum number of sub folders, with nb_sub_folders per folder
+    Return the relative paths of the files, in the order they were written.
+    """
+    size_distribution = size_distribution or SIZE_DISTRIBUTION
+    sizes, weights = zip(*size_distribution)
+    rng = random.Random(seed)
+    relative_paths: List[str] = []
+    written = set()
+
+    for i in range(nb_files):
+        relative_folder = os.path.join(
+            *[
+                f"folder_{rng.randrange(nb_sub_folders)}"
+                for _ in range(rng.randint(0, depth))
+            ],
+            "",
+        )
+        name = f"file_{i:06d}.bin"
+        if relative_paths and rng.random() < collision_ratio:
+            name = os.path.basename(rng.choice(relative_paths))
+        relative_path = os.path.join(relative_folder, name)
+        if relative_path in written:
+            # same folder drawn twice : no collision
+            relative_path = os.path.join(relative_folder, f"file_{i:06d}.bin")
+
+        file_path = os.path.join(folder, relative_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if relative_paths and rng.random() < duplicate_ratio:
+            shutil.copyfile(os.path.join(folder, rng.choice(relative_paths)), file_path)
+        else:
+            size = rng.choices(sizes, weights)[0]
+            size = rng.randint(size // 2, size)
+            with open(file_path, "wb") as f:
+                f.write(rng.getrandbits(8 * size).to_bytes(size, "little"))
+        os.utime(file_path, (MTIME, MTIME))
+        relative_paths.append(relative_path)
+        written.add(relative_path)
+
+    return relative_paths
+
+
+def copy_share(
+    folder_src: str,
+    relative_paths: List[str],
+    folder_dst: str,
+    ratio: float,
+    seed: int = 0,
+) -> List[str]:
+    """
+    Copy a share of the files of folder_src in folder_dst/archive/, renamed : the
+    files already in the destination of a copy. Return their relative paths
+    """
+    rng = random.Random(seed)
+    copied = []
+    for relative_path in relative_paths:
+        if rng.random() >= ratio:
+            continue
+        target_path = os.path.join(
+            folder_dst, "archive", relative_path.replace(os.sep, "_")
+        )
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        shutil.copy2(os.path.join(folder_src, relative_path), target_path)
+        copied.append(os.path.relpath(target_path, folder_dst))
+    return copied
@@ -1,26 +1,60 @@
 #!/usr/bin/env python3
+import cProfile
+import importlib
+import os
 import sys
 from pathlib import Path
 
 from dotenv import load_dotenv
 
-from src.files_cleaners import copy_recursive
+# Command -> module, imported only when the command is run : pandas and sqlalchemy
+# are slow to import
+COMMANDS = {
+    "copy_recursive": "src.files_cleaners",
+    "find_duplicates": "src.files_cleaners",
+    "find_duplicates_across_roots": "src.files_cleaners",
+    "watch": "src.folder_watcher",
+}
 
 
 def main():
     def display_help(*a, **kw):
-        print("Expecting argument in", set(args_2_func.keys()))
+        print("Expecting argument in", set(COMMANDS.keys()))
 
     load_dotenv(dotenv_path=Path.cwd() / ".env")
-    args_2_func = {func.__name__: func for func in [copy_recursive]}
 
     if len(sys.argv) < 2:
         display_help()
         exit(0)
 
     func_name = sys.argv[1].lower()
-    func = args_2_func.get(func_name, display_help)
-    func(*sys.argv[2:])
+    if func_name in COMMANDS:
+        func = getattr(importlib.import_module(COMMANDS[func_name]), func_name)
+    else:
+        func = display_help
+    run(func, sys.argv[2:])
+
+
+def run(func, args):
+    """
+    PROFILE_FILE : profile the command with cProfile, read with pstats / snakeviz
+    METRICS_FILE : export the metrics of the stages as JSON at the end of the command
+    """
+    profile_file = os.getenv("PROFILE_FILE")
+    profiler = cProfile.Profile() if profile_file else None
+    try:
+        if profiler is None:
+            func(*args)
+        else:
+            profiler.runcall(func, *args)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(profile_file)
+        metrics_file = os.getenv("METRICS_FILE")
+        if metrics_file:
+            from src.metrics import METRICS
+
+            METRICS.export(metrics_file)
 
 
 if __name__ == "__main__":
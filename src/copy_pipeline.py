@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+import os
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import wait
+from functools import partial
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+
+from src.db_cache import Folders
+from src.db_cache.db_cache_manager import DbCacheManager
+from src.io_files.hash_functions import FileHashManager
+from src.io_files.hash_functions import get_hashs_for_small_files
+from src.io_files.io_wrappers import FileEntry
+from src.io_files.io_wrappers import FileManager
+from src.io_files.io_wrappers import get_physical_offset
+from src.io_files.io_wrappers import iter_file_entries
+from src.io_files.io_wrappers import iter_in_background
+
+# Files scanned ahead of the lookups
+SIZE_QUEUE = 1024
+# Files read in one call, hashed and looked for by batches of SIZE_SMALL_BATCH files
+SIZE_SMALL_FILE = 10 * 1024
+SIZE_SMALL_BATCH = 256
+# Order of the reads : "scan" (as listed), "inode" or "extent" (position on the disk,
+# with the inode for the filesystems without FIEMAP). Less seeks on HDD / USB drives
+COPY_ORDER = os.getenv("COPY_ORDER", "scan")
+ORDERS = ("scan", "inode", "extent")
+# Files of the other roots not mounted : skipped on the hashs of the last sync
+COPY_TRUST_UNMOUNTED = os.getenv("COPY_TRUST_UNMOUNTED", "0") == "1"
+
+
+class CopyPipeline:
+    """
+    Copy the files of folder_src missing in the cache of folder_dst, in 4 stages :
+    - scanner : lists folder_src in a thread, ahead of the other stages
+    - hashers : compute the next hash stage of the source files, in the workers of the
+        hash generator, with a bounded number of files read at the same time.
+        The small files are hashed entirely, by batches
+    - lookup : this thread, the only one using the cache. Decides for each file if it
+        has to be hashed more, copied, or if it's already in folder_dst
+    - copiers : the workers of the file manager
+    With an order other than "scan", or for a dry run, the files are listed first and
+    read in this order, and the copies are planned then run folder by folder.
+    With other_roots, a file missing in folder_dst is only copied if it isn't in these
+    roots either : looked for in the ContentIndex, with the file hashed in the
+    lookup thread. The roots not mounted are only trusted with trust_unmounted.
+    """
+
+    def __init__(
+        self,
+        db_cache: DbCacheManager,
+        file_manager: FileManager,
+        src_hash_gen: FileHashManager,
+        folder_dst: str,
+        order: str = None,
+        dry_run: bool = False,
+        other_roots: Dict[int, Folders] = None,
+        trust_unmounted: bool = None,
+    ):
+        """
+        order : one of ORDERS, default COPY_ORDER
+        dry_run : print the files to copy, without copying them
+        other_roots : folders of the cache to look in too, see registered_roots
+        trust_unmounted : don't copy the files found in the other roots not mounted,
+            default COPY_TRUST_UNMOUNTED
+        """
+        super(CopyPipeline, self).__init__()
+        order = order or COPY_ORDER
+        if order not in ORDERS:
+            raise ValueError(f"Unknown order {order}, expecting one of {ORDERS}")
+        self.db_cache = db_cache
+        self.file_manager = file_manager
+        self.src_hash_gen = src_hash_gen
+        self.folder_src = src_hash_gen.data_folder
+        self.folder_dst = folder_dst
+        self.errors: List[Tuple[str, Exception]] = []
+        # hash task -> function processing its result
+        self._hashing: Dict[Future, Callable[[Future], None]] = {}
+        self._small_files: List[FileEntry] = []
+        self.order = order
+        self.dry_run = dry_run
+        self.other_roots = other_roots or {}
+        self.trust_unmounted = (
+            COPY_TRUST_UNMOUNTED if trust_unmounted is None else trust_unmounted
+        )
+        self.planned = order != "scan" or dry_run
+        # planned mode : position of the files on the disk, and the copies to run
+        self._locations: Dict[str, Tuple] = {}
+        self._planned_copies: List[Tuple[FileEntry, Callable]] = []
+
+    def run(self) -> List[Tuple[str, Exception]]:
+        """Return the files who couldn't be copied, with the error"""
+        if self.planned:
+            entries = self._plan_reads()
+        else:
+            entries = iter_in_background(iter_file_entries(self.folder_src), SIZE_QUEUE)
+        for entry in entries:
+            self._process_hashed([f for f in self._hashing if f.done()])
+            while len(self._hashing) >= 2 * self._reader_limit(entry):
+                self._wait_hashed()
+            if not self._is_in_folder_dst(entry):
+                self._lookup(entry, {"size": entry.size})
+
+        self._hash_small_files()
+        while self._hashing:
+            self._wait_hashed()
+        self._run_planned_copies()
+        self.file_manager.wait()
+        self._add_copied_files()
+        return self.errors + self.file_manager.errors
+
+    def _lookup(self, entry: FileEntry, hash_info: Dict) -> None:
+        """Copy the file, or hash its next stage in the background"""
+        try:
+            keys = self._copy_one_file(entry, hash_info)
+            known_hashs = self.src_hash_gen.known_hashs(entry.link_key, keys or [])
+            while keys is not None and known_hashs is not None:
+                # another hard link of the file was already hashed
+                hash_info.update(known_hashs)
+                keys = self._copy_one_file(entry, hash_info)
+                known_hashs = self.src_hash_gen.known_hashs(entry.link_key, keys or [])
+        except Exception as e:
+            self.errors.append((entry.path, e))
+        else:
+            if keys is not None:
+                future = self.src_hash_gen.workers.executor.submit(
+                    self.src_hash_gen.get_hashs_for_stage, entry.path, keys
+                )
+                self._hashing[future] = partial(self._lookup_hashed, entry, hash_info)
+        self._add_copied_files()
+
+    def _copy_one_file(self, entry: FileEntry, hash_info: Dict):
+        """Return the next hash stage needed to decide, None once decided"""
+
+        def compare(target_path):
+            return self.db_cache.compare_file(
+                target_path, entry.path, self.src_hash_gen, hash_info
+            )
+
+        if entry.size < SIZE_SMALL_FILE:
+            self._small_files.append(entry)
+            if len(self._small_files) >= SIZE_SMALL_BATCH:
+                self._hash_small_files()
+            return None
+
+        candidates, keys = self.db_cache.find_candidates(hash_info)
+        if keys is not None:
+            return keys
+
+        if candidates:
+            self._display_duplicate(entry, self.db_cache.index.location(candidates[0]))
+        elif not self._is_in_other_roots(entry, hash_info):
+            self._copy(entry, compare)
+        return None
+
+    def _copy(self, entry: FileEntry, compare: Callable[[str], bool]) -> None:
+        """Copy the file now, or once all the files are looked for in planned mode"""
+        if self.planned:
+            self._planned_copies.append((entry, compare))
+            return
+        self.file_manager.copy_file(
+            entry.path,
+            self.folder_dst,
+            os.path.relpath(entry.path, self.folder_src),
+            entry.size,
+            compare,
+        )
+
+    def _plan_reads(self) -> List[FileEntry]:
+        """All the files of folder_src, sorted by position on the disk"""
+        entries = list(iter_file_entries(self.folder_src))
+        for entry in entries:
+            offset = get_physical_offset(entry.path) if self.order == "extent" else None
+            # the inodes are allocated close to their data : fallback without FIEMAP
+            self._locations[entry.path] = (
+                entry.device,
+                offset is None,
+                offset or entry.inode,
+            )
+        if self.order != "scan":
+            entries.sort(key=lambda entry: self._locations[entry.path])
+        return entries
+
+    def _run_planned_copies(self) -> None:
+        """
+        Write the files folder by folder, and read them in the order of the disk
+        inside each folder
+        """
+        planned, self._planned_copies = self._planned_copies, []
+        planned.sort(
+            key=lambda item: (
+                os.path.dirname(os.path.relpath(item[0].path, self.folder_src)),
+                self._locations[item[0].path],
+            )
+        )
+        for entry, compare in planned:
+            relative_path = os.path.relpath(entry.path, self.folder_src)
+            if self.dry_run:
+                print(f"cp {relative_path:<130} -> {self.folder_dst} (dry run)")
+                continue
+            try:
+                self.file_manager.copy_file(
+                    entry.path, self.folder_dst, relative_path, entry.size, compare
+                )
+            except Exception as e:
+                self.errors.append((entry.path, e))
+            self._add_copied_files()
+
+        if self.dry_run:
+            size = sum(entry.size for entry, _ in planned)
+            print(f"Dry run : {len(planned)} files to copy, {size / 1024 ** 2:.1f} MiB")
+
+    def _is_in_folder_dst(self, entry: FileEntry) -> bool:
+        """A hard link of the file is in folder_dst : no need to read it"""
+        try:
+            location = self.db_cache.find_same_file(entry)
+        except Exception as e:
+            # found by its hashs instead
+            print(f"Hard links of {entry.path} not looked for : {e}")
+            return False
+        if location[1]:
+            self._display_duplicate(entry, location)
+        return bool(location[1])
+
+    def _is_in_other_roots(self, entry: FileEntry, hash_info: Dict) -> bool:
+        if not self.other_roots:
+            return False
+        root, folder, name = self.db_cache.find_file_in_roots(
+            entry.path,
+            self.src_hash_gen,
+            hash_info,
+            self.other_roots,
+            accept_unmounted=self.trust_unmounted,
+        )
+        if name:
+            relative_path = os.path.relpath(entry.path, self.folder_src)
+            existing_path = os.path.join(root, folder, name)
+            if not os.path.isdir(root):
+                existing_path += " (not mounted, not checked)"
+            print(f"File {relative_path:<130} already in {existing_path}")
+        return bool(name)
+
+    def _display_duplicate(self, entry: FileEntry, location: Tuple[str, str]) -> None:
+        relative_folder = os.path.relpath(entry.root, self.folder_src)
+        folder_doublon, name_doublon = location
+        if folder_doublon != relative_folder:
+            existing_path = os.path.join(folder_doublon, name_doublon)
+            relative_path = os.path.join(relative_folder, entry.name)
+            print(f"File {relative_path:<130} already in {existing_path}")
+
+    def _hash_small_files(self) -> None:
+        if not self._small_files:
+            return
+        entries, self._small_files = self._small_files, []
+        future = self.src_hash_gen.workers.executor.submit(
+            get_hashs_for_small_files, [(entry.path, entry.size) for entry in entries]
+        )
+        self._hashing[future] = partial(self._lookup_small_files, entries)
+
+    def _lookup_small_files(self, entries: List[FileEntry], future: Future) -> None:
+        """Look for a batch of small files in the cache with one lookup"""
+        hashed = []
+        for entry, hash_info in zip(entries, future.result()):
+            if isinstance(hash_info, Exception):
+                self.errors.append((entry.path, hash_info))
+            else:
+                hashed.append((entry, hash_info))
+
+        try:
+            locations = self.db_cache.find_files([hash_info for _, hash_info in hashed])
+        except Exception as e:
+            self.errors += [(entry.path, e) for entry, _ in hashed]
+            return
+        for (entry, hash_info), location in zip(hashed, locations):
+            if location[1]:
+                self._display_duplicate(entry, location)
+                continue
+            try:
+                if self._is_in_other_roots(entry, hash_info):
+                    continue
+                self._copy(
+                    entry,
+                    partial(
+                        self.db_cache.compare_file,
+                        source_path=entry.path,
+                        hash_generator=self.src_hash_gen,
+                        hash_info=hash_info,
+                    ),
+                )
+            except Exception as e:
+                self.errors.append((entry.path, e))
+        self._add_copied_files()
+
+    def _wait_hashed(self) -> None:
+        done, _ = wait(list(self._hashing), return_when=FIRST_COMPLETED)
+        self._process_hashed(done)
+
+    def _process_hashed(self, futures: Iterable[Future]) -> None:
+        for future in futures:
+            self._hashing.pop(future)(future)
+
+    def _lookup_hashed(self, entry: FileEntry, hash_info: Dict, future: Future) -> None:
+        try:
+            hash_info.update(future.result())
+            self.src_hash_gen.remember(entry.link_key, hash_info)
+        except Exception as e:
+            self.errors.append((entry.path, e))
+        else:
+            self._lookup(entry, hash_info)
+
+    def _reader_limit(self, entry: FileEntry) -> int:
+        return self.src_hash_gen.workers.reader_limit(entry.path)
+
+    def _add_copied_files(self) -> None:
+        """The copy is done : a file not added to the cache is hashed at the next run"""
+        for target_path in self.file_manager.pop_copied():
+            try:
+                self.db_cache.add_file(target_path)
+            except Exception as e:
+                self.errors.append((target_path, e))
@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
+from sqlalchemy import BigInteger
 from sqlalchemy import Column
+from sqlalchemy import Float
+from sqlalchemy import Index
 from sqlalchemy import Integer
+from sqlalchemy import MetaData
 from sqlalchemy import String
+from sqlalchemy import Table
 from sqlalchemy.ext.declarative import declarative_base
 
+from src.io_files.hash_functions import HASH_KEYS
+from src.io_files.hash_functions import HASH_STAGES
+
 Base = declarative_base()
 
 
@@ -13,6 +21,57 @@ class Folders(Base):
     folder_id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
     folder_name = Column(String, nullable=False)
     table_name = Column(String, nullable=False)
+    # HASH_ALGORITHM used to hash the files of the table. NULL : md5+sha256
+    hash_algorithm = Column(String, nullable=True)
+    # Set while the cache table is built, to resume an interrupted build. NULL : complete
+    build_started = Column(Float, nullable=True)
+    # Last heartbeat of the process watching the folder. NULL : not watched
+    watched_at = Column(Float, nullable=True)
 
     def __str__(self):
-        return f"{self.folder_id} : folder {self.folder_name}, table {self.table_name}"
+        return (
+            f"{self.folder_id} : folder {self.folder_name}, table {self.table_name}"
+            f", hashed with {self.hash_algorithm}"
+        )
+
+
+def cache_table(table_name: str) -> Table:
+    """Table with the files of a folder, one table per folder (see Folders)"""
+    full_hash_key = list(HASH_STAGES)[-1][0]
+    columns = [
+        Column("file_id", Integer, primary_key=True, autoincrement=True),
+        Column("name", String, nullable=False),
+        Column("folder", String, nullable=False),
+        Column("size", BigInteger, nullable=False),
+        Column("mtime_ns", BigInteger),
+        Column("inode", BigInteger),
+    ]
+    columns += [Column(key, String) for key in HASH_KEYS]
+    columns.append(Column("timestamp", Float))
+
+    table = Table(table_name, MetaData(), *columns)
+    Index(f"ix_{table_name}_size_hash", table.c.size, table.c[full_hash_key])
+    Index(f"ux_{table_name}_path", table.c.folder, table.c.name, unique=True)
+    return table
+
+
+def content_table() -> Table:
+    """
+    Files of all the folders of the Folders table, with the folder_id of their root
+    (see ContentIndex). The folder is relative to the root, like in cache_table
+    """
+    full_hash_key = list(HASH_STAGES)[-1][0]
+    columns = [
+        Column("folder_id", Integer, nullable=False),
+        Column("folder", String, nullable=False),
+        Column("name", String, nullable=False),
+        Column("size", BigInteger, nullable=False),
+    ]
+    columns += [Column(key, String) for key in HASH_KEYS]
+
+    table = Table("contents", MetaData(), *columns)
+    Index("ix_contents_size_hash", table.c.size, table.c[full_hash_key])
+    Index(
+        "ux_contents_path", table.c.folder_id, table.c.folder, table.c.name, unique=True
+    )
+    return table
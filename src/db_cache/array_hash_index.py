@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import Table
+
+from .index_snapshot import read_snapshot
+from .index_snapshot import write_snapshot
+from .sql_hash_index import SqlHashIndex
+from src.io_files.hash_functions import HASH_KEYS
+
+# Rows read at once when loading the index
+SIZE_CHUNK = 100000
+# Records added since the arrays were sorted, merged in the arrays above this count
+SIZE_PENDING = 10000
+
+
+def to_digest(value) -> int:
+    """
+    First 64 bits of a hex digest, 0 for a missing value.
+    2 files with the same size and digests of 64 bits are considered identical.
+    """
+    if value is None or value != value:  # None or NaN
+        return 0
+    return int(value[:16], 16) or 1
+
+
+class ArrayHashIndex(SqlHashIndex):
+    """
+    Same interface as HashIndex, for tens of millions of files. In memory, only the
+    file_id, size and truncated digests of each record, in NumPy arrays sorted by
+    size : about 8 bytes per value instead of a python string. The records are searched
+    by binary search on the size, the folder and name are read from the database on
+    a hit. The updates are written to the database immediately.
+    """
+
+    def __init__(self, engine, table: Table, snapshot_path: str = None):
+        """
+        snapshot_path : file where the arrays are saved, mapped in memory on the next
+            run instead of reading the table
+        """
+        super(ArrayHashIndex, self).__init__(engine, table)
+        self._keys = [key for key in HASH_KEYS if key in table.c]
+        self._pending: List[Dict] = []
+        self.snapshot_path = snapshot_path
+        if not self._load_snapshot():
+            self._load()
+            self.save_snapshot()
+
+    def __len__(self):
+        return len(self._file_ids) + len(self._pending)
+
+    def add(self, record: Dict) -> int:
+        label = super(ArrayHashIndex, self).add(record)
+        self._pending.append(
+            dict(
+                {key: to_digest(record.get(key)) for key in self._keys},
+                file_id=label,
+                size=int(record["size"]),
+            )
+        )
+        if len(self._pending) > SIZE_PENDING:
+            self._merge_pending()
+        return label
+
+    def find(self, hash_info: Dict) -> List[int]:
+        """Records matching all the keys of hash_info. hash_info must contain the size"""
+        size = int(hash_info["size"])
+        digests = {
+            key: to_digest(value)
+            for key, value in hash_info.items()
+            if key in self._digests
+        }
+        if set(hash_info) - set(digests) - {"size"}:
+            # stat values, not in memory : indexed query on the size in the table
+            return super(ArrayHashIndex, self).find(hash_info)
+        start, end = np.searchsorted(self._sizes, [size, size + 1])
+        matches = np.ones(end - start, dtype=bool)
+        for key, digest in digests.items():
+            matches &= self._digests[key][start:end] == np.uint64(digest)
+
+        labels = self._file_ids[start:end][matches].tolist()
+        labels += [
+            record["file_id"]
+            for record in self._pending
+            if record["size"] == size
+            and all(record[key] == digest for key, digest in digests.items())
+        ]
+        return labels
+
+    def size_groups(self) -> Iterable[List[int]]:
+        """Records of the same size, for the sizes shared by several records"""
+        self._merge_pending()
+        bounds = np.flatnonzero(np.diff(self._sizes)) + 1
+        starts = np.concatenate([[0], bounds])
+        ends = np.concatenate([bounds, [len(self._sizes)]])
+        shared = ends - starts > 1
+        for start, end in zip(starts[shared], ends[shared]):
+            yield self._file_ids[start:end].tolist()
+
+    def hash_values(self, labels: Iterable[int], keys) -> List[Tuple]:
+        """The truncated digests, None when missing"""
+        labels = np.asarray(list(labels), dtype=np.int64)
+        positions = self._positions(labels)
+        pending = {record["file_id"]: record for record in self._pending}
+        values = []
+        for label, position in zip(labels.tolist(), positions.tolist()):
+            if position >= 0:
+                digests = [int(self._digests[key][position]) for key in keys]
+            else:
+                digests = [pending[label][key] for key in keys]
+            values.append(tuple(digest or None for digest in digests))
+        return values
+
+    def missing(self, labels: Iterable[int], keys) -> List[int]:
+        """Records without a value for one of the keys"""
+        labels = np.asarray(list(labels), dtype=np.int64)
+        positions = self._positions(labels)
+        known = positions >= 0
+        keys = [
+            key for key in keys if key in self._digests
+        ]  # the size is never missing
+        missing = np.zeros(len(labels), dtype=bool)
+        for key in keys:
+            missing[known] |= self._digests[key][positions[known]] == 0
+
+        pending = {record["file_id"]: record for record in self._pending}
+        for i in np.flatnonzero(~known):
+            record = pending.get(int(labels[i]))
+            missing[i] = record is not None and any(record[key] == 0 for key in keys)
+        return labels[missing].tolist()
+
+    def update(self, label: int, hash_info: Dict) -> None:
+        super(ArrayHashIndex, self).update(label, hash_info)
+        position = self._positions(np.array([label], dtype=np.int64))[0]
+        for key, value in hash_info.items():
+            if key not in self._digests:
+                continue
+            if position >= 0:
+                self._digests[key][position] = to_digest(value)
+            else:
+                for record in self._pending:
+                    if record["file_id"] == label:
+                        record[key] = to_digest(value)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Indexed by file_id, with the size and the truncated digests only, NA when
+        missing. The whole records are read with records()
+        """
+        self._merge_pending()
+        df = pd.DataFrame(
+            {"size": self._sizes}, index=pd.Index(self._file_ids, name="file_id")
+        )
+        for key in self._keys:
+            digests = self._digests[key]
+            df[key] = pd.arrays.IntegerArray(digests, mask=digests == 0)
+        return df
+
+    def save_snapshot(self) -> None:
+        if self.snapshot_path is None:
+            return
+        self._merge_pending()
+        arrays = {
+            "file_ids": self._file_ids,
+            "sizes": self._sizes,
+            "by_id": self._by_id,
+        }
+        arrays.update({f"digest_{key}": self._digests[key] for key in self._keys})
+        write_snapshot(self.snapshot_path, arrays, self._snapshot_info())
+
+    def _load_snapshot(self) -> bool:
+        """
+        The snapshot is in sync with the table if no file was inserted since it was
+        written. The other writes to the table remove the snapshot (see DbCacheManager)
+        """
+        snapshot = (
+            None if self.snapshot_path is None else read_snapshot(self.snapshot_path)
+        )
+        if snapshot is None or snapshot[1] != self._snapshot_info():
+            return False
+
+        arrays, _ = snapshot
+        self._file_ids = arrays["file_ids"]
+        self._sizes = arrays["sizes"]
+        self._by_id = arrays["by_id"]
+        self._digests = {key: arrays[f"digest_{key}"] for key in self._keys}
+        return True
+
+    def _snapshot_info(self) -> Dict:
+        with self.engine.connect() as connection:
+            max_file_id = connection.execute(
+                select([func.max(self.table.c.file_id)])
+            ).scalar()
+        return {
+            "database": repr(self.engine.url),
+            "table": self.table.name,
+            "keys": self._keys,
+            "max_file_id": max_file_id,
+        }
+
+    def _load(self) -> None:
+        """Read the table by chunks, to never hold it as python objects"""
+        columns = [self.table.c.file_id, self.table.c.size]
+        columns += [self.table.c[key] for key in self._keys]
+        with self.engine.connect() as connection:
+            nb_rows = connection.execute(
+                select([func.count()]).select_from(self.table)
+            ).scalar()
+            self._file_ids = np.empty(nb_rows, dtype=np.int64)
+            self._sizes = np.empty(nb_rows, dtype=np.int64)
+            self._digests = {
+                key: np.empty(nb_rows, dtype=np.uint64) for key in self._keys
+            }
+
+            result = connection.execution_options(stream_results=True).execute(
+                select(columns).order_by(self.table.c.size, self.table.c.file_id)
+            )
+            start = 0
+            for rows in iter(lambda: result.fetchmany(SIZE_CHUNK), []):
+                end = start + len(rows)
+                self._file_ids[start:end] = [row[0] for row in rows]
+                self._sizes[start:end] = [row[1] for row in rows]
+                for i, key in enumerate(self._keys, 2):
+                    self._digests[key][start:end] = [to_digest(row[i]) for row in rows]
+                start = end
+        self._sort_by_id()
+
+    def _merge_pending(self) -> None:
+        if not self._pending:
+            return
+        pending = pd.DataFrame(self._pending)
+        self._pending = []
+        file_ids = np.concatenate([self._file_ids, pending["file_id"].to_numpy()])
+        sizes = np.concatenate([self._sizes, pending["size"].to_numpy()])
+        order = np.argsort(sizes, kind="stable")
+        self._file_ids = file_ids[order]
+        self._sizes = sizes[order]
+        for key in self._keys:
+            digests = pending[key].to_numpy(dtype=np.uint64)
+            self._digests[key] = np.concatenate([self._digests[key], digests])[order]
+        self._sort_by_id()
+
+    def _sort_by_id(self) -> None:
+        self._by_id = np.argsort(self._file_ids, kind="stable")
+
+    def _positions(self, labels: np.ndarray) -> np.ndarray:
+        """Position of the labels in the arrays, -1 for the pending records"""
+        if len(self._file_ids) == 0:
+            return np.full(len(labels), -1, dtype=np.int64)
+        idx = np.searchsorted(self._file_ids, labels, sorter=self._by_id)
+        idx = self._by_id[np.minimum(idx, len(self._file_ids) - 1)]
+        return np.where(self._file_ids[idx] == labels, idx, -1)
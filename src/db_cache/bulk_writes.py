@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import io
+from typing import List
+
+import pandas as pd
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import Table
+from sqlalchemy import text
+
+SIZE_BATCH = 10000
+# Unique key of a cache table
+PATH_KEYS = ["folder", "name"]
+
+
+def upsert_records(connection, table: Table, df: pd.DataFrame) -> None:
+    """
+    Insert the records in the cache table, or update the rows with the same path.
+    Postgres : COPY in a staging table, then one INSERT ... ON CONFLICT
+    Others : INSERT ... ON CONFLICT in batches of SIZE_BATCH (executemany)
+    """
+    if df.shape[0] == 0:
+        return
+
+    columns = [column for column in table.c.keys() if column != "file_id"]
+    df = df.reindex(columns=columns)
+    df = df.astype(object).where(df.notnull(), None)
+    if connection.dialect.name == "postgresql":
+        _copy_upsert(connection, table, df, columns)
+        return
+
+    values = ", ".join(f":{column}" for column in columns)
+    query = text(_upsert_query(table, columns, f"VALUES ({values})"))
+    records = df.to_dict("records")
+    for start in range(0, len(records), SIZE_BATCH):
+        connection.execute(query, records[start : start + SIZE_BATCH])
+
+
+def delete_records(connection, table: Table, df_paths: pd.DataFrame) -> None:
+    """Delete the rows with the (folder, name) of df_paths"""
+    if df_paths.shape[0] == 0:
+        return
+
+    query = table.delete().where(
+        and_(
+            table.c.folder == bindparam("b_folder"), table.c.name == bindparam("b_name")
+        )
+    )
+    records = [
+        {"b_folder": folder, "b_name": name}
+        for folder, name in df_paths[PATH_KEYS].itertuples(index=False)
+    ]
+    for start in range(0, len(records), SIZE_BATCH):
+        connection.execute(query, records[start : start + SIZE_BATCH])
+
+
+def _copy_upsert(connection, table: Table, df: pd.DataFrame, columns: List[str]):
+    staging_table = f"staging_{table.name}"
+    quoted_columns = ", ".join(f'"{column}"' for column in columns)
+    # CSV format : empty unquoted values are NULL
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.execute(
+        f'CREATE TEMPORARY TABLE "{staging_table}" ON COMMIT DROP AS '
+        f'SELECT {quoted_columns} FROM "{table.name}" WITH NO DATA'
+    )
+    cursor.copy_expert(
+        f'COPY "{staging_table}" ({quoted_columns}) FROM STDIN WITH CSV', buffer
+    )
+    source = f'SELECT {quoted_columns} FROM "{staging_table}"'
+    cursor.execute(_upsert_query(table, columns, source))
+    cursor.close()
+
+
+def _upsert_query(table: Table, columns: List[str], source: str) -> str:
+    quoted_columns = ", ".join(f'"{column}"' for column in columns)
+    updates = ", ".join(
+        f'"{column}" = excluded."{column}"'
+        for column in columns
+        if column not in PATH_KEYS
+    )
+    conflict_keys = ", ".join(PATH_KEYS)
+    return (
+        f'INSERT INTO "{table.name}" ({quoted_columns}) {source} '
+        f"ON CONFLICT ({conflict_keys}) DO UPDATE SET {updates}"
+    )
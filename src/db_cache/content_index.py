@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+from itertools import groupby
+from typing import Dict
+from typing import Iterable
+from typing import List
+
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy import Table
+
+from . import content_table
+from .sql_hash_index import SIZE_IN_CLAUSE
+from src.io_files.hash_functions import HASH_KEYS
+
+
+class ContentIndex:
+    """
+    The files of all the folders of the cache in one table, indexed by size and full
+    hash, with the folder_id of their root (see Folders) : a lookup in several roots
+    is one indexed query, instead of one per cache table.
+    The rows of a root are replaced by the content of its cache table (see sync), so
+    the index is as up to date as the last sync of each root.
+    """
+
+    def __init__(self, engine):
+        super(ContentIndex, self).__init__()
+        self.engine = engine
+        self.table = content_table()
+        self._create()
+
+    def _create(self) -> None:
+        """Created for another HASH_ALGORITHM : rebuilt as the roots are synced"""
+        with self.engine.connect() as connection:
+            exists = self.engine.dialect.has_table(connection, self.table.name)
+        if exists:
+            columns = inspect(self.engine).get_columns(self.table.name)
+            if set(self.table.c.keys()) <= {column["name"] for column in columns}:
+                return
+            print("Rebuild the index of the contents for", ", ".join(HASH_KEYS))
+            self.table.drop(self.engine)
+        self.table.create(self.engine)
+
+    def sync(self, folder_id: int, table: Table) -> None:
+        """Replace the rows of the root by the records of its cache table"""
+        columns = ["folder", "name", "size"] + HASH_KEYS
+        query = select(
+            [literal(folder_id).label("folder_id")] + [table.c[key] for key in columns]
+        )
+        with self.engine.begin() as connection:
+            connection.execute(
+                self.table.delete().where(self.table.c.folder_id == folder_id)
+            )
+            connection.execute(
+                self.table.insert().from_select(["folder_id"] + columns, query)
+            )
+
+    def has_root(self, folder_id: int) -> bool:
+        query = select([self.table.c.folder_id]).where(
+            self.table.c.folder_id == folder_id
+        )
+        with self.engine.connect() as connection:
+            return connection.execute(query.limit(1)).first() is not None
+
+    def find(self, size: int, folder_ids: Iterable[int]) -> List[Dict]:
+        """Files of the roots with this size"""
+        query = select([self.table]).where(
+            and_(
+                self.table.c.size == size,
+                self.table.c.folder_id.in_(list(folder_ids)),
+            )
+        )
+        with self.engine.connect() as connection:
+            return [dict(row) for row in connection.execute(query)]
+
+    def size_groups(self, folder_ids: Iterable[int]) -> Iterable[List[Dict]]:
+        """
+        Files of the same size, for the sizes found in several of the roots.
+        Read SIZE_IN_CLAUSE sizes at a time, ordered by size
+        """
+        in_roots = self.table.c.folder_id.in_(list(folder_ids))
+        last_size = -1
+        while True:
+            query = (
+                select([self.table.c.size])
+                .where(and_(in_roots, self.table.c.size > last_size))
+                .group_by(self.table.c.size)
+                .having(func.count(self.table.c.folder_id.distinct()) > 1)
+                .order_by(self.table.c.size)
+                .limit(SIZE_IN_CLAUSE)
+            )
+            with self.engine.connect() as connection:
+                sizes = [row[0] for row in connection.execute(query)]
+                if not sizes:
+                    return
+                query = (
+                    select([self.table])
+                    .where(and_(in_roots, self.table.c.size.in_(sizes)))
+                    .order_by(self.table.c.size)
+                )
+                rows = [dict(row) for row in connection.execute(query)]
+
+            for _, group in groupby(rows, key=lambda row: row["size"]):
+                yield list(group)
+            last_size = sizes[-1]
+
+    def update(self, row: Dict, hash_info: Dict) -> None:
+        """Set the hashs of the file of row"""
+        query = (
+            self.table.update()
+            .where(
+                and_(
+                    self.table.c.folder_id == row["folder_id"],
+                    self.table.c.folder == row["folder"],
+                    self.table.c.name == row["name"],
+                )
+            )
+            .values(**hash_info)
+        )
+        with self.engine.begin() as connection:
+            connection.execute(query)
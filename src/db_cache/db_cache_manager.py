@@ -1,96 +1,942 @@
 #!/usr/bin/env python3
 import os
-import traceback
+from collections import Counter
+from collections import defaultdict
+from contextlib import contextmanager
 from ctypes import c_ulong
+from itertools import groupby
+from operator import itemgetter
 from time import time
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Set
 from typing import Tuple
 
+import numpy as np
 import pandas as pd
 from numpy import base_repr
+from sqlalchemy import and_
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import Table
+from sqlalchemy import text
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy_utils.functions import create_database
-from sqlalchemy_utils.functions import database_exists
 
 from . import Base
+from . import cache_table
 from . import Folders
+from .array_hash_index import ArrayHashIndex
+from .bulk_writes import delete_records
+from .bulk_writes import PATH_KEYS
+from .bulk_writes import upsert_records
+from .content_index import ContentIndex
+from .index_snapshot import remove_snapshot
+from .hash_index import HashIndex
+from .sidecar import Sidecar
+from .sql_hash_index import SIZE_IN_CLAUSE
+from .sql_hash_index import SqlHashIndex
 from src.io_files.hash_functions import FileHashManager
-from src.io_files.hash_functions import HASH_FUNCTIONS
+from src.io_files.hash_functions import HASH_ALGORITHM
+from src.io_files.hash_functions import HASH_KEYS
+from src.io_files.hash_functions import HASH_STAGES
+from src.io_files.hash_functions import RECORD_KEYS
+from src.io_files.hash_functions import STAT_KEYS
+from src.io_files.io_wrappers import FileEntry
+from src.io_files.io_wrappers import get_file_entry
+from src.io_files.io_wrappers import iter_file_entries
+from src.metrics import METRICS
+
+# "postgres" (see docker-compose.yml) or "sqlite" : a local file, no server needed
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "postgres")
+SQLITE_PATH = os.getenv(
+    "SQLITE_PATH",
+    os.path.join(
+        os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "find_duplicated_files",
+        "files_hash.db",
+    ),
+)
+# Snapshots of the array indexes, mapped in memory at startup
+SNAPSHOT_FOLDER = os.getenv(
+    "CACHE_SNAPSHOT_FOLDER", os.path.join(os.path.dirname(SQLITE_PATH), "snapshots")
+)
+# Keep the hashs in an index at the root of the volume of the folder, to build the
+# cache from it when the volume is mounted elsewhere / on another computer
+CACHE_SIDECAR = os.getenv("CACHE_SIDECAR", "0") == "1"
+# "0" : use the cache as it is, without comparing it with the files : starts at once,
+# for a folder not modified since it was cached, or kept up to date by watch
+CACHE_REFRESH = os.getenv("CACHE_REFRESH", "1") == "1"
+# Number of records written / hashed between two commits
+SIZE_CHECKPOINT = int(os.getenv("CACHE_CHECKPOINT", 10000))
+# Files of the same size hashed together when looking for the duplicated files
+SIZE_GROUPS_BATCH = 1000
+# Seconds between 2 heartbeats of a watch process. The table of a folder watched is
+# not refreshed when it's loaded : it's already up to date
+WATCH_HEARTBEAT = 60
+# "memory" : load the cache in a HashIndex, "sql" : indexed queries on the cache table,
+# "array" : sizes and truncated digests in memory, for the very big folders
+CACHE_INDEX = os.getenv("CACHE_INDEX", "sql" if CACHE_BACKEND == "sqlite" else "memory")
+
+
+def _set_sqlite_pragma(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
 
 
 class DbCacheManager:
-    def __init__(self, hash_gen: FileHashManager):
+    def __init__(self, hash_gen: FileHashManager, refresh: bool = None):
+        """
+        refresh : compare the cache with the files on disk when it is loaded,
+            to forget the hashs of the files modified since they were hashed.
+            Default CACHE_REFRESH
+        """
         super(DbCacheManager, self).__init__()
         self.hash_gen = hash_gen
+        self.refresh = CACHE_REFRESH if refresh is None else refresh
         self._session_maker = None
         self._table_name = None
+        self._cache_table = None
         self._db_cache = None
+        self._index = None
         self._metadata = None
         self._engine = None
+        self._device = None
+        self._modified = False
+        self._sidecar = None
+        self._sidecar_outdated = False
+        self._folder_id = None
+        self._content_index = None
+        self._content_outdated = False
         self._set_up_db()
 
     def _set_up_db(self):
         self._metadata = Base.metadata
-        self.engine.connect().execution_options(autocommit=True)
-        if not database_exists(url=self.engine.url):
-            create_database(url=self.engine.url, encoding="utf8")
+        if self.engine.dialect.name != "sqlite":
+            # slow to import, and only needed for a database server
+            from sqlalchemy_utils.functions import create_database
+            from sqlalchemy_utils.functions import database_exists
+
+            if not database_exists(url=self.engine.url):
+                create_database(url=self.engine.url, encoding="utf8")
         self._metadata.create_all(self.engine, checkfirst=True)
+        self._migrate_folders_table()
+
+    def _migrate_folders_table(self) -> None:
+        """Add the columns created after the first version of the folders table"""
+        table_name = Folders.__tablename__
+        columns = {
+            column["name"] for column in inspect(self.engine).get_columns(table_name)
+        }
+        new_columns = {
+            "hash_algorithm": "VARCHAR",
+            "build_started": "FLOAT",
+            "watched_at": "FLOAT",
+        }
+        for column, column_type in new_columns.items():
+            if column not in columns:
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        text(
+                            f"ALTER TABLE {table_name} ADD COLUMN {column} {column_type}"
+                        )
+                    )
 
     def read_or_create_cache(self) -> pd.DataFrame:
+        if self._is_build_interrupted():
+            return self._create_db_cache()
         df_table = self._try_read_from_db()
         if df_table is None:
             return self._create_db_cache()
+        if self.refresh and not self.is_watched():
+            return self._refresh_db_cache(df_table)
         return df_table
 
     def find_file(
-        self, file_path: str, hash_generator: FileHashManager
+        self, file_path: str, hash_generator: FileHashManager, hash_info: Dict = None
     ) -> Tuple[str, str]:
-        file_hash_info = hash_generator.get_hashs_for_file(file_path)
-        query = " and ".join([f"{k} == {v!r}" for k, v in file_hash_info.items()])
-        existing_file = self.db_cache.query(query)
+        """
+        hash_info : hashs already known for the file, ex its size.
+        Completed in place with the hashs computed, to reuse them (see compare_file)
+        """
+        hash_info = {} if hash_info is None else hash_info
+        candidates, keys = self.find_candidates(hash_info)
+        while keys is not None:
+            hash_info.update(hash_generator.hash_file(file_path, keys))
+            candidates, keys = self.find_candidates(hash_info)
 
-        if existing_file.shape[0] > 0:
-            return existing_file["folder"].iloc[0], existing_file["name"].iloc[0]
-        else:
+        if not candidates:
+            return "", ""
+        return self.index.location(candidates[0])
+
+    @METRICS.timed("lookup")
+    def find_files(self, hash_infos: List[Dict]) -> List[Tuple[str, str]]:
+        """
+        Batch version of find_file, for files whose stages are all known (ex small
+        files, see get_hashs_for_small_file). Each stage of the candidates of the whole
+        batch is hashed together
+        """
+        candidates: List[List[Hashable]] = [[] for _ in hash_infos]
+        stage_hash_infos: List[Dict] = [{} for _ in hash_infos]
+        for nb_stage, keys in enumerate(HASH_STAGES):
+            if nb_stage > 0:
+                labels = {label for labels in candidates for label in labels}
+                self._complete_hashs(labels, keys)
+            for i, hash_info in enumerate(hash_infos):
+                if nb_stage > 0 and not candidates[i]:
+                    continue
+                stage_hash_infos[i].update({key: hash_info[key] for key in keys})
+                candidates[i] = self.index.find(stage_hash_infos[i])
+
+        return [
+            self.index.location(labels[0]) if labels else ("", "")
+            for labels in candidates
+        ]
+
+    @METRICS.timed("lookup")
+    def find_candidates(
+        self, hash_info: Dict
+    ) -> Tuple[List[Hashable], Optional[Tuple[str, ...]]]:
+        """
+        Files of the cache matching the stages known in hash_info, and the next stage
+        to compute for the file. Stage None : the file is found, or has no match.
+        Lets the caller hash the file in another thread between two lookups.
+        """
+        stage_hash_info = {}
+        candidates = []
+        for nb_stage, keys in enumerate(HASH_STAGES):
+            if not all(key in hash_info for key in keys):
+                return candidates, keys
+            stage_hash_info.update({key: hash_info[key] for key in keys})
+            if nb_stage > 0:
+                self._complete_hashs(candidates, keys)
+            candidates = self.index.find(stage_hash_info)
+            if not candidates:
+                return [], None
+        return candidates, None
+
+    @METRICS.timed("lookup")
+    def find_same_file(self, entry: FileEntry) -> Tuple[str, str]:
+        """
+        A file of the cache with the device and inode of entry : a hard link of the
+        file, or the file itself. Found from the stat values, without reading the file
+        """
+        if entry.device != self.device:
+            return "", ""
+        hash_info = {
+            "size": entry.size,
+            "inode": entry.inode,
+            "mtime_ns": entry.mtime_ns,
+        }
+        candidates = self.index.find(hash_info)
+        if not candidates:
             return "", ""
+        return self.index.location(candidates[0])
+
+    def compare_file(
+        self,
+        target_path: str,
+        source_path: str,
+        hash_generator: FileHashManager,
+        hash_info: Dict,
+    ) -> Optional[bool]:
+        """
+        Compare source_path with target_path, a file of the data folder, stage by stage
+        with the hashs of the cache. None if target_path is not in the cache.
+        hash_info : hashs known for source_path, completed in place with the stages
+        computed, so the source is read once for all the targets it is compared with
+        """
+        folder, name = os.path.split(os.path.relpath(target_path, self.data_folder))
+        label = self.index.find_path(folder or ".", name)
+        if label is None:
+            return None
+
+        for keys in HASH_STAGES:
+            if not all(key in hash_info for key in keys):
+                hash_info.update(hash_generator.hash_file(source_path, keys))
+            self._complete_hashs([label], keys)
+            record = self.index.record(label)
+            if any(record[key] != hash_info[key] for key in keys):
+                return False
+        return True
+
+    def add_file(self, file_path: str) -> None:
+        """Record a file written in the data folder since the cache was loaded"""
+        folder, file_name = os.path.split(file_path)
+        record = self.hash_gen.create_record(folder, file_name)
+        record["timestamp"] = time()
+        self.index.add(record)
+        self._modified = True
+
+    @METRICS.timed("db_write")
+    def refresh_paths(self, paths: Iterable[str]) -> Tuple[int, int]:
+        """
+        Apply to the cache table the changes of files or folders of the data folder,
+        created, modified, moved or removed since the table was refreshed (see watch).
+        The hashs of the files whose stat values didn't change are kept.
+        Return the number of files written and removed
+        """
+        records = []
+        removed = []
+        with self.engine.connect() as connection:
+            for path in paths:
+                cached = {
+                    (row["folder"], row["name"]): row
+                    for row in connection.execute(self._select_under(path))
+                }
+                if os.path.isdir(path):
+                    entries = iter_file_entries(path)
+                else:
+                    entries = filter(None, [get_file_entry(path)])
+                for entry in entries:
+                    record = self.hash_gen.create_record_from_entry(entry)
+                    row = cached.pop((record["folder"], record["name"]), None)
+                    if row is None or any(row[key] != record[key] for key in STAT_KEYS):
+                        records.append(dict(record, timestamp=time()))
+                removed += list(cached)
+
+        if records or removed:
+            if self._index is not None:
+                self.save_cache()
+            remove_snapshot(self.snapshot_path)
+            with self.engine.begin() as connection:
+                upsert_records(connection, self.cache_table, pd.DataFrame(records))
+                delete_records(
+                    connection,
+                    self.cache_table,
+                    pd.DataFrame(removed, columns=PATH_KEYS),
+                )
+            # loaded before the changes
+            self._index = None
+            self._db_cache = None
+            self._content_outdated = True
+        return len(records), len(removed)
+
+    def _select_under(self, path: str):
+        """Records of the file, or of the files of the folder and its sub folders"""
+        table = self.cache_table
+        relative_path = os.path.relpath(path, self.data_folder)
+        if relative_path == ".":
+            return table.select()
+        folder, name = os.path.split(relative_path)
+        return table.select().where(
+            or_(
+                and_(table.c.folder == (folder or "."), table.c.name == name),
+                table.c.folder == relative_path,
+                table.c.folder.startswith(relative_path + os.sep, autoescape=True),
+            )
+        )
 
     def find_duplicated_files(self) -> Tuple[List[str], pd.DataFrame]:
-        df_files_info = self.read_or_create_cache()
+        candidates = self.index.to_dataframe()
+        keys = []
+        for stage_keys in HASH_STAGES:
+            self._complete_hashs(candidates.index, stage_keys)
+            candidates = self.index.to_dataframe().loc[candidates.index]
+            keys += stage_keys
+            candidates = candidates[candidates[keys].notnull().all(axis=1)]
+            candidates = candidates[candidates.duplicated(subset=keys, keep=False)]
+        self.save_cache()
 
-        keys = ["size"] + list(HASH_FUNCTIONS.keys())
-        df_duplicated = df_files_info[df_files_info.duplicated(subset=keys)]
+        labels = candidates[candidates.duplicated(subset=keys)].index
+        df_duplicated = self.index.records(labels)
         self.save_to_db(df_duplicated, "duplicated_files")
 
         return keys, df_duplicated
 
-    def save_to_db(self, df: pd.DataFrame, table_name: str) -> None:
+    def iter_duplicated_files(self) -> Iterable[List[Dict]]:
+        """
+        Groups of identical files, streamed without loading the whole cache : the
+        records are grouped by size, then split by each hash stage. The hashs are
+        computed for SIZE_GROUPS_BATCH files at a time, to hash them in parallel.
+        """
+        groups = []
+        for size_group in self.index.size_groups():
+            groups.append(size_group)
+            if sum(len(group) for group in groups) >= SIZE_GROUPS_BATCH:
+                yield from self._split_groups(groups)
+                groups = []
+        yield from self._split_groups(groups)
+        self.save_cache()
+
+    def _split_groups(self, groups: List[List[Hashable]]) -> Iterable[List[Dict]]:
+        for keys in list(HASH_STAGES)[1:]:
+            self._complete_hashs([label for group in groups for label in group], keys)
+            groups = [
+                sub_group for group in groups for sub_group in self._split(group, keys)
+            ]
+        for group in groups:
+            yield [self.index.record(label) for label in group]
+
+    def _split(self, labels: List[Hashable], keys) -> List[List[Hashable]]:
+        """Sub groups with the same hashs, of more than one file"""
+        groups = defaultdict(list)
+        for label, values in zip(labels, self.index.hash_values(labels, keys)):
+            if all(value is not None for value in values):
+                groups[values].append(label)
+        return [group for group in groups.values() if len(group) > 1]
+
+    @METRICS.timed("db_write")
+    def save_cache(self) -> None:
+        """Save the records added or hashed since the cache was loaded"""
+        if self._modified and not self.index.persistent:
+            remove_snapshot(self.snapshot_path)
+            with self.engine.begin() as connection:
+                upsert_records(connection, self.cache_table, self.index.pop_modified())
+        elif self._modified and isinstance(self.index, ArrayHashIndex):
+            self.index.save_snapshot()
+        self._sidecar_outdated |= self._modified
+        self._content_outdated |= self._modified
+        self._modified = False
+
+    def save_sidecar(self) -> None:
+        """Save the hashs of the folder in the index of its volume (CACHE_SIDECAR)"""
+        self.save_cache()
+        if self.sidecar is None or not self._sidecar_outdated:
+            return
+        if not self._has_table(self.table_name):
+            # no file cached in the folder yet
+            return
+        table = self.cache_table
+        query = select([table]).where(
+            or_(*[table.c[key].isnot(None) for key in HASH_KEYS])
+        )
         try:
+            self.sidecar.update(pd.read_sql(query, self.engine), self.data_folder)
+            self.sidecar.write()
+        except OSError as e:
+            print("Index of the volume not saved :", e)
+        self._sidecar_outdated = False
+
+    @METRICS.timed("db_write")
+    def save_content_index(self) -> None:
+        """Replace the files of the folder in the index of all the roots"""
+        self.save_cache()
+        if not self._has_table(self.table_name):
+            # no file cached in the folder yet
+            return
+        if self._content_outdated or not self.content_index.has_root(self.folder_id):
+            self.content_index.sync(self.folder_id, self.cache_table)
+        self._content_outdated = False
+
+    def registered_roots(self, folders: Iterable[str] = None) -> Dict[int, Folders]:
+        """Folders of the cache by folder_id : all of them, or those of `folders`"""
+        with self.session() as session:
+            query = session.query(Folders)
+            if folders is not None:
+                folder_names = [os.path.abspath(folder) for folder in folders]
+                query = query.filter(Folders.folder_name.in_(folder_names))
+            return {db_folder.folder_id: db_folder for db_folder in query}
+
+    def find_file_in_roots(
+        self,
+        file_path: str,
+        hash_generator: FileHashManager,
+        hash_info: Dict,
+        roots: Dict[int, Folders],
+        accept_unmounted: bool = False,
+    ) -> Tuple[str, str, str]:
+        """
+        A file with the content of file_path in the roots (see registered_roots), from
+        one indexed query on the ContentIndex. The hashs missing in the index are
+        computed for the files of the roots mounted.
+        accept_unmounted : also match the files of the roots not mounted, on the hashs
+            already known : they can't be checked, the file may be gone since the
+            last sync of the root
+        hash_info : completed in place, like for find_file
+        Return (root, folder, name), empty strings if not found
+        """
+        if "size" not in hash_info:
+            hash_info.update(hash_generator.hash_file(file_path, ("size",)))
+        candidates = self.content_index.find(hash_info["size"], roots)
+        for keys in list(HASH_STAGES)[1:]:
+            if not candidates:
+                break
+            if not all(key in hash_info for key in keys):
+                hash_info.update(hash_generator.hash_file(file_path, keys))
+            self._complete_root_hashs(candidates, keys, roots)
+            candidates = [
+                row
+                for row in candidates
+                if all(row[key] == hash_info[key] for key in keys)
+            ]
+
+        for row in candidates:
+            root = roots[row["folder_id"]].folder_name
+            if not os.path.isdir(root):
+                if accept_unmounted:
+                    return root, row["folder"], row["name"]
+            # removed since the root was synced
+            elif os.path.isfile(os.path.join(root, row["folder"], row["name"])):
+                return root, row["folder"], row["name"]
+        return "", "", ""
+
+    def iter_duplicated_files_across_roots(
+        self, roots: Dict[int, Folders]
+    ) -> Iterable[List[Dict]]:
+        """
+        Groups of identical files found in several of the roots, streamed from the
+        ContentIndex by size then split by each hash stage, like
+        iter_duplicated_files. The records have the path of their root in "root"
+        """
+        groups = []
+        for size_group in self.content_index.size_groups(roots):
+            groups.append(size_group)
+            if sum(len(group) for group in groups) >= SIZE_GROUPS_BATCH:
+                yield from self._split_root_groups(groups, roots)
+                groups = []
+        yield from self._split_root_groups(groups, roots)
+
+    def _split_root_groups(
+        self, groups: List[List[Dict]], roots: Dict[int, Folders]
+    ) -> Iterable[List[Dict]]:
+        for keys in list(HASH_STAGES)[1:]:
+            self._complete_root_hashs(
+                [row for group in groups for row in group], keys, roots
+            )
+            split_groups = []
+            for group in groups:
+                sub_groups = defaultdict(list)
+                for row in group:
+                    values = tuple(row[key] for key in keys)
+                    if all(value is not None for value in values):
+                        sub_groups[values].append(row)
+                split_groups += [
+                    sub_group
+                    for sub_group in sub_groups.values()
+                    if len({row["folder_id"] for row in sub_group}) > 1
+                ]
+            groups = split_groups
+        for group in groups:
+            yield [dict(row, root=roots[row["folder_id"]].folder_name) for row in group]
+
+    def _complete_root_hashs(
+        self, rows: List[Dict], keys, roots: Dict[int, Folders]
+    ) -> None:
+        """
+        Compute in place the hashs of the stage `keys` for the rows of the mounted
+        roots who don't have it yet. Saved in the ContentIndex and in the cache table
+        of their root
+        """
+        file_paths = {}
+        for row in rows:
+            root = roots[row["folder_id"]].folder_name
+            if any(row[key] is None for key in keys) and os.path.isdir(root):
+                file_paths[os.path.join(root, row["folder"], row["name"])] = row
+        for file_path, hash_info in self.hash_gen.hash_files(file_paths, keys):
+            row = file_paths[file_path]
+            hash_info = {key: hash_info[key] for key in keys}
+            row.update(hash_info)
+            self.content_index.update(row, hash_info)
+            db_folder = roots[row["folder_id"]]
+            if db_folder.hash_algorithm == HASH_ALGORITHM:
+                # the tables of the other algorithms are migrated when they're loaded
+                table = cache_table(db_folder.table_name)
+                remove_snapshot(
+                    os.path.join(SNAPSHOT_FOLDER, f"{db_folder.table_name}.idx")
+                )
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        table.update()
+                        .where(
+                            and_(
+                                table.c.folder == row["folder"],
+                                table.c.name == row["name"],
+                            )
+                        )
+                        .values(**hash_info)
+                    )
+
+    @METRICS.timed("db_write")
+    def save_to_db(self, df: pd.DataFrame, table_name: str) -> None:
+        """Raise the errors : a cache not written must not be used as migrated"""
+        if table_name == self.table_name:
+            self._write_cache_table(df)
+        else:
             df.to_sql(table_name, self.engine, if_exists="replace", index=False)
-            self._update_db_metadata()
-        except Exception as e:
-            traceback.print_tb(e.__traceback__)
-            print(e)
-            df.to_csv(table_name + ".csv", index=False)
 
     def _try_read_from_db(self) -> Optional[pd.DataFrame]:
-        if self.table_name in self.tables:
-            return pd.read_sql_table(self.table_name, self.engine)
+        if self._has_table(self.table_name):
+            df_table = pd.read_sql_table(self.table_name, self.engine)
+            for key in HASH_KEYS:
+                if key not in df_table.columns:
+                    df_table[key] = None
+            self._update_hash_algorithm()
+            self._migrate_cache_table(df_table)
+            return df_table
         return None
 
+    def _migrate_cache_table(self, df_table: pd.DataFrame = None) -> None:
+        """Rewrite the tables created by a previous version, or for another HASH_ALGORITHM"""
+        inspector = inspect(self.engine)
+        columns = {column["name"] for column in inspector.get_columns(self.table_name)}
+        indexes = {index["name"] for index in inspector.get_indexes(self.table_name)}
+        if (
+            set(self.cache_table.c.keys()) <= columns
+            and {index.name for index in self.cache_table.indexes} <= indexes
+        ):
+            return
+
+        print("Migrate cache table", self.table_name)
+        if df_table is None:
+            df_table = pd.read_sql_table(self.table_name, self.engine)
+        self.save_to_db(df_table, self.table_name)
+
+    def _write_cache_table(self, df: pd.DataFrame) -> None:
+        """Replace the cache table, with bulk inserts in one transaction"""
+        remove_snapshot(self.snapshot_path)
+        with self.engine.begin() as connection:
+            self.cache_table.drop(connection, checkfirst=True)
+            self.cache_table.create(connection)
+            upsert_records(connection, self.cache_table, df)
+
+    def _update_hash_algorithm(self) -> None:
+        """
+        When HASH_ALGORITHM changed, the cache is migrated lazily : the hashs of
+        the current algorithm are computed on demand, like for new files
+        """
+        with self.session() as session:
+            db_folder: Folders = session.query(Folders).filter_by(
+                folder_name=self.data_folder
+            ).first()
+            if db_folder.hash_algorithm != HASH_ALGORITHM:
+                previous_algorithm = db_folder.hash_algorithm or "md5+sha256"
+                print(
+                    f"Cache hashed with {previous_algorithm}, migrate to",
+                    HASH_ALGORITHM,
+                )
+                db_folder.hash_algorithm = HASH_ALGORITHM
+                session.commit()
+
+    def _complete_hashs(self, labels: Iterable[Hashable], keys) -> None:
+        """Compute the hashs of the stage `keys` for the rows who don't have it yet"""
+        file_paths = {
+            os.path.join(self.data_folder, *self.index.location(label)): label
+            for label in self.index.missing(labels, keys)
+        }
+        # counted in "hash" and "db_write", not in the lookup waiting for them
+        with METRICS.paused():
+            hash_results = self.hash_gen.hash_files(file_paths, keys)
+            for nb_hashed, (file_path, hash_info) in enumerate(hash_results, 1):
+                hash_info = {key: hash_info[key] for key in keys}
+                self.index.update(file_paths[file_path], hash_info)
+                self._modified = True
+                if nb_hashed % SIZE_CHECKPOINT == 0:
+                    self.save_cache()
+
     def _create_db_cache(self) -> pd.DataFrame:
-        print("Create cache from folder", self.data_folder)
+        self._build_db_cache()
+        return pd.read_sql_table(self.table_name, self.engine)
+
+    def _build_db_cache(self) -> None:
+        """
+        Stream the records to the cache table, committed every SIZE_CHECKPOINT files.
+        The files of a folder are committed together : when an interrupted build is
+        resumed, the folders already in the table are skipped, whatever the order of
+        the walk (see SCAN_WORKERS).
+        """
+        folders_done = set()
+        remove_snapshot(self.snapshot_path)
+        if self._is_build_interrupted() and self._has_table(self.table_name):
+            print("Resume cache from folder", self.data_folder)
+            query = select([self.cache_table.c.folder]).distinct()
+            with self.engine.connect() as connection:
+                folders_done = {row[0] for row in connection.execute(query)}
+        else:
+            print("Create cache from folder", self.data_folder)
+            self.cache_table.drop(self.engine, checkfirst=True)
+            self.cache_table.create(self.engine)
+        self._set_build_started(time())
 
         file_hash_manager = FileHashManager(self.data_folder)
-        df_files_info = pd.DataFrame(file_hash_manager.generate_file_records())
-        df_files_info["timestamp"] = time()
+        records = []
+        for folder, folder_records in groupby(
+            file_hash_manager.generate_file_records(), key=itemgetter("folder")
+        ):
+            if folder not in folders_done:
+                records += [dict(record, timestamp=time()) for record in folder_records]
+            if len(records) >= SIZE_CHECKPOINT:
+                self._write_records(records)
+                records = []
+        self._write_records(records)
+        self._set_build_started(None)
+        self._content_outdated = True
+
+    @METRICS.timed("db_write")
+    def _write_records(self, records: List[Dict]) -> None:
+        df = pd.DataFrame(records)
+        self._fill_from_sidecar(df)
+        with self.engine.begin() as connection:
+            upsert_records(connection, self.cache_table, df)
+
+    def _fill_from_sidecar(self, df_files_info: pd.DataFrame) -> np.ndarray:
+        """Mask of the records whose hashs were found in the index of the volume"""
+        if self.sidecar is None:
+            return np.zeros(df_files_info.shape[0], dtype=bool)
+        filled = self.sidecar.fill_hashs(df_files_info, self.data_folder)
+        if filled.any():
+            print(f"  {int(filled.sum())} files hashed from {self.sidecar.path}")
+        return filled
+
+    def _is_build_interrupted(self) -> bool:
+        with self.session() as session:
+            db_folder: Folders = session.query(Folders).filter_by(
+                folder_name=self.data_folder
+            ).first()
+        return db_folder is not None and db_folder.build_started is not None
+
+    def _set_build_started(self, build_started: Optional[float]) -> None:
+        with self.session() as session:
+            db_folder: Folders = session.query(Folders).filter_by(
+                folder_name=self.data_folder
+            ).first()
+            db_folder.build_started = build_started
+            session.commit()
+
+    def is_watched(self) -> bool:
+        with self.session() as session:
+            db_folder: Folders = session.query(Folders).filter_by(
+                folder_name=self.data_folder
+            ).first()
+        return (
+            db_folder is not None
+            and db_folder.watched_at is not None
+            and time() - db_folder.watched_at < 2 * WATCH_HEARTBEAT
+        )
+
+    def set_watched(self, watched: bool) -> None:
+        """Heartbeat of the watch process, False when it stops"""
+        with self.session() as session:
+            db_folder: Folders = session.query(Folders).filter_by(
+                folder_name=self.data_folder
+            ).first()
+            # None : the cache of the folder is not created
+            if db_folder is not None:
+                db_folder.watched_at = time() if watched else None
+                session.commit()
+
+    def _refresh_db_cache(self, df_table: pd.DataFrame) -> pd.DataFrame:
+        """
+        Keep the hashs of the files whose (size, mtime_ns, inode) didn't change,
+        forget the others. Removed files are deleted from the cache.
+        """
+        print("Refresh cache from folder", self.data_folder)
+        keys = ["folder", "name"]
+
+        df_files_info = self._read_files_info().set_index(keys)
+        df_cached = df_table.reindex(columns=RECORD_KEYS + ["timestamp"])
+        df_cached = df_cached.drop_duplicates(subset=keys).set_index(keys)
+        df_cached = df_cached.astype(object).reindex(df_files_info.index)
+
+        known = df_files_info.index.isin(df_cached.dropna(subset=["size"]).index)
+        unchanged = (df_files_info[STAT_KEYS] == df_cached[STAT_KEYS]).all(axis=1)
+        for key in HASH_KEYS + ["timestamp"]:
+            df_files_info[key] = df_cached[key].where(unchanged, None)
+        df_files_info.loc[~unchanged, "timestamp"] = time()
+        self._copy_hashs_of_links(df_files_info, unchanged)
+        df_files_info = df_files_info.reset_index()[RECORD_KEYS + ["timestamp"]]
+        # written with the new and modified files
+        written = ~unchanged.values | self._fill_from_sidecar(df_files_info)
 
-        self.save_to_db(df_files_info, self.table_name)
+        table_paths = pd.MultiIndex.from_frame(df_table[keys])
+        df_removed = df_table[~table_paths.isin(df_files_info.set_index(keys).index)]
+        if written.any() or df_removed.shape[0] > 0:
+            remove_snapshot(self.snapshot_path)
+            self._content_outdated = True
+        with self.engine.begin() as connection:
+            upsert_records(connection, self.cache_table, df_files_info[written])
+            delete_records(connection, self.cache_table, df_removed)
+
+        nb_new = int((~known).sum())
+        nb_modified = int((known & ~unchanged).sum())
+        print(
+            f"  {nb_new} new, {nb_modified} modified, {df_removed.shape[0]} removed files"
+        )
         return df_files_info
 
+    def _copy_hashs_of_links(self, df_files_info: pd.DataFrame, unchanged) -> None:
+        """
+        A new or modified file with several links, and the inode, size and mtime of
+        an unchanged file is a hard link of it : it gets its hashs without being read
+        df_files_info : indexed by folder and name
+        """
+        link_keys = ["inode", "size", "mtime_ns"]
+        has_inode = (df_files_info["inode"] != 0).values
+        df_links = (
+            df_files_info[unchanged.values & has_inode]
+            .drop_duplicates(subset=link_keys)
+            .set_index(link_keys)
+        )
+        rows = np.flatnonzero(~unchanged.values & has_inode)
+        new_links = pd.MultiIndex.from_frame(df_files_info.iloc[rows][link_keys])
+        is_link = new_links.isin(df_links.index)
+        if not is_link.any():
+            return
+        is_link[is_link] = [
+            self._has_links(folder, name)
+            for folder, name in df_files_info.index[rows[is_link]]
+        ]
+        for key in HASH_KEYS:
+            hashs = df_links[key].reindex(new_links[is_link]).values
+            df_files_info.iloc[rows[is_link], df_files_info.columns.get_loc(key)] = (
+                hashs
+            )
+
+    def _has_links(self, folder: str, name: str) -> bool:
+        """
+        Other files with the same stat values are not always links of the file : ex
+        without inode numbers, or after the link was removed
+        """
+        try:
+            stat = os.stat(os.path.join(self.data_folder, folder, name))
+        except OSError:
+            return False
+        return stat.st_nlink > 1
+
+    def _refresh_by_chunks(self) -> None:
+        """
+        Same as _refresh_db_cache, without loading the folder or the cache table :
+        the files are compared with the table SIZE_CHECKPOINT files at a time, with
+        indexed queries on the folders of the chunk
+        """
+        print("Refresh cache from folder", self.data_folder)
+        counts = Counter()
+        folders_seen = set()
+        records = []
+        file_hash_manager = FileHashManager(self.data_folder)
+        for folder, folder_records in groupby(
+            file_hash_manager.generate_file_records(), key=itemgetter("folder")
+        ):
+            folders_seen.add(folder)
+            records += list(folder_records)
+            if len(records) >= SIZE_CHECKPOINT:
+                self._refresh_records(records, counts)
+                records = []
+        self._refresh_records(records, counts)
+        counts["removed"] += self._delete_folders_except(folders_seen)
+        print(
+            f"  {counts['new']} new, {counts['modified']} modified, "
+            f"{counts['removed']} removed files"
+        )
+
+    @METRICS.timed("db_write")
+    def _refresh_records(self, records: List[Dict], counts: Counter) -> None:
+        """Compare the records of whole folders with their rows of the cache table"""
+        if not records:
+            return
+        table = self.cache_table
+        folders = sorted({record["folder"] for record in records})
+        cached = {}
+        with self.engine.connect() as connection:
+            for start in range(0, len(folders), SIZE_IN_CLAUSE):
+                query = select([table]).where(
+                    table.c.folder.in_(folders[start : start + SIZE_IN_CLAUSE])
+                )
+                for row in connection.execute(query):
+                    cached[row["folder"], row["name"]] = dict(row)
+
+        written = []
+        unhashed = []
+        for record in records:
+            row = cached.pop((record["folder"], record["name"]), None)
+            if row is None or any(row[key] != record[key] for key in STAT_KEYS):
+                counts["new" if row is None else "modified"] += 1
+                written.append(dict(record, timestamp=time()))
+            elif self.sidecar is not None and any(row[k] is None for k in HASH_KEYS):
+                unhashed.append(row)
+        df_written = pd.DataFrame(
+            written + unhashed, columns=RECORD_KEYS + ["timestamp"]
+        )
+        is_written = df_written.index < len(written)
+        self._copy_hashs_of_table_links(df_written, is_written)
+        df_written = df_written[is_written | self._fill_from_sidecar(df_written)]
+        # files of these folders removed
+        df_removed = pd.DataFrame(list(cached), columns=PATH_KEYS)
+        counts["removed"] += df_removed.shape[0]
+
+        if df_written.shape[0] or df_removed.shape[0]:
+            remove_snapshot(self.snapshot_path)
+            self._content_outdated = True
+            with self.engine.begin() as connection:
+                upsert_records(connection, table, df_written)
+                delete_records(connection, table, df_removed)
+
+    def _copy_hashs_of_table_links(self, df_files_info: pd.DataFrame, mask) -> None:
+        """
+        Like _copy_hashs_of_links, with the hashed rows of the table : the records
+        of the mask with several links, and their inode, size and mtime are hard
+        links of them
+        """
+        if not mask.any():
+            return
+        table = self.cache_table
+        link_keys = ["inode", "size", "mtime_ns"]
+        sizes = sorted({int(size) for size in df_files_info.loc[mask, "size"]})
+        links = {}
+        with self.engine.connect() as connection:
+            for start in range(0, len(sizes), SIZE_IN_CLAUSE):
+                query = select([table.c[key] for key in link_keys + HASH_KEYS]).where(
+                    and_(
+                        table.c.size.in_(sizes[start : start + SIZE_IN_CLAUSE]),
+                        or_(*[table.c[key].isnot(None) for key in HASH_KEYS]),
+                    )
+                )
+                for row in connection.execute(query):
+                    links[tuple(row[: len(link_keys)])] = row[len(link_keys) :]
+        if not links:
+            return
+        for i in np.flatnonzero(mask):
+            if df_files_info.loc[i, "inode"] == 0:
+                continue
+            values = links.get(tuple(df_files_info.loc[i, link_keys]))
+            if values is not None and self._has_links(
+                df_files_info.loc[i, "folder"], df_files_info.loc[i, "name"]
+            ):
+                df_files_info.loc[i, HASH_KEYS] = list(values)
+
+    def _delete_folders_except(self, folders: Set[str]) -> int:
+        """Delete the rows of the other folders : removed, or without files"""
+        table = self.cache_table
+        with self.engine.connect() as connection:
+            removed = [
+                row[0]
+                for row in connection.execute(select([table.c.folder]).distinct())
+                if row[0] not in folders
+            ]
+        nb_removed = 0
+        if removed:
+            remove_snapshot(self.snapshot_path)
+            self._content_outdated = True
+            with self.engine.begin() as connection:
+                for start in range(0, len(removed), SIZE_IN_CLAUSE):
+                    query = table.delete().where(
+                        table.c.folder.in_(removed[start : start + SIZE_IN_CLAUSE])
+                    )
+                    nb_removed += connection.execute(query).rowcount
+        return nb_removed
+
+    def _read_files_info(self) -> pd.DataFrame:
+        file_hash_manager = FileHashManager(self.data_folder)
+        return pd.DataFrame(
+            file_hash_manager.generate_file_records(), columns=RECORD_KEYS
+        )
+
+    def _has_table(self, table_name: str) -> bool:
+        """Without reflecting all the tables of the database, like self.tables"""
+        with self.engine.connect() as connection:
+            return self.engine.dialect.has_table(connection, table_name)
+
     def _update_db_metadata(self) -> None:
-        if not self._metadata.is_bound():
+        if self._metadata.bind is not self.engine:
             self._metadata.bind = self.engine
         self._metadata.reflect()
 
@@ -99,37 +945,83 @@ class DbCacheManager:
         if self._table_name:
             return self._table_name
 
-        db_folder: Folders = self.session.query(Folders).filter_by(
-            folder_name=self.data_folder
-        ).first()
-        if db_folder is None:
-            hash_value = hash(self.data_folder)
-            hash_value = hash_value if hash_value >= 0 else c_ulong(hash_value).value
-            db_folder = Folders(
-                folder_name=self.data_folder, table_name=base_repr(hash_value, 36)
-            )
+        with self.session() as session:
+            db_folder: Folders = session.query(Folders).filter_by(
+                folder_name=self.data_folder
+            ).first()
+            if db_folder is None:
+                hash_value = hash(self.data_folder)
+                hash_value = (
+                    hash_value if hash_value >= 0 else c_ulong(hash_value).value
+                )
+                db_folder = Folders(
+                    folder_name=self.data_folder,
+                    table_name=base_repr(hash_value, 36),
+                    hash_algorithm=HASH_ALGORITHM,
+                )
+                session.add(db_folder)
+                session.commit()
 
-            session = self.session
-            session.add(db_folder)
-            session.commit()
-
-        self._table_name = db_folder.table_name
+            self._folder_id = db_folder.folder_id
+            self._table_name = db_folder.table_name
         return self._table_name
 
+    @property
+    def folder_id(self) -> int:
+        """Id of the folder in the Folders table, its root id in the ContentIndex"""
+        # read or created with the table name
+        _ = self.table_name
+        return self._folder_id
+
+    @property
+    def device(self) -> Optional[int]:
+        """None while the data folder doesn't exist : no file can be linked in it"""
+        if self._device is None and os.path.isdir(self.data_folder):
+            self._device = os.stat(self.data_folder).st_dev
+        return self._device
+
+    @property
+    def sidecar(self) -> Optional[Sidecar]:
+        if self._sidecar is None and CACHE_SIDECAR:
+            self._sidecar = Sidecar(self.data_folder)
+        return self._sidecar
+
+    @property
+    def content_index(self) -> ContentIndex:
+        if self._content_index is None:
+            self._content_index = ContentIndex(self.engine)
+        return self._content_index
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(SNAPSHOT_FOLDER, f"{self.table_name}.idx")
+
     @property
     def engine(self):
         if self._engine is None:
-            db_user = os.getenv("POSTGRES_USER", "postgres")
-            db_pwd = os.getenv("POSTGRES_PASSWORD")
-            db_host = os.getenv("POSTGRES_HOST", "localhost")
-            self._engine = create_engine(
-                f"postgresql://{db_user}:{db_pwd}@{db_host}:5432/postgres"
-            )
+            if CACHE_BACKEND == "sqlite":
+                os.makedirs(os.path.dirname(SQLITE_PATH), exist_ok=True)
+                self._engine = create_engine(f"sqlite:///{SQLITE_PATH}")
+            else:
+                db_user = os.getenv("POSTGRES_USER", "postgres")
+                db_pwd = os.getenv("POSTGRES_PASSWORD")
+                db_host = os.getenv("POSTGRES_HOST", "localhost")
+                self._engine = create_engine(
+                    f"postgresql://{db_user}:{db_pwd}@{db_host}:5432/postgres"
+                )
+            if self._engine.dialect.name == "sqlite":
+                event.listen(self._engine, "connect", _set_sqlite_pragma)
         return self._engine
 
+    @property
+    def cache_table(self) -> Table:
+        if self._cache_table is None:
+            self._cache_table = cache_table(self.table_name)
+        return self._cache_table
+
     @property
     def tables(self):
-        if not self._metadata.is_bound():
+        if self._metadata.bind is not self.engine:
             self._update_db_metadata()
         return self._metadata.tables
 
@@ -144,7 +1036,38 @@ class DbCacheManager:
         return self._db_cache
 
     @property
-    def session(self):
+    def index(self) -> HashIndex:
+        if self._index is None:
+            if CACHE_INDEX in ("sql", "array"):
+                if not self._has_table(self.table_name) or self._is_build_interrupted():
+                    self._build_db_cache()
+                else:
+                    self._update_hash_algorithm()
+                    self._migrate_cache_table()
+                    if self.refresh and not self.is_watched():
+                        self._refresh_by_chunks()
+                if CACHE_INDEX == "array":
+                    self._index = ArrayHashIndex(
+                        self.engine, self.cache_table, self.snapshot_path
+                    )
+                else:
+                    # the updates of the index are not in the snapshot
+                    remove_snapshot(self.snapshot_path)
+                    self._index = SqlHashIndex(self.engine, self.cache_table)
+            else:
+                self._index = HashIndex(self.db_cache)
+        return self._index
+
+    @contextmanager
+    def session(self) -> Iterator[Session]:
+        """
+        Closed at the end of the block, in the thread who opened it : a sqlite
+        connection can't be released in another thread. The objects read stay usable
+        """
         if self._session_maker is None:
-            self._session_maker = sessionmaker(bind=self.engine)
-        return self._session_maker()
+            self._session_maker = sessionmaker(bind=self.engine, expire_on_commit=False)
+        session = self._session_maker()
+        try:
+            yield session
+        finally:
+            session.close()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+from collections import defaultdict
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import pandas as pd
+
+from src.io_files.hash_functions import HASH_STAGES
+
+FULL_HASH_KEYS = list(HASH_STAGES)[-1]
+
+
+class HashIndex:
+    """
+    Index of the cache records, built once from the cache table :
+    - size -> records, to find the candidates of the staged matcher
+    - (size, *full hashs) -> records, for the records already fully hashed
+    - (folder, name) -> record
+    A record is identified by its position in the index.
+    """
+
+    persistent = False
+
+    def __init__(self, df_files_info: pd.DataFrame):
+        super(HashIndex, self).__init__()
+        self._columns = list(df_files_info.columns)
+        self._records: List[Dict] = []
+        self._by_size: Dict[int, List[int]] = defaultdict(list)
+        self._by_digest: Dict[Tuple, List[int]] = defaultdict(list)
+        self._by_path: Dict[Tuple[str, str], int] = {}
+        # records added or updated since the last pop_modified
+        self._modified: Set[int] = set()
+
+        df_files_info = df_files_info.astype(object).where(
+            df_files_info.notnull(), None
+        )
+        for record in df_files_info.to_dict("records"):
+            self._add(record)
+
+    def __len__(self):
+        return len(self._records)
+
+    def add(self, record: Dict) -> int:
+        label = self._add(record)
+        self._modified.add(label)
+        return label
+
+    def _add(self, record: Dict) -> int:
+        label = len(self._records)
+        self._records.append(record)
+        self._columns += [key for key in record if key not in self._columns]
+        self._by_size[int(record["size"])].append(label)
+        self._by_path[record["folder"], record["name"]] = label
+
+        digest_key = self._digest_key(record)
+        if digest_key is not None:
+            self._by_digest[digest_key].append(label)
+        return label
+
+    def find(self, hash_info: Dict) -> List[int]:
+        """Records matching all the keys of hash_info. hash_info must contain the size"""
+        digest_key = self._digest_key(hash_info)
+        if digest_key is not None:
+            return list(self._by_digest.get(digest_key, []))
+
+        other_keys = [key for key in hash_info if key != "size"]
+        return [
+            label
+            for label in self._by_size.get(int(hash_info["size"]), [])
+            if all(self._records[label][key] == hash_info[key] for key in other_keys)
+        ]
+
+    def find_path(self, folder: str, name: str) -> Optional[int]:
+        return self._by_path.get((folder, name))
+
+    def size_groups(self) -> Iterable[List[int]]:
+        """Records of the same size, for the sizes shared by several records"""
+        for labels in list(self._by_size.values()):
+            if len(labels) > 1:
+                yield list(labels)
+
+    def hash_values(self, labels: Iterable[int], keys) -> List[Tuple]:
+        return [
+            tuple(self._records[label].get(key) for key in keys) for label in labels
+        ]
+
+    def missing(self, labels: Iterable[int], keys) -> List[int]:
+        """Records without a value for one of the keys"""
+        return [
+            label
+            for label in labels
+            if any(self._records[label].get(key) is None for key in keys)
+        ]
+
+    def location(self, label: int) -> Tuple[str, str]:
+        record = self._records[label]
+        return record["folder"], record["name"]
+
+    def record(self, label: int) -> Dict:
+        return dict(self._records[label])
+
+    def update(self, label: int, hash_info: Dict) -> None:
+        record = self._records[label]
+        already_indexed = self._digest_key(record) is not None
+        record.update(hash_info)
+        self._modified.add(label)
+
+        digest_key = self._digest_key(record)
+        if digest_key is not None and not already_indexed:
+            self._by_digest[digest_key].append(label)
+
+    def records(self, labels: Iterable[int]) -> pd.DataFrame:
+        labels = list(labels)
+        records = [self._records[label] for label in labels]
+        return pd.DataFrame(records, index=labels, columns=self._columns)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self._records, columns=self._columns)
+
+    def pop_modified(self) -> pd.DataFrame:
+        """Records added or updated since the last call"""
+        records = [self._records[label] for label in sorted(self._modified)]
+        self._modified = set()
+        return pd.DataFrame(records, columns=self._columns)
+
+    @classmethod
+    def _digest_key(cls, hash_info: Dict) -> Optional[Tuple]:
+        values = [hash_info.get(key) for key in FULL_HASH_KEYS]
+        if any(value is None for value in values):
+            return None
+        return (int(hash_info["size"]),) + tuple(values)
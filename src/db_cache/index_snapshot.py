@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import json
+import os
+import struct
+import zlib
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+# Bump when the layout of the arrays changes : older snapshots are ignored
+VERSION = 2
+MAGIC = b"FDFINDEX"
+# magic, version, size of the json header
+HEADER_FORMAT = "<8sII"
+ALIGNMENT = 8
+# Check the crc32 of the arrays when a snapshot is opened : reads the whole file.
+# Otherwise only the header and the size of the file are checked
+VERIFY = os.getenv("CACHE_SNAPSHOT_VERIFY", "0") == "1"
+
+
+def write_snapshot(path: str, arrays: Dict[str, np.ndarray], info: Dict) -> None:
+    """
+    Write the arrays in a single file, aligned to be read with mmap.
+    info : checked by the reader, to detect a snapshot of another table
+    """
+    offset = 0
+    layout = []
+    for name, array in arrays.items():
+        layout.append([name, array.dtype.str, len(array), offset])
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    crc = 0
+    for array in arrays.values():
+        crc = zlib.crc32(_padded(array), crc)
+    header = {"arrays": layout, "data_size": offset, "info": info}
+    header = dict(header, crc32=crc, header_crc32=_header_crc(header))
+    header = json.dumps(header).encode()
+    header += b" " * (-(struct.calcsize(HEADER_FORMAT) + len(header)) % ALIGNMENT)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(header)))
+        f.write(header)
+        for array in arrays.values():
+            f.write(_padded(array))
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(
+    path: str, verify: bool = None
+) -> Optional[Tuple[Dict[str, np.ndarray], Dict]]:
+    """
+    Arrays mapped in memory, copy on write : they can be modified without changing
+    the file, and are only read from the disk when used.
+    None if the file is missing, of another version, truncated, or with a corrupted
+    header. verify : also check the crc32 of the arrays, default VERIFY
+    """
+    verify = VERIFY if verify is None else verify
+    try:
+        with open(path, "rb") as f:
+            magic, version, header_size = struct.unpack(
+                HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT))
+            )
+            if magic != MAGIC or version != VERSION:
+                return None
+            header = json.loads(f.read(header_size))
+        if header["header_crc32"] != _header_crc(header):
+            return None
+
+        start = struct.calcsize(HEADER_FORMAT) + header_size
+        if os.path.getsize(path) != start + header["data_size"]:
+            return None
+        data = np.memmap(path, dtype=np.uint8, mode="c")[start:]
+        if verify and zlib.crc32(data) != header["crc32"]:
+            return None
+
+        arrays = {}
+        for name, dtype, length, offset in header["arrays"]:
+            dtype = np.dtype(dtype)
+            end = offset + length * dtype.itemsize
+            if end > header["data_size"]:
+                return None
+            arrays[name] = data[offset:end].view(dtype)
+        return arrays, header["info"]
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+
+
+def remove_snapshot(path: str) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _header_crc(header: Dict) -> int:
+    """crc32 of the layout and info of the header"""
+    values = [header["arrays"], header["data_size"], header["info"]]
+    return zlib.crc32(json.dumps(values, sort_keys=True).encode())
+
+
+def _padded(array: np.ndarray) -> bytes:
+    data = np.ascontiguousarray(array).tobytes()
+    return data + b"\0" * (-len(data) % ALIGNMENT)
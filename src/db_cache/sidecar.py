@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import gzip
+import json
+import os
+import uuid
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.io_files.hash_functions import HASH_KEYS
+from src.io_files.io_wrappers import SIDECAR_NAME
+
+# Bump when the layout of the file changes : older files are ignored
+VERSION = 2
+FORMAT = "find_duplicated_files sidecar"
+# Identify a file across mounts : path from the root of the volume, size and mtime.
+# Not the inode : FAT / exFAT files get a new inode number on each mount
+STAT_KEYS = ["size", "mtime_ns"]
+MATCH_KEYS = ["folder", "name"] + STAT_KEYS
+
+
+def volume_root(folder: str) -> str:
+    """Mount point of the volume of the folder"""
+    folder = os.path.abspath(folder)
+    while not os.path.ismount(folder):
+        folder = os.path.dirname(folder)
+    return folder
+
+
+def volume_uuid(folder: str) -> Optional[str]:
+    """UUID of the filesystem of the folder, None if not found (ex not on Linux)"""
+    device = os.stat(folder).st_dev
+    by_uuid = "/dev/disk/by-uuid"
+    try:
+        for name in os.listdir(by_uuid):
+            if os.stat(os.path.join(by_uuid, name)).st_rdev == device:
+                return name
+    except OSError:
+        pass
+    return None
+
+
+class Sidecar:
+    """
+    Hashs of the files of a volume, in a gzip file at its root : the cache of a
+    folder of a removable drive is built from it on any computer, whatever the mount
+    point, without reading the files again. A hash is only reused for a file with
+    the same path from the root, size and mtime as when it was hashed.
+    Layout : a JSON header, then one JSON list per file, with the values of MATCH_KEYS
+    and of the hash keys of the header.
+    """
+
+    def __init__(self, folder: str):
+        """folder : any folder of the volume"""
+        super(Sidecar, self).__init__()
+        self.root = volume_root(folder)
+        self.path = os.path.join(self.root, SIDECAR_NAME)
+        self.volume_uuid = volume_uuid(self.root)
+        self.volume_id = None
+        self._keys: List[str] = []
+        self._records: Optional[Dict[Tuple[str, str], List]] = None
+        # records of the last data folder : read once for all the chunks of a refresh
+        self._df_records: Optional[Tuple[str, pd.DataFrame]] = None
+
+    def records(self, data_folder: str) -> pd.DataFrame:
+        """Records of the files of data_folder, with their folder relative to it"""
+        if self._df_records is not None and self._df_records[0] == data_folder:
+            return self._df_records[1]
+        self._read()
+        prefix = self._volume_folder(data_folder)
+        rows = []
+        for (folder, name), values in self._records.items():
+            if prefix == "" or folder == prefix or folder.startswith(prefix + "/"):
+                relative_folder = os.path.relpath(folder or ".", prefix or ".")
+                rows.append([relative_folder.replace("/", os.sep), name] + values)
+        df_records = pd.DataFrame(rows, columns=MATCH_KEYS + self._keys)
+        self._df_records = (data_folder, df_records)
+        return df_records
+
+    def fill_hashs(self, df: pd.DataFrame, data_folder: str) -> np.ndarray:
+        """
+        Set in place the missing hashs of the records of data_folder, for the files
+        not modified since they were hashed. Return the mask of the records completed
+        """
+        keys = [key for key in HASH_KEYS if key in df.columns]
+        df_sidecar = self.records(data_folder)
+        keys = [key for key in keys if key in df_sidecar.columns]
+        if df.shape[0] == 0 or df_sidecar.shape[0] == 0 or not keys:
+            return np.zeros(df.shape[0], dtype=bool)
+
+        df_sidecar = df_sidecar.astype({key: "int64" for key in STAT_KEYS})
+        df_match = df[MATCH_KEYS].astype({key: "int64" for key in STAT_KEYS})
+        df_match = df_match.merge(df_sidecar, on=MATCH_KEYS, how="left")
+        missing = df[keys].isnull().values & df_match[keys].notnull().values
+        for i, key in enumerate(keys):
+            df.loc[missing[:, i], key] = df_match.loc[missing[:, i], key].values
+        return missing.any(axis=1)
+
+    def update(self, df: pd.DataFrame, data_folder: str) -> None:
+        """Replace the records of data_folder by the hashed records of df"""
+        self._read()
+        self._df_records = None
+        prefix = self._volume_folder(data_folder)
+        self._records = {
+            (folder, name): values
+            for (folder, name), values in self._records.items()
+            if not (prefix == "" or folder == prefix or folder.startswith(prefix + "/"))
+        }
+
+        new_keys = [key for key in HASH_KEYS if key in df.columns]
+        if new_keys != self._keys:
+            # another hash algorithm : the hashs of the other folders are kept
+            self._records = {
+                path: values[: len(STAT_KEYS)]
+                + [
+                    (
+                        values[len(STAT_KEYS) + self._keys.index(key)]
+                        if key in self._keys
+                        else None
+                    )
+                    for key in new_keys
+                ]
+                for path, values in self._records.items()
+            }
+            self._keys = new_keys
+
+        df = df[df[self._keys].notnull().any(axis=1)].dropna(subset=STAT_KEYS)
+        df = df.astype(object).where(df.notnull(), None)
+        for record in df[MATCH_KEYS + self._keys].itertuples(index=False):
+            folder, name, *values = record
+            folder = os.path.join(self._volume_folder(data_folder), folder)
+            folder = os.path.normpath(folder).replace(os.sep, "/")
+            self._records[("" if folder == "." else folder, name)] = [
+                int(value) if key in STAT_KEYS else value
+                for key, value in zip(MATCH_KEYS[2:] + self._keys, values)
+            ]
+
+    def write(self) -> None:
+        """Written next to the file then renamed : never left half written"""
+        self._read()
+        self.volume_id = self.volume_id or str(uuid.uuid4())
+        header = {
+            "format": FORMAT,
+            "version": VERSION,
+            "volume_uuid": self.volume_uuid,
+            "volume_id": self.volume_id,
+            "keys": self._keys,
+        }
+        tmp_path = self.path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf8") as f:
+            f.write(json.dumps(header) + "\n")
+            for (folder, name), values in self._records.items():
+                f.write(json.dumps([folder, name] + values) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def _read(self) -> None:
+        """
+        An empty index if the file is missing, of another version, or of another
+        volume : copied there with the files of another drive
+        """
+        if self._records is not None:
+            return
+        self._records = {}
+        try:
+            with gzip.open(self.path, "rt", encoding="utf8") as f:
+                header = json.loads(f.readline())
+                if header.get("format") != FORMAT or header.get("version") != VERSION:
+                    return
+                uuids = {header.get("volume_uuid"), self.volume_uuid}
+                if None not in uuids and len(uuids) > 1:
+                    print(f"Ignore {self.path} : index of another volume")
+                    return
+                self.volume_id = header["volume_id"]
+                self._keys = header["keys"]
+                for line in f:
+                    folder, name, *values = json.loads(line)
+                    self._records[folder, name] = values
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignore {self.path} : {e}")
+            self._records = {}
+
+    def _volume_folder(self, folder: str) -> str:
+        """Path from the root of the volume, with "/", "" for the root"""
+        relative_folder = os.path.relpath(folder, self.root).replace(os.sep, "/")
+        return "" if relative_folder == "." else relative_folder
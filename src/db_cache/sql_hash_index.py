@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import pandas as pd
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import Table
+
+# Max number of values in a "IN (...)" clause
+SIZE_IN_CLAUSE = 500
+
+
+class SqlHashIndex:
+    """
+    Same interface as HashIndex, with the lookups done by indexed queries on the
+    cache table instead of loading the whole table. A record is identified by its file_id.
+    The updates are written to the database immediately.
+    """
+
+    persistent = True
+
+    def __init__(self, engine, table: Table):
+        super(SqlHashIndex, self).__init__()
+        self.engine = engine
+        self.table = table
+
+    def __len__(self):
+        query = select([func.count()]).select_from(self.table)
+        with self.engine.connect() as connection:
+            return connection.execute(query).scalar()
+
+    def add(self, record: Dict) -> int:
+        record = {key: value for key, value in record.items() if key in self.table.c}
+        with self.engine.begin() as connection:
+            result = connection.execute(self.table.insert(), record)
+        return result.inserted_primary_key[0]
+
+    def find(self, hash_info: Dict) -> List[int]:
+        """Records matching all the keys of hash_info. hash_info must contain the size"""
+        conditions = [self.table.c[key] == value for key, value in hash_info.items()]
+        query = select([self.table.c.file_id]).where(and_(*conditions))
+        with self.engine.connect() as connection:
+            return [row[0] for row in connection.execute(query)]
+
+    def find_path(self, folder: str, name: str) -> Optional[int]:
+        query = select([self.table.c.file_id]).where(
+            and_(self.table.c.folder == folder, self.table.c.name == name)
+        )
+        with self.engine.connect() as connection:
+            return connection.execute(query).scalar()
+
+    def size_groups(self) -> Iterable[List[int]]:
+        """
+        Records of the same size, for the sizes shared by several records.
+        Read SIZE_IN_CLAUSE sizes at a time, ordered by size
+        """
+        last_size = -1
+        while True:
+            query = (
+                select([self.table.c.size])
+                .where(self.table.c.size > last_size)
+                .group_by(self.table.c.size)
+                .having(func.count() > 1)
+                .order_by(self.table.c.size)
+                .limit(SIZE_IN_CLAUSE)
+            )
+            with self.engine.connect() as connection:
+                sizes = [row[0] for row in connection.execute(query)]
+                if not sizes:
+                    return
+                query = (
+                    select([self.table.c.size, self.table.c.file_id])
+                    .where(self.table.c.size.in_(sizes))
+                    .order_by(self.table.c.size, self.table.c.file_id)
+                )
+                rows = connection.execute(query).fetchall()
+
+            for _, group in groupby(rows, key=itemgetter(0)):
+                yield [row[1] for row in group]
+            last_size = sizes[-1]
+
+    def hash_values(self, labels: Iterable[int], keys) -> List[Tuple]:
+        labels = list(labels)
+        values = {}
+        with self.engine.connect() as connection:
+            for start in range(0, len(labels), SIZE_IN_CLAUSE):
+                query = select(
+                    [self.table.c.file_id] + [self.table.c[key] for key in keys]
+                ).where(
+                    self.table.c.file_id.in_(labels[start : start + SIZE_IN_CLAUSE])
+                )
+                values.update(
+                    {row[0]: tuple(row[1:]) for row in connection.execute(query)}
+                )
+        return [values[label] for label in labels]
+
+    def missing(self, labels: Iterable[int], keys) -> List[int]:
+        """Records without a value for one of the keys"""
+        labels = list(labels)
+        missing = []
+        with self.engine.connect() as connection:
+            for start in range(0, len(labels), SIZE_IN_CLAUSE):
+                query = select([self.table.c.file_id]).where(
+                    and_(
+                        self.table.c.file_id.in_(
+                            labels[start : start + SIZE_IN_CLAUSE]
+                        ),
+                        or_(*[self.table.c[key].is_(None) for key in keys]),
+                    )
+                )
+                missing += [row[0] for row in connection.execute(query)]
+        return missing
+
+    def location(self, label: int) -> Tuple[str, str]:
+        query = select([self.table.c.folder, self.table.c.name]).where(
+            self.table.c.file_id == label
+        )
+        with self.engine.connect() as connection:
+            folder, name = connection.execute(query).first()
+        return folder, name
+
+    def record(self, label: int) -> Dict:
+        query = select([self.table]).where(self.table.c.file_id == label)
+        with self.engine.connect() as connection:
+            return dict(connection.execute(query).first())
+
+    def update(self, label: int, hash_info: Dict) -> None:
+        query = self.table.update().where(self.table.c.file_id == label)
+        with self.engine.begin() as connection:
+            connection.execute(query.values(**hash_info))
+
+    def records(self, labels: Iterable[int]) -> pd.DataFrame:
+        """Whole records of the labels, indexed by file_id"""
+        labels = list(labels)
+        df_records = []
+        for start in range(0, len(labels), SIZE_IN_CLAUSE):
+            query = select([self.table]).where(
+                self.table.c.file_id.in_(labels[start : start + SIZE_IN_CLAUSE])
+            )
+            df_records.append(pd.read_sql(query, self.engine, index_col="file_id"))
+        if not df_records:
+            return pd.DataFrame(columns=self.table.c.keys()).set_index("file_id")
+        return pd.concat(df_records).reindex(labels)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Indexed by file_id, like the labels of the other methods"""
+        return pd.read_sql_table(self.table.name, self.engine, index_col="file_id")
@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 import os
 import shutil
+from typing import Dict
 
+from src.copy_pipeline import CopyPipeline
+from src.db_cache import Folders
 from src.db_cache.db_cache_manager import DbCacheManager
+from src.io_files import dedupe
 from src.io_files import hash_functions
 from src.io_files import io_wrappers
+from src.metrics import METRICS
 
 
-def copy_recursive(folder_src: str, folder_dst: str):
+def copy_recursive(folder_src: str, folder_dst: str, action: str = "copy"):
     """
     Use the database to find each file from folder_src in folder_dst/**
     ie : file folder_src/Folder_A/File_01 won't be cp to folder_dst
         if File_01 exists in folder_dst/Folder_B/Folder_C
+    action : "copy", or "dry_run" to only display the files to copy
+    COPY_CHECK_ROOTS : other folders of the cache where the files are looked for too,
+        separated by os.pathsep, or "all" : ex the other drives of an archive.
+        The drives not mounted are trusted with COPY_TRUST_UNMOUNTED only
     """
+    if action not in ("copy", "dry_run"):
+        raise ValueError(f"Unknown action {action}, expecting copy or dry_run")
+    METRICS.reset()
     folder_src = os.path.abspath(folder_src)
     folder_dst = os.path.abspath(folder_dst)
     src_hash_gen = hash_functions.FileHashManager(folder_src)
@@ -21,52 +33,167 @@ def copy_recursive(folder_src: str, folder_dst: str):
     db_cache = DbCacheManager(dst_hash_gen)
     file_manager = io_wrappers.FileManager()
 
+    errors = CopyPipeline(
+        db_cache,
+        file_manager,
+        src_hash_gen,
+        folder_dst,
+        dry_run=action == "dry_run",
+        other_roots=_check_roots(db_cache, folder_src),
+    ).run()
+
+    db_cache.save_cache()
+    db_cache.save_sidecar()
+    db_cache.save_content_index()
+    file_manager.display_stats()
+    METRICS.display()
+    for file_path, exception in errors:
+        print(f"{file_path} : {exception}")
+
+
+def find_duplicates(folder: str, action: str = "list"):
+    """
+    Keep one file of each group of identical files in folder/**, with :
+    - the shortest folder : longest folder often have useless names like '_backup'
+    - the longest name : keep maximum information
+    action for the other files : "list" to only display them, "trash" to move them to
+    TRASH_FOLDER, "hardlink" / "reflink" to replace them with a link to the file kept
+    """
+    if action != "list" and action not in dedupe.ACTIONS:
+        raise ValueError(
+            f"Unknown action {action}, expecting list or {set(dedupe.ACTIONS)}"
+        )
+    METRICS.reset()
+    folder = os.path.abspath(folder)
+    trash_folder = os.path.abspath(
+        os.getenv("TRASH_FOLDER", os.path.join(folder, "duplicated"))
+    )
+    db_cache = DbCacheManager(hash_functions.FileHashManager(folder))
+
+    nb_duplicated = 0
+    size_duplicated = 0
     errors = []
-    for root, file_name in io_wrappers.iter_on_files(folder_src):
-        file_path = os.path.join(root, file_name)
-        relative_folder = os.path.relpath(root, folder_src)
-        relative_path = os.path.join(relative_folder, file_name)
-
-        try:
-            _copy_one_file(
-                db_cache,
-                file_manager,
-                file_path,
-                folder_dst,
-                relative_folder,
-                relative_path,
-                src_hash_gen,
+    for records in db_cache.iter_duplicated_files():
+        # the files trashed by a previous run, when TRASH_FOLDER is in folder
+        records = [
+            record
+            for record in records
+            if not _is_in_folder(
+                os.path.normpath(os.path.join(folder, record["folder"])), trash_folder
             )
-        except Exception as e:
-            errors.append((file_path, e))
+        ]
+        if len(records) < 2:
+            continue
+        records = sorted(records, key=lambda r: (len(r["folder"]), -len(r["name"])))
+        keep_path = os.path.join(folder, records[0]["folder"], records[0]["name"])
+        print("keep", keep_path)
+        for record in records[1:]:
+            duplicate_path = os.path.join(folder, record["folder"], record["name"])
+            trash_path = os.path.join(trash_folder, record["folder"], record["name"])
+            try:
+                if not _is_unchanged(keep_path, records[0]):
+                    raise OSError(f"{keep_path} modified since it was hashed")
+                if not _is_unchanged(duplicate_path, record):
+                    raise OSError("modified since it was hashed")
+                if action in ["hardlink", "reflink"]:
+                    if os.path.samefile(keep_path, duplicate_path):
+                        continue
+                    # replaced for good : the hashs could collide (ex crc32)
+                    if not io_wrappers.files_equals(keep_path, duplicate_path):
+                        raise OSError(f"same hashs as {keep_path}, other content")
+                print(f"  {action}", duplicate_path)
+                if action != "list":
+                    dedupe.ACTIONS[action](keep_path, duplicate_path, trash_path)
+                nb_duplicated += 1
+                size_duplicated += int(record["size"])
+            except OSError as e:
+                errors.append((duplicate_path, e))
 
-    file_manager.display_stats()
+    db_cache.save_sidecar()
+    db_cache.save_content_index()
+    print("Summary :")
+    print("  Duplicates :", nb_duplicated)
+    print(f"  Size       : {size_duplicated / 1024 ** 2:.1f} MiB")
+    METRICS.display()
     for file_path, exception in errors:
         print(f"{file_path} : {exception}")
 
 
-def _copy_one_file(
-    db_cache,
-    file_manager,
-    file_path,
-    folder_dst,
-    relative_folder,
-    relative_path,
-    src_hash_gen,
-):
-    if os.path.getsize(file_path) < 10 * 1024:
-        file_manager.copy_file(file_path, folder_dst, relative_path)
-        return
+def find_duplicates_across_roots(*folders: str):
+    """
+    List the files found in several of the folders, all the folders of the cache by
+    default : ex the same photos on 2 backup drives. The folders mounted are
+    refreshed, the others are compared as they were when last used
+    """
+    METRICS.reset()
+    # only used to query the cache : the current folder is not added to it
+    db_cache = DbCacheManager(hash_functions.FileHashManager(os.getcwd()))
+    folders = [os.path.abspath(folder) for folder in folders] or [
+        root.folder_name for root in db_cache.registered_roots().values()
+    ]
+    for folder in folders:
+        if os.path.isdir(folder):
+            root_cache = DbCacheManager(hash_functions.FileHashManager(folder))
+            # built or refreshed
+            _ = root_cache.index
+            root_cache.save_content_index()
+        else:
+            print(folder, "not mounted : compared with its last known content")
+
+    roots = db_cache.registered_roots(folders)
+    for folder in set(folders) - {root.folder_name for root in roots.values()}:
+        print(folder, "not in the cache, ignored")
+
+    nb_duplicated = 0
+    size_duplicated = 0
+    for records in db_cache.iter_duplicated_files_across_roots(roots):
+        records = sorted(records, key=lambda r: (r["root"], r["folder"], r["name"]))
+        print("same content :")
+        for record in records:
+            file_path = os.path.join(record["root"], record["folder"], record["name"])
+            print("  ", os.path.normpath(file_path))
+        nb_duplicated += len(records) - 1
+        size_duplicated += (len(records) - 1) * int(records[0]["size"])
+
+    print("Summary :")
+    print("  Duplicates :", nb_duplicated)
+    print(f"  Size       : {size_duplicated / 1024 ** 2:.1f} MiB")
+    METRICS.display()
 
-    folder_doublon, name_doublon = db_cache.find_file(file_path, src_hash_gen)
 
-    if name_doublon:
-        if folder_doublon != relative_folder:
-            existing_path = os.path.join(folder_doublon, name_doublon)
-            print(f"File {relative_path:<130} already in {existing_path}")
-    else:
-        file_manager.copy_file(file_path, folder_dst, relative_path)
-        # TODO : update cache
+def _check_roots(db_cache: DbCacheManager, folder_src: str) -> Dict[int, Folders]:
+    """
+    Roots of COPY_CHECK_ROOTS, without folder_dst and the roots overlapping
+    folder_src : their files would be found in themselves
+    """
+    check_roots = os.getenv("COPY_CHECK_ROOTS")
+    if not check_roots:
+        return {}
+    folders = None if check_roots == "all" else check_roots.split(os.pathsep)
+    roots = db_cache.registered_roots(folders)
+    roots.pop(db_cache.folder_id, None)
+    return {
+        folder_id: root
+        for folder_id, root in roots.items()
+        if not _is_in_folder(root.folder_name, folder_src)
+        and not _is_in_folder(folder_src, root.folder_name)
+    }
+
+
+def _is_in_folder(path: str, folder: str) -> bool:
+    return path == folder or path.startswith(os.path.join(folder, ""))
+
+
+def _is_unchanged(file_path: str, record) -> bool:
+    """Same size and modification time as when the file was hashed"""
+    stat = os.stat(file_path)
+    mtime_ns = record.get("mtime_ns")
+    if stat.st_size != int(record["size"]):
+        return False
+    # None or NaN : not known
+    if mtime_ns is None or mtime_ns != mtime_ns:
+        return True
+    return stat.st_mtime_ns == int(mtime_ns)
 
 
 # def rsync(folder_src, folder_dst):
@@ -99,31 +226,3 @@ def _copy_one_file(
 #                 file_manager.copy_file(source_path, folder_dst, relative_path)
 #
 #     file_manager.display_stats()
-
-
-# def delete_duplicated_files(folder: str):
-#     """
-#     Keep files with:
-#     - the shortest folder : longest folder often have useless names like '_backup'
-#     - the longest name : keep maximum information
-#     """
-#     db_cache_manager = DbCacheManager(folder)
-#     keys, df_duplicated = db_cache_manager.find_duplicated_files()
-#
-#     df_duplicated["name_len"] = -df_duplicated["name"].map(len)
-#     df_duplicated["folder_len"] = df_duplicated["folder"].map(len)
-#
-#     trash_folder = os.getenv("TRASH_FOLDER", os.path.join(folder, "duplicated"))
-#
-#     for files_info, sub_df in df_duplicated.groupby(keys):
-#         sub_df = sub_df.sort_values(["folder_len", "name_len"])
-#         for idx, row in sub_df.iloc[1:, :].iterrows():
-#             source_path = os.path.join(folder, row["folder"], row["name"])
-#             target_path = os.path.join(trash_folder, row["folder"], row["name"])
-#             os.makedirs(os.path.dirname(target_path), exist_ok=True)
-#
-#             print("move", source_path, target_path)
-#             shutil.move(source_path, target_path)
-#
-#     print("duplicated :")
-#     print(df_duplicated)
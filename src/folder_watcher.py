@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import os
+import time
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from src.db_cache import db_cache_manager
+from src.db_cache.db_cache_manager import DbCacheManager
+from src.db_cache.db_cache_manager import WATCH_HEARTBEAT
+from src.io_files.hash_functions import FileHashManager
+from src.io_files.inotify import IN_CREATE
+from src.io_files.inotify import IN_DELETE
+from src.io_files.inotify import IN_ISDIR
+from src.io_files.inotify import IN_MOVED_FROM
+from src.io_files.inotify import IN_MOVED_TO
+from src.io_files.inotify import IN_Q_OVERFLOW
+from src.io_files.inotify import Inotify
+
+# Seconds without event before the changes are written to the cache
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", 2))
+# Maximum seconds between a change and its write, for a continuous flow of events
+WATCH_MAX_DELAY = float(os.getenv("WATCH_MAX_DELAY", 30))
+
+
+class FolderWatcher:
+    """
+    Keep the cache table of a folder up to date, with inotify : the paths changed
+    are collected until no event came for `debounce` seconds, then written to the
+    cache in one batch (see DbCacheManager.refresh_paths)
+    """
+
+    def __init__(
+        self,
+        db_cache: DbCacheManager,
+        debounce: float = WATCH_DEBOUNCE,
+        max_delay: float = WATCH_MAX_DELAY,
+    ):
+        super(FolderWatcher, self).__init__()
+        self.db_cache = db_cache
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._inotify: Optional[Inotify] = None
+        self._pending: Set[str] = set()
+        self._first_pending = None
+        # files of the cache itself, written after each batch
+        self._ignored = [
+            db_cache_manager.SQLITE_PATH,
+            os.path.join(db_cache_manager.SNAPSHOT_FOLDER, ""),
+        ]
+
+    def run(self) -> None:
+        self.start()
+        # the changes made while the cache is refreshed are in the next batch. The
+        # heartbeat of a previous watch process is ignored
+        self.db_cache.set_watched(False)
+        self.db_cache.read_or_create_cache()
+        print("Watching", self.db_cache.data_folder)
+        try:
+            while True:
+                self.db_cache.set_watched(True)
+                self.poll(WATCH_HEARTBEAT / 2)
+        except KeyboardInterrupt:
+            self.apply()
+            self.db_cache.save_content_index()
+        finally:
+            self.db_cache.set_watched(False)
+            self.close()
+
+    def start(self) -> None:
+        self._inotify = Inotify()
+        self._add_watches(self.db_cache.data_folder)
+
+    def poll(self, timeout: float = None) -> Tuple[int, int]:
+        """
+        Read the events for up to timeout seconds, None to wait for the first one.
+        Return the number of files written and removed, once the events stopped
+        """
+        if self._pending:
+            max_wait = self._first_pending + self.max_delay - time.monotonic()
+            timeout = max(0.0, min(self.debounce, max_wait))
+        events = self._inotify.read_events(timeout)
+        for path, mask in events:
+            self._on_event(path, mask)
+
+        if not self._pending:
+            return 0, 0
+        if events and time.monotonic() - self._first_pending < self.max_delay:
+            return 0, 0
+        return self.apply()
+
+    def apply(self) -> Tuple[int, int]:
+        """Write the pending changes to the cache"""
+        paths, self._pending = _outermost(self._pending), set()
+        self._first_pending = None
+        nb_written, nb_removed = self.db_cache.refresh_paths(paths)
+        if nb_written or nb_removed:
+            print(f"  {nb_written} files updated, {nb_removed} removed")
+        return nb_written, nb_removed
+
+    def close(self) -> None:
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _on_event(self, path: str, mask: int) -> None:
+        if mask & IN_Q_OVERFLOW:
+            # events lost : refresh everything
+            path = self.db_cache.data_folder
+        elif any(path.startswith(ignored) for ignored in self._ignored):
+            return
+        elif mask & IN_ISDIR and mask & (IN_MOVED_FROM | IN_DELETE):
+            self._inotify.remove_watches(path)
+        elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self._add_watches(path)
+
+        if not self._pending:
+            self._first_pending = time.monotonic()
+        self._pending.add(path)
+
+    def _add_watches(self, folder: str) -> None:
+        for root, _, _ in os.walk(folder):
+            try:
+                self._inotify.add_watch(root)
+            except FileNotFoundError:
+                # removed since it was listed
+                pass
+
+
+def _outermost(paths: Set[str]) -> List[str]:
+    """The paths not inside another path of the set : refreshed with their folder"""
+    return [
+        path
+        for path in sorted(paths)
+        if not any(parent in paths for parent in _parents(path))
+    ]
+
+
+def _parents(path: str) -> List[str]:
+    parents = []
+    parent = os.path.dirname(path)
+    while parent and parent != path:
+        parents.append(parent)
+        path, parent = parent, os.path.dirname(parent)
+    return parents
+
+
+def watch(folder: str):
+    """
+    Keep the cache of the folder up to date until interrupted, for the next
+    copy_recursive / find_duplicates to start without refreshing the whole folder
+    """
+    folder = os.path.abspath(folder)
+    db_cache = DbCacheManager(FileHashManager(folder))
+    FolderWatcher(db_cache).run()
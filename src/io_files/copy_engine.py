@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import errno
+import os
+import shutil
+
+from src.metrics import METRICS
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# ioctl cloning the extents of a file (btrfs, XFS) : no data is copied
+FICLONE = 0x40049409
+SIZE_COPY_CHUNK = 64 * 1024 * 1024
+
+
+def copy_file_data(source_path: str, target_path: str) -> None:
+    """
+    Like shutil.copy2, with the fastest copy available on the system :
+    reflink when source and target are on the same filesystem, then
+    copy_file_range / sendfile in the kernel, then a copy in user space.
+    """
+    with METRICS.measure("copy") as measure:
+        with open(source_path, "rb") as source, open(target_path, "wb") as target:
+            source_fd, target_fd = source.fileno(), target.fileno()
+            size = os.fstat(source_fd).st_size
+            if not _clone(source_fd, target_fd):
+                _preallocate(target_fd, size)
+                if not _copy_in_kernel(source_fd, target_fd, size):
+                    shutil.copyfileobj(source, target, SIZE_COPY_CHUNK)
+                    target.flush()
+                # the source shrank during the copy : no preallocated zeros left
+                size = os.lseek(target_fd, 0, os.SEEK_CUR)
+                os.ftruncate(target_fd, size)
+        shutil.copystat(source_path, target_path)
+        measure.nb_bytes = size
+
+
+def reflink_file(source_path: str, target_path: str) -> None:
+    """Clone source_path to a new file sharing its extents. OSError if not supported"""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflink not supported", target_path)
+    with open(source_path, "rb") as source, open(target_path, "xb") as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            os.remove(target_path)
+            raise
+
+
+def _clone(source_fd: int, target_fd: int) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+        return True
+    except OSError:
+        # other filesystem / not supported
+        return False
+
+
+def _preallocate(target_fd: int, size: int) -> None:
+    if size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(target_fd, 0, size)
+        except OSError:
+            pass
+
+
+def _copy_in_kernel(source_fd: int, target_fd: int, size: int) -> bool:
+    """False if nothing could be copied : the caller copies the file in user space"""
+    for copy_func in [_copy_file_range, _sendfile]:
+        try:
+            copy_func(source_fd, target_fd, size)
+            return True
+        except (AttributeError, OSError):
+            # function not available on the system, or not supported for these files
+            os.lseek(source_fd, 0, os.SEEK_SET)
+            os.lseek(target_fd, 0, os.SEEK_SET)
+    return False
+
+
+def _copy_file_range(source_fd: int, target_fd: int, size: int) -> None:
+    offset = 0
+    while offset < size:
+        nb_copied = os.copy_file_range(source_fd, target_fd, SIZE_COPY_CHUNK)
+        if nb_copied == 0:
+            break
+        offset += nb_copied
+
+
+def _sendfile(source_fd: int, target_fd: int, size: int) -> None:
+    offset = 0
+    while offset < size:
+        nb_copied = os.sendfile(target_fd, source_fd, offset, SIZE_COPY_CHUNK)
+        if nb_copied == 0:
+            break
+        offset += nb_copied
+    os.lseek(target_fd, offset, os.SEEK_SET)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import os
+import shutil
+
+from src.io_files.copy_engine import reflink_file
+
+
+def move_to_trash(keep_path: str, duplicate_path: str, trash_path: str) -> None:
+    os.makedirs(os.path.dirname(trash_path), exist_ok=True)
+    shutil.move(duplicate_path, trash_path)
+
+
+def replace_with_hardlink(keep_path: str, duplicate_path: str, trash_path: str) -> None:
+    """The 2 paths share the same inode : a change in one file changes the other"""
+    _replace(duplicate_path, lambda tmp_path: os.link(keep_path, tmp_path))
+
+
+def replace_with_reflink(keep_path: str, duplicate_path: str, trash_path: str) -> None:
+    """
+    The 2 files share their extents on disk until one is modified (btrfs, XFS).
+    The duplicate keeps its timestamps and permissions
+    """
+
+    def clone(tmp_path):
+        reflink_file(keep_path, tmp_path)
+        shutil.copystat(duplicate_path, tmp_path)
+
+    _replace(duplicate_path, clone)
+
+
+def _replace(duplicate_path: str, create_file) -> None:
+    """Create the new file next to the duplicate, then rename it over the duplicate"""
+    folder, name = os.path.split(duplicate_path)
+    tmp_path = os.path.join(folder, f".{name}.dedupe")
+    try:
+        create_file(tmp_path)
+        os.replace(tmp_path, duplicate_path)
+    except OSError:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Action of find_duplicates -> function(keep_path, duplicate_path, trash_path)
+ACTIONS = {
+    "trash": move_to_trash,
+    "hardlink": replace_with_hardlink,
+    "reflink": replace_with_reflink,
+}
@@ -1,50 +1,278 @@
 #!/usr/bin/env python3
 import hashlib
 import os
+import zlib
+from collections import defaultdict
+from functools import partial
 from typing import Dict
 from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
 
 from src.io_files import io_wrappers
+from src.io_files.hash_workers import HashWorkers
+from src.metrics import METRICS
 
 SIZE_READ = 1024 * 1024
+SIZE_SAMPLE = 64 * 1024
 
-HASH_FUNCTIONS = {"md5": hashlib.md5, "sha256": hashlib.sha256}
+
+class Crc32:
+    """Fast non cryptographic checksum, with the hashlib interface"""
+
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data) -> None:
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self) -> str:
+        return format(self._value, "08x")
+
+
+# Without the variable length digests (shake_128, shake_256) : no hexdigest()
+ALGORITHMS = {
+    name: partial(hashlib.new, name)
+    for name in hashlib.algorithms_guaranteed
+    if hashlib.new(name).digest_size > 0
+}
+ALGORITHMS["crc32"] = Crc32
+try:
+    import xxhash
+
+    ALGORITHMS.update(xxh64=xxhash.xxh64, xxh3_64=xxhash.xxh3_64)
+except ImportError:
+    pass
+
+# Hash functions compared once the partial hashs match. "+" : computed together,
+# ">" : the next ones are only computed when the previous ones match.
+# ex : "blake2b", or "crc32>sha256" for a fast checksum confirmed on collision
+HASH_ALGORITHM = os.getenv("HASH_ALGORITHM", "md5+sha256")
+HASH_FUNCTIONS = {
+    name: ALGORITHMS.get(name)
+    for stage in HASH_ALGORITHM.split(">")
+    for name in stage.split("+")
+}
+if None in HASH_FUNCTIONS.values():
+    raise ValueError(
+        f"Unknown hash function in HASH_ALGORITHM={HASH_ALGORITHM}, "
+        f"expecting one of {sorted(ALGORITHMS)}"
+    )
+PARTIAL_HASH = "partial"
+# Stat values stored in the cache, to detect the files modified since they were hashed
+STAT_KEYS = ["size", "mtime_ns", "inode"]
 
 
 class FileHashManager:
-    def __init__(self, ref_folder):
+    def __init__(self, ref_folder, workers: HashWorkers = None):
         super(FileHashManager, self).__init__()
         self.data_folder = ref_folder
+        self.workers = workers or HashWorkers()
+        # hashs of the files with several hard links, by link key (see FileEntry)
+        self._links: Dict[Tuple, Dict] = {}
 
     def generate_file_records(self) -> Iterable[Dict]:
-        for root, file_name in io_wrappers.iter_on_files(self.data_folder):
-            try:
-                yield self.create_record(root, file_name)
-            except FileNotFoundError as e:
-                print(e)
-                print(root, file_name)
+        for entry in io_wrappers.iter_file_entries(self.data_folder):
+            yield self.create_record_from_entry(entry)
 
     def create_record(self, folder: str, file_name: str) -> Dict:
+        """
+        Only the stat values are read here : the hashes are computed on demand,
+        when another file has the same size (see HASH_STAGES)
+        """
         file_path = os.path.join(folder, file_name)
-        hash_info = self.get_hashs_for_file(file_path)
         return dict(
             {"name": file_name, "folder": os.path.relpath(folder, self.data_folder)},
-            **hash_info
+            **get_stat_for_file(file_path),
+            **{key: None for key in HASH_KEYS},
+        )
+
+    def create_record_from_entry(self, entry: io_wrappers.FileEntry) -> Dict:
+        return dict(
+            {
+                "name": entry.name,
+                "folder": os.path.relpath(entry.root, self.data_folder),
+            },
+            size=entry.size,
+            mtime_ns=entry.mtime_ns,
+            inode=entry.inode,
+            **{key: None for key in HASH_KEYS},
         )
 
     @classmethod
     def get_hashs_for_file(cls, file_path):
         return get_hashs_for_file(file_path)
 
+    @classmethod
+    def get_hashs_for_stage(cls, file_path: str, keys: Tuple[str, ...]) -> Dict:
+        return HASH_STAGES[keys](file_path)
+
+    def hash_file(self, file_path: str, keys: Tuple[str, ...]) -> Dict:
+        """get_hashs_for_stage, read once for all the hard links of the file"""
+        link_key = get_link_key(file_path)
+        hash_info = self.known_hashs(link_key, keys)
+        if hash_info is None:
+            hash_info = self.get_hashs_for_stage(file_path, keys)
+            self.remember(link_key, hash_info)
+        return hash_info
+
+    def hash_files(
+        self, file_paths: Iterable[str], keys: Tuple[str, ...]
+    ) -> Iterable[Tuple[str, Dict]]:
+        """
+        Hash the stage `keys` of the files in parallel, in no particular order.
+        The hard links of a file are read once
+        """
+        links: Dict[Tuple, List[str]] = defaultdict(list)
+        to_hash: Dict[str, Optional[Tuple]] = {}
+        for file_path in file_paths:
+            link_key = get_link_key(file_path)
+            hash_info = self.known_hashs(link_key, keys)
+            if hash_info is not None:
+                yield file_path, hash_info
+            elif link_key is None:
+                to_hash[file_path] = None
+            else:
+                if link_key not in links:
+                    to_hash[file_path] = link_key
+                links[link_key].append(file_path)
+
+        for file_path, hash_info in self.workers.imap_unordered(
+            HASH_STAGES[keys], list(to_hash)
+        ):
+            link_key = to_hash[file_path]
+            self.remember(link_key, hash_info)
+            for link_path in links.get(link_key, [file_path]):
+                yield link_path, hash_info
+
+    def known_hashs(self, link_key: Optional[Tuple], keys) -> Optional[Dict]:
+        """Hashs of the stage `keys` computed for another link of the file"""
+        hash_info = self._links.get(link_key, {})
+        if link_key is None or not all(key in hash_info for key in keys):
+            return None
+        return dict(hash_info)
+
+    def remember(self, link_key: Optional[Tuple], hash_info: Dict) -> None:
+        if link_key is not None:
+            self._links.setdefault(link_key, {"size": link_key[2]}).update(hash_info)
 
-def get_hashs_for_file(file_path):
-    hashs = {func_name: func() for func_name, func in HASH_FUNCTIONS.items()}
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(SIZE_READ), b""):
-            for hash_name in hashs.keys():
-                hashs[hash_name].update(chunk)
+
+def get_link_key(file_path: str) -> Optional[Tuple[int, int, int, int]]:
+    """Key of the hard links of a file, see FileEntry.link_key"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    if stat.st_nlink <= 1:
+        return None
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def get_stat_for_file(file_path):
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino}
+
+
+def get_size_for_file(file_path):
+    return {"size": os.path.getsize(file_path)}
+
+
+def get_partial_hash_for_file(file_path):
+    """
+    Hash of the head, middle and tail of the file.
+    Small files are read entirely.
+    """
+    partial_hash = hashlib.md5()
+    with METRICS.measure("hash") as measure, open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= 3 * SIZE_SAMPLE:
+            partial_hash.update(f.read())
+        else:
+            for offset in (0, (size - SIZE_SAMPLE) // 2, size - SIZE_SAMPLE):
+                f.seek(offset)
+                partial_hash.update(f.read(SIZE_SAMPLE))
+        measure.nb_bytes = min(size, 3 * SIZE_SAMPLE)
+
+    return {PARTIAL_HASH: partial_hash.hexdigest()}
+
+
+def get_hashs_for_small_file(file_path: str, size: int) -> Dict:
+    """
+    All the hash stages of a file, read at once : in a loop until the end of the file,
+    for the filesystems returning short reads (FUSE, MTP...).
+    For the files of less than 3 * SIZE_SAMPLE bytes : their partial hash is the hash
+    of the whole file (see get_partial_hash_for_file)
+    """
+    with METRICS.measure("hash") as measure:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            chunks = []
+            nb_missing = size + 1
+            while nb_missing > 0:
+                chunk = os.read(fd, nb_missing)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                nb_missing -= len(chunk)
+        finally:
+            os.close(fd)
+        data = b"".join(chunks)
+        if len(data) <= 3 * SIZE_SAMPLE:
+            measure.nb_bytes = len(data)
+            hash_info = {
+                PARTIAL_HASH: hashlib.md5(data).hexdigest(),
+                "size": len(data),
+            }
+            for hash_name, hash_function in HASH_FUNCTIONS.items():
+                hash_func = hash_function()
+                hash_func.update(data)
+                hash_info[hash_name] = hash_func.hexdigest()
+            return hash_info
+
+    # the file grew since it was scanned
+    return dict(get_partial_hash_for_file(file_path), **get_hashs_for_file(file_path))
+
+
+def get_hashs_for_small_files(
+    files: List[Tuple[str, int]],
+) -> List[Union[Dict, OSError]]:
+    """A batch of (file_path, size), hashed in one task. The OSError are returned"""
+    results = []
+    for file_path, size in files:
+        try:
+            results.append(get_hashs_for_small_file(file_path, size))
+        except OSError as e:
+            results.append(e)
+    return results
+
+
+def get_hashs_for_file(file_path, hash_names: Iterable[str] = None):
+    hash_names = HASH_FUNCTIONS.keys() if hash_names is None else hash_names
+    hashs = {hash_name: HASH_FUNCTIONS[hash_name]() for hash_name in hash_names}
+    size = 0
+    with METRICS.measure("hash") as measure:
+        for chunk in io_wrappers.iter_file_chunks(file_path, SIZE_READ):
+            size += len(chunk)
+            for hash_func in hashs.values():
+                hash_func.update(chunk)
+        measure.nb_bytes = size
 
     return dict(
         {hash_name: hash_func.hexdigest() for hash_name, hash_func in hashs.items()},
-        size=os.path.getsize(file_path),
+        size=size,
     )
+
+
+# Keys compared to find identical files, from the cheapest to the most expensive to compute.
+# A stage is only computed for files matching all the previous stages.
+HASH_STAGES = {
+    ("size",): get_size_for_file,
+    (PARTIAL_HASH,): get_partial_hash_for_file,
+}
+for _stage in HASH_ALGORITHM.split(">"):
+    _hash_names = tuple(_stage.split("+"))
+    HASH_STAGES[_hash_names] = partial(get_hashs_for_file, hash_names=_hash_names)
+HASH_KEYS = [key for keys in list(HASH_STAGES)[1:] for key in keys]
+RECORD_KEYS = ["name", "folder"] + STAT_KEYS + HASH_KEYS
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import os
+from collections import Counter
+from collections.abc import Sized
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Tuple
+
+NB_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))
+# Readers per spinning / removable disk : parallel reads make the disk seek
+NB_WORKERS_SLOW_DEVICE = int(os.getenv("HASH_WORKERS_SLOW_DEVICE", 2))
+# "thread" : hashlib releases the GIL on large buffers. "process" : for slow pure python hashes
+EXECUTOR = os.getenv("HASH_EXECUTOR", "thread")
+
+
+def is_slow_device(device: int) -> bool:
+    """Spinning or removable disk, read from /sys on Linux. False if unknown"""
+    sys_folder = f"/sys/dev/block/{os.major(device)}:{os.minor(device)}"
+    # a partition has its queue information in the parent folder
+    for folder in [sys_folder, os.path.join(sys_folder, "..")]:
+        for flag in ["queue/rotational", "removable"]:
+            try:
+                with open(os.path.join(folder, flag)) as f:
+                    if f.read().strip() == "1":
+                        return True
+            except OSError:
+                pass
+    return False
+
+
+class HashWorkers:
+    """
+    Pool of workers hashing files, with a limited number of files read at the same time
+    on each device. Results are yielded as soon as they are ready, so only a bounded
+    number of files are in progress.
+    """
+
+    def __init__(self, nb_workers: int = NB_WORKERS, executor: str = EXECUTOR):
+        super(HashWorkers, self).__init__()
+        self.nb_workers = max(1, nb_workers)
+        self.executor_type = executor
+        self._executor = None
+        self._devices: Dict[str, int] = {}
+        self._device_limits: Dict[int, int] = {}
+
+    def imap_unordered(
+        self, func: Callable[[str], Dict], file_paths: Iterable[str]
+    ) -> Iterable[Tuple[str, Dict]]:
+        """Yield (file_path, func(file_path)). Files who can't be read are skipped"""
+        if self.nb_workers == 1 or (
+            isinstance(file_paths, Sized) and len(file_paths) <= 1
+        ):
+            for file_path in file_paths:
+                yield from self._run_inline(func, file_path)
+            return
+
+        in_flight = {}
+        per_device = Counter()
+        for file_path in file_paths:
+            device = self._device(file_path)
+            while in_flight and (
+                len(in_flight) >= 2 * self.nb_workers
+                or per_device[device] >= self._device_limit(device)
+            ):
+                yield from self._wait(in_flight, per_device)
+
+            future = self.executor.submit(func, file_path)
+            in_flight[future] = (file_path, device)
+            per_device[device] += 1
+
+        while in_flight:
+            yield from self._wait(in_flight, per_device)
+
+    def reader_limit(self, file_path: str) -> int:
+        """Number of files read at the same time on the device of file_path"""
+        return self._device_limit(self._device(file_path))
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @classmethod
+    def _run_inline(cls, func, file_path):
+        try:
+            yield file_path, func(file_path)
+        except OSError as e:
+            print(e)
+
+    @classmethod
+    def _wait(cls, in_flight: Dict, per_device: Counter):
+        done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+        for future in done:
+            file_path, device = in_flight.pop(future)
+            per_device[device] -= 1
+            try:
+                yield file_path, future.result()
+            except OSError as e:
+                print(e)
+
+    def _device(self, file_path: str) -> int:
+        folder = os.path.dirname(file_path)
+        if folder not in self._devices:
+            try:
+                self._devices[folder] = os.stat(folder).st_dev
+            except OSError:
+                self._devices[folder] = -1
+        return self._devices[folder]
+
+    def _device_limit(self, device: int) -> int:
+        if device not in self._device_limits:
+            slow = device >= 0 and is_slow_device(device)
+            limit = NB_WORKERS_SLOW_DEVICE if slow else self.nb_workers
+            self._device_limits[device] = max(1, limit)
+        return self._device_limits[device]
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.executor_type == "process":
+                self._executor = ProcessPoolExecutor(self.nb_workers)
+            else:
+                self._executor = ThreadPoolExecutor(self.nb_workers)
+        return self._executor
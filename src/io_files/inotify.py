@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+# Events of linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+# Files written, touched, created, removed or renamed in a folder
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+# struct inotify_event : wd, mask, cookie, len, then the name
+EVENT_FORMAT = "iIII"
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+SIZE_READ = 64 * 1024
+
+
+class Inotify:
+    """
+    Linux inotify with ctypes : one watch per folder, not recursive.
+    OSError on the other systems
+    """
+
+    def __init__(self):
+        super(Inotify, self).__init__()
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._check(self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK))
+        self._paths: Dict[int, str] = {}
+        self._watches: Dict[str, int] = {}
+
+    def add_watch(self, folder: str) -> None:
+        """The same watch is returned for a folder moved since it was watched"""
+        wd = self._check(
+            self._libc.inotify_add_watch(
+                self.fd, os.fsencode(folder), WATCH_MASK | IN_ONLYDIR | IN_DONT_FOLLOW
+            ),
+            folder,
+        )
+        self._watches.pop(self._paths.get(wd), None)
+        self._paths[wd] = folder
+        self._watches[folder] = wd
+
+    def remove_watches(self, folder: str) -> None:
+        """Stop watching the folder and its sub folders"""
+        for path in list(self._watches):
+            if path == folder or path.startswith(folder + os.sep):
+                wd = self._watches.pop(path)
+                self._paths.pop(wd, None)
+                self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: Optional[float] = None) -> List[Tuple[str, int]]:
+        """
+        (path, mask) of the events received within timeout seconds, None to wait for
+        the first event. Path "" for IN_Q_OVERFLOW : events were lost
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        data = b""
+        try:
+            while True:
+                data += os.read(self.fd, SIZE_READ)
+        except BlockingIOError:
+            pass
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from(EVENT_FORMAT, data, offset)
+            name = data[offset + EVENT_SIZE : offset + EVENT_SIZE + length]
+            offset += EVENT_SIZE + length
+            if mask & IN_Q_OVERFLOW:
+                events.append(("", mask))
+            elif mask & IN_IGNORED:
+                # folder removed, or watch removed
+                self._watches.pop(self._paths.pop(wd, None), None)
+            elif wd in self._paths:
+                name = os.fsdecode(name.rstrip(b"\0"))
+                events.append((os.path.join(self._paths[wd], name), mask))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def _check(self, result: int, path: str = None) -> int:
+        if result < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                print("Too many folders : increase fs.inotify.max_user_watches")
+            raise OSError(error, os.strerror(error), path)
+        return result
@@ -1,21 +1,142 @@
 #!/usr/bin/env python3
 import filecmp
 import os
-import shutil
+import queue
+import struct
+import threading
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from datetime import datetime
+from stat import S_ISREG
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
 
+from src.io_files.copy_engine import copy_file_data
+from src.metrics import METRICS
 
-def is_hidden_system_file(folder: str, basename: str) -> bool:
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# Number of folders listed in parallel. Useful for deep trees on network / FUSE mounts
+NB_SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", 1))
+# Number of files copied in parallel, and size from which a file is copied in the big files lane
+NB_COPY_WORKERS = int(os.getenv("COPY_WORKERS", 1))
+SIZE_BIG_FILE = 64 * 1024 * 1024
+# Index written at the root of a volume by the cache (see db_cache.sidecar)
+SIDECAR_NAME = ".find_duplicated_files.idx"
+
+# struct fiemap : fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FORMAT = "=QQIIII"
+FIEMAP_EXTENT_SIZE = 56
+
+_buffers = threading.local()
+_END = object()  # last item of iter_in_background
+
+
+class FileEntry(NamedTuple):
+    """A file found by the scanner, with the stat values read once"""
+
+    root: str
+    name: str
+    size: int
+    mtime_ns: int
+    inode: int
+    device: int
+    nlink: int = 1
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.root, self.name)
+
+    @property
+    def link_key(self) -> Optional[Tuple[int, int, int, int]]:
+        """Same key for all the hard links of a file, None without other link"""
+        if self.nlink <= 1:
+            return None
+        return self.device, self.inode, self.size, self.mtime_ns
+
+
+def is_hidden_system_file(folder: str, basename: str, size: int = None) -> bool:
     if basename.lower() in [".ds_store", "thumbs.db", "desktop.ini", ".picasa.ini"]:
         return True
+    if basename.startswith(SIDECAR_NAME):  # the index and its temporary file
+        return True
 
     if basename.startswith("._") or basename.startswith("~$"):
-        file_path = os.path.join(folder, basename)
-        return os.path.getsize(file_path) <= 6 * 1024
+        if size is None:
+            size = os.path.getsize(os.path.join(folder, basename))
+        return size <= 6 * 1024
 
     return False
 
 
+def iter_file_chunks(file_path: str, size_read: int) -> Iterable[memoryview]:
+    """
+    Read the file sequentially in a buffer reused for all the files read by the thread :
+    a chunk is only valid until the next one is read.
+    The pages of big files are dropped from the page cache once read, to keep the cache
+    of the other processes.
+    """
+    with open(file_path, "rb", buffering=0) as f:
+        fd = f.fileno()
+        stat = os.fstat(fd)
+        # multiple of the filesystem block size
+        block_size = stat.st_blksize or 4096
+        size_read = max(block_size, size_read // block_size * block_size)
+
+        _fadvise(fd, "POSIX_FADV_SEQUENTIAL")
+        view = memoryview(_get_buffer(size_read))
+        for nb_read in iter(lambda: f.readinto(view), 0):
+            yield view[:nb_read]
+
+        if stat.st_size > size_read:
+            _fadvise(fd, "POSIX_FADV_DONTNEED")
+
+
+def _get_buffer(size: int) -> bytearray:
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) != size:
+        buffer = _buffers.buffer = bytearray(size)
+    return buffer
+
+
+def _fadvise(fd: int, advice: str) -> None:
+    """No-op where posix_fadvise is not available"""
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
+def get_physical_offset(file_path: str) -> Optional[int]:
+    """
+    Position on the disk of the first extent of the file, with the FIEMAP ioctl.
+    None if the filesystem doesn't support it, or for an empty file
+    """
+    if fcntl is None:
+        return None
+    request = struct.pack(FIEMAP_FORMAT, 0, 2**64 - 1, 0, 0, 1, 0)
+    request += b"\0" * FIEMAP_EXTENT_SIZE
+    try:
+        with open(file_path, "rb") as f:
+            result = fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    nb_extents = struct.unpack_from(FIEMAP_FORMAT, result)[3]
+    if nb_extents == 0:
+        return None
+    # fiemap_extent : fe_logical, fe_physical, ...
+    return struct.unpack_from("=QQ", result, struct.calcsize(FIEMAP_FORMAT))[1]
+
+
 def files_equals(source_path, target_path):
     return filecmp.cmp(source_path, target_path, shallow=False)
 
@@ -26,31 +147,164 @@ def remove_folder(root: str):
 
 
 def iter_on_files(folder: str):
-    for root, dirs, files in os.walk(folder, topdown=False):
-        for file_name in files:
-            if not is_hidden_system_file(root, file_name):
-                yield root, file_name
+    for entry in iter_file_entries(folder):
+        yield entry.root, entry.name
+
+
+def get_file_entry(file_path: str) -> Optional[FileEntry]:
+    """Like the scanner : None if the path is not a file, or is a hidden system file"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    folder, name = os.path.split(file_path)
+    if not S_ISREG(stat.st_mode) or is_hidden_system_file(folder, name, stat.st_size):
+        return None
+    return FileEntry(
+        folder,
+        name,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ino,
+        stat.st_dev,
+        stat.st_nlink,
+    )
+
+
+def iter_file_entries(folder: str, nb_workers: int = None) -> Iterable[FileEntry]:
+    """
+    Files of the folder and its sub folders, with one stat per file.
+    The files of a folder are yielded together. With one worker, the sub folders
+    are yielded before their parent folder, like os.walk(topdown=False).
+    """
+    nb_workers = NB_SCAN_WORKERS if nb_workers is None else nb_workers
+    if nb_workers > 1:
+        return _scan_parallel(folder, nb_workers)
+    return _scan_bottom_up(folder)
+
+
+def _scan_bottom_up(folder: str) -> Iterable[FileEntry]:
+    files, sub_folders = _scan_folder(folder)
+    for sub_folder in sub_folders:
+        yield from _scan_bottom_up(sub_folder)
+    yield from files
+
+
+def _scan_parallel(folder: str, nb_workers: int) -> Iterable[FileEntry]:
+    with ThreadPoolExecutor(nb_workers) as executor:
+        pending = {executor.submit(_scan_folder, folder)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, sub_folders = future.result()
+                pending |= {executor.submit(_scan_folder, sub) for sub in sub_folders}
+                yield from files
+
+
+def iter_in_background(iterable: Iterable, size_queue: int) -> Iterable:
+    """
+    Consume the iterable in a thread, ahead of the caller, with at most size_queue
+    items waiting. The exceptions of the iterable are raised in the caller.
+    """
+    items = queue.Queue(size_queue)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except Exception as e:
+            items.put((None, e))
+        items.put((_END, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, exception = items.get()
+        if exception is not None:
+            raise exception
+        if item is _END:
+            return
+        yield item
+
+
+def _scan_folder(folder: str) -> Tuple[List[FileEntry], List[str]]:
+    """Measured in the "scan" stage : one call per folder, the bytes of its files"""
+    with METRICS.measure("scan") as measure:
+        files, sub_folders = _list_folder(folder)
+        measure.nb_bytes = sum(entry.size for entry in files)
+    return files, sub_folders
+
+
+def _list_folder(folder: str) -> Tuple[List[FileEntry], List[str]]:
+    files, sub_folders = [], []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_folders.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        if not is_hidden_system_file(folder, entry.name, stat.st_size):
+                            files.append(
+                                FileEntry(
+                                    folder,
+                                    entry.name,
+                                    stat.st_size,
+                                    stat.st_mtime_ns,
+                                    stat.st_ino,
+                                    stat.st_dev,
+                                    stat.st_nlink,
+                                )
+                            )
+                except OSError as e:
+                    print(e)
+    except OSError as e:
+        print(e)
+
+    return files, sub_folders
 
 
 class FileManager:
-    def __init__(self):
+    """
+    Copy the files in a pool of workers, with a separate lane for the big files so
+    the small ones don't wait behind them. With one worker, the files are copied
+    immediately. The target names are chosen in the calling thread.
+    """
+
+    def __init__(self, nb_workers: int = None):
         super(FileManager, self).__init__()
         self._copied = 0
         self._duplicated = []
+        self.nb_workers = NB_COPY_WORKERS if nb_workers is None else nb_workers
+        self.errors: List[Tuple[str, Exception]] = []
+        # appended by the copy threads
+        self._completed: queue.Queue = queue.Queue()
+        self._pending: Dict[str, Future] = {}
+        self._lanes: Dict[bool, Tuple[ThreadPoolExecutor, threading.Semaphore]] = {}
 
-    def copy_file(self, source_path, folder_dst, relative_path):
+    def copy_file(
+        self,
+        source_path,
+        folder_dst,
+        relative_path,
+        size: int = None,
+        compare: Callable[[str], Optional[bool]] = None,
+    ) -> Optional[str]:
+        """
+        Return the path of the new file, None if it was not copied.
+        compare : compare the source with an existing target using known hashs,
+            None when they are unknown. The files are then compared byte by byte.
+        """
         target_path = os.path.join(folder_dst, relative_path)
-        if os.path.exists(target_path) and files_equals(source_path, target_path):
-            return
-
         date = None
         suffix = None
         name, ext = os.path.splitext(target_path)
 
         while os.path.exists(target_path):
-            if files_equals(source_path, target_path):
-                self._duplicated.append((source_path, target_path))
-                return
+            if self._files_equals(source_path, target_path, compare):
+                if date is not None:
+                    self._duplicated.append((source_path, target_path))
+                return None
 
             if date is None:
                 date = datetime.now().strftime("%Y%m%d")
@@ -65,7 +319,71 @@ class FileManager:
         print(f"cp {relative_path:<130} -> {folder_dst}")
         self._copied += 1
         os.makedirs(os.path.dirname(target_path), exist_ok=True)
-        shutil.copy2(source_path, target_path)
+        if self.nb_workers <= 1:
+            copy_file_data(source_path, target_path)
+            self._completed.put(target_path)
+            return target_path
+
+        # reserve the name, for the next files copied to the same folder
+        open(target_path, "xb").close()
+        size = os.path.getsize(source_path) if size is None else size
+        executor, semaphore = self._lane(size >= SIZE_BIG_FILE)
+        semaphore.acquire()  # wait when too many files are queued
+        future = executor.submit(self._copy, source_path, target_path)
+        future.add_done_callback(lambda _: semaphore.release())
+        self._pending[target_path] = future
+        return target_path
+
+    def pop_copied(self) -> List[str]:
+        """Files completely copied since the last call"""
+        completed = []
+        while True:
+            try:
+                completed.append(self._completed.get_nowait())
+            except queue.Empty:
+                break
+        for target_path in completed:
+            self._pending.pop(target_path, None)
+        return completed
+
+    def wait(self) -> None:
+        """Wait for the end of all the copies"""
+        for executor, _ in self._lanes.values():
+            executor.shutdown(wait=True)
+        self._lanes = {}
+
+    def _copy(self, source_path: str, target_path: str) -> None:
+        try:
+            copy_file_data(source_path, target_path)
+            self._completed.put(target_path)
+        except Exception as e:
+            self.errors.append((source_path, e))
+            if os.path.exists(target_path):
+                os.remove(target_path)
+
+    def _files_equals(
+        self,
+        source_path: str,
+        target_path: str,
+        compare: Callable[[str], Optional[bool]] = None,
+    ) -> bool:
+        pending = self._pending.get(target_path)
+        if pending is not None:
+            pending.result()
+        elif compare is not None:
+            equals = compare(target_path)
+            if equals is not None:
+                return equals
+        return files_equals(source_path, target_path)
+
+    def _lane(self, big_files: bool) -> Tuple[ThreadPoolExecutor, threading.Semaphore]:
+        if big_files not in self._lanes:
+            nb_workers = max(1, self.nb_workers // 4) if big_files else self.nb_workers
+            self._lanes[big_files] = (
+                ThreadPoolExecutor(nb_workers),
+                threading.Semaphore(2 * nb_workers),
+            )
+        return self._lanes[big_files]
 
     def display_stats(self):
         print("Summary :")
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+# Seconds between 2 progress lines, 0 to disable them
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 10))
+# Upper bounds of the latency histogram, in seconds
+LATENCY_BUCKETS = [0.0001, 0.001, 0.01, 0.1, 1, 10]
+LATENCY_LABELS = ["0.1ms", "1ms", "10ms", "100ms", "1s", "10s", "inf"]
+
+
+class Measure:
+    """
+    Bytes processed by a measured call, set by the caller, and the seconds of the
+    call spent in the blocks counted in other stages (see Metrics.paused)
+    """
+
+    def __init__(self):
+        super(Measure, self).__init__()
+        self.nb_bytes = 0
+        self.paused = 0.0
+
+
+class StageStats:
+    """
+    Calls of one stage. The busy time is the sum of the durations of the calls, the
+    wall time is from the start of the first call to the end of the last one : both
+    differ when the stage runs in several threads.
+    """
+
+    def __init__(self):
+        super(StageStats, self).__init__()
+        self.count = 0
+        self.errors = 0
+        self.nb_bytes = 0
+        self.busy_time = 0.0
+        self.max_time = 0.0
+        self.first_start = None
+        self.last_end = None
+        self.histogram = [0] * len(LATENCY_LABELS)
+
+    def add(
+        self, start: float, end: float, nb_bytes: int, error: bool, paused: float = 0.0
+    ) -> None:
+        duration = end - start - paused
+        self.count += 1
+        self.errors += error
+        self.nb_bytes += nb_bytes
+        self.busy_time += duration
+        self.max_time = max(self.max_time, duration)
+        if self.first_start is None or start < self.first_start:
+            self.first_start = start
+        if self.last_end is None or end > self.last_end:
+            self.last_end = end
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def to_dict(self) -> Dict:
+        wall_time = self.last_end - self.first_start if self.count else 0.0
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes": self.nb_bytes,
+            "busy_time": self.busy_time,
+            "wall_time": wall_time,
+            "files_per_second": self.count / wall_time if wall_time else None,
+            "bytes_per_second": self.nb_bytes / wall_time if wall_time else None,
+            "latency": {
+                "mean": self.busy_time / self.count if self.count else None,
+                "max": self.max_time,
+                "histogram": dict(zip(LATENCY_LABELS, self.histogram)),
+            },
+        }
+
+
+class Metrics:
+    """
+    Counters, bytes and durations of the stages of a run : scan, hash, lookup,
+    db_write, copy. Thread safe. The calls run in the worker processes of
+    HASH_EXECUTOR=process are not counted.
+    """
+
+    def __init__(self, progress_interval: float = PROGRESS_INTERVAL):
+        super(Metrics, self).__init__()
+        self.progress_interval = progress_interval
+        self._lock = threading.Lock()
+        # measures running in each thread
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stages: Dict[str, StageStats] = {}
+            self._start = time.perf_counter()
+            self._last_progress = self._start
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[Measure]:
+        """Time the block. The block sets the bytes processed on the Measure"""
+        measure = Measure()
+        running = self._running()
+        running.append(measure)
+        start = time.perf_counter()
+        error = False
+        try:
+            yield measure
+        except BaseException:
+            error = True
+            raise
+        finally:
+            end = time.perf_counter()
+            running.remove(measure)
+            self.add(stage, start, end, measure.nb_bytes, error, measure.paused)
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """
+        The block is not counted in the measures running in this thread : ex the
+        files hashed on demand during a lookup, counted in "hash"
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            for measure in self._running():
+                measure.paused += duration
+
+    def timed(self, stage: str):
+        """Decorator measuring each call of the function, without bytes"""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.measure(stage):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def add(
+        self,
+        stage: str,
+        start: float,
+        end: float,
+        nb_bytes: int = 0,
+        error=False,
+        paused: float = 0.0,
+    ) -> None:
+        with self._lock:
+            if stage not in self._stages:
+                self._stages[stage] = StageStats()
+            self._stages[stage].add(start, end, nb_bytes, error, paused)
+            progress = (
+                self.progress_interval > 0
+                and end - self._last_progress >= self.progress_interval
+            )
+            if progress:
+                self._last_progress = end
+                line = self._progress_line(end)
+        if progress:
+            print(line)
+
+    def report(self) -> Dict:
+        with self._lock:
+            return {
+                "elapsed": time.perf_counter() - self._start,
+                "stages": {
+                    stage: stats.to_dict() for stage, stats in self._stages.items()
+                },
+            }
+
+    def export(self, path: str) -> None:
+        """Write the report as JSON"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def display(self) -> None:
+        report = self.report()
+        print(f"Stages ({report['elapsed']:.1f} s) :")
+        for stage, stats in report["stages"].items():
+            throughput = (stats["bytes_per_second"] or 0) / 1024**2
+            print(
+                f"  {stage:<10} : {stats['count']:>8} calls, "
+                f"{stats['bytes'] / 1024 ** 2:>10.1f} MiB, "
+                f"{stats['wall_time']:>8.1f} s, {throughput:>8.1f} MiB/s, "
+                f"max {stats['latency']['max'] * 1000:.1f} ms"
+            )
+
+    def _running(self) -> List[Measure]:
+        if not hasattr(self._local, "measures"):
+            self._local.measures = []
+        return self._local.measures
+
+    def _progress_line(self, now: float) -> str:
+        stages = ", ".join(
+            f"{stage} {stats.count} ({stats.nb_bytes / 1024 ** 2:.0f} MiB)"
+            for stage, stats in self._stages.items()
+        )
+        return f"Progress {now - self._start:.0f} s : {stages}"
+
+
+# Metrics of the current run
+METRICS = Metrics()
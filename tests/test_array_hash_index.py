@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import mock
+from unittest import TestCase
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from src.db_cache import cache_table
+from src.db_cache.array_hash_index import ArrayHashIndex
+from src.db_cache.bulk_writes import upsert_records
+from src.db_cache.index_snapshot import read_snapshot
+from src.io_files.hash_functions import HASH_STAGES
+
+FULL_HASH_KEYS = list(HASH_STAGES)[-1]
+
+
+class TestArrayHashIndex(TestCase):
+    def setUp(self) -> None:
+        super(TestArrayHashIndex, self).setUp()
+        self.engine = create_engine("sqlite://")  # in-memory database
+        self.table = cache_table("files")
+        self.table.create(self.engine)
+        self.addCleanup(self.engine.dispose)
+
+        full_hashs = {key: "ff" * 32 for key in FULL_HASH_KEYS}
+        records = [
+            dict(
+                {"folder": "a", "name": "f1", "size": 10, "partial": "aa"}, **full_hashs
+            ),
+            {"folder": "b", "name": "f2", "size": 10, "partial": "aa"},
+            {"folder": "c", "name": "f3", "size": 20},
+        ]
+        with self.engine.begin() as connection:
+            upsert_records(connection, self.table, pd.DataFrame(records))
+        self.index = ArrayHashIndex(self.engine, self.table)
+        self.labels = {
+            name: self.index.find_path(folder, name)
+            for folder, name in [("a", "f1"), ("b", "f2"), ("c", "f3")]
+        }
+        self.full_hashs = full_hashs
+
+    def test_find(self):
+        self.assertEqual(
+            {self.labels["f1"], self.labels["f2"]}, set(self.index.find({"size": 10}))
+        )
+        hash_info = dict({"size": 10, "partial": "aa"}, **self.full_hashs)
+        self.assertEqual([self.labels["f1"]], self.index.find(hash_info))
+        self.assertEqual([], self.index.find({"size": 30}))
+        self.assertEqual(("a", "f1"), self.index.location(self.labels["f1"]))
+
+    def test_update(self):
+        label = self.labels["f2"]
+        missing = self.index.missing(self.labels.values(), FULL_HASH_KEYS)
+        self.assertEqual([label, self.labels["f3"]], missing)
+
+        self.index.update(label, self.full_hashs)
+
+        hash_info = dict({"size": 10}, **self.full_hashs)
+        self.assertEqual(2, len(self.index.find(hash_info)))
+        self.assertEqual(
+            self.full_hashs[FULL_HASH_KEYS[0]],
+            self.index.record(label)[FULL_HASH_KEYS[0]],
+        )
+
+    def test_add(self):
+        with mock.patch("src.db_cache.array_hash_index.SIZE_PENDING", 1):
+            for name in ["f4", "f5"]:
+                self.index.add({"folder": "d", "name": name, "size": 20})
+
+        self.assertEqual(5, len(self.index))
+        self.assertEqual(3, len(self.index.find({"size": 20})))
+        labels = self.index.to_dataframe().index
+        self.assertEqual(["d", "d"], list(self.index.records(labels[-2:])["folder"]))
+
+    def test_snapshot(self):
+        snapshot_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_folder)
+        snapshot_path = os.path.join(snapshot_folder, "files.idx")
+        ArrayHashIndex(self.engine, self.table, snapshot_path)
+
+        with mock.patch.object(ArrayHashIndex, "_load") as load:
+            index = ArrayHashIndex(self.engine, self.table, snapshot_path)
+            load.assert_not_called()
+        self.assertEqual(2, len(index.find({"size": 10})))
+
+        # a file inserted by another index : the snapshot is out of date
+        ArrayHashIndex(self.engine, self.table).add(
+            {"folder": "d", "name": "f4", "size": 10}
+        )
+        index = ArrayHashIndex(self.engine, self.table, snapshot_path)
+        self.assertEqual(3, len(index.find({"size": 10})))
+
+    def test_corrupted_snapshot(self):
+        snapshot_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_folder)
+        snapshot_path = os.path.join(snapshot_folder, "files.idx")
+        ArrayHashIndex(self.engine, self.table, snapshot_path)
+
+        with open(snapshot_path, "r+b") as f:
+            f.seek(-4, os.SEEK_END)
+            f.write(b"\xff\xff\xff\xff")
+        # the arrays are only checked on demand, to be read lazily
+        self.assertIsNotNone(read_snapshot(snapshot_path))
+        self.assertIsNone(read_snapshot(snapshot_path, verify=True))
+
+        with open(snapshot_path, "r+b") as f:
+            f.truncate(os.path.getsize(snapshot_path) - 8)
+        self.assertIsNone(read_snapshot(snapshot_path))
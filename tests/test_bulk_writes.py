@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+from unittest import TestCase
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from src.db_cache import cache_table
+from src.db_cache.bulk_writes import delete_records
+from src.db_cache.bulk_writes import upsert_records
+
+
+class TestBulkWrites(TestCase):
+    def setUp(self) -> None:
+        super(TestBulkWrites, self).setUp()
+        self.engine = create_engine("sqlite://")  # in-memory database
+        self.table = cache_table("files")
+        self.table.create(self.engine)
+        self.addCleanup(self.engine.dispose)
+
+        records = [{"folder": ".", "name": f"file{i}", "size": i} for i in range(5)]
+        with self.engine.begin() as connection:
+            upsert_records(connection, self.table, pd.DataFrame(records))
+
+    def read_table(self) -> pd.DataFrame:
+        return pd.read_sql_table("files", self.engine).set_index("name")
+
+    def test_insert(self):
+        df_table = self.read_table()
+        self.assertEqual([0, 1, 2, 3, 4], list(df_table["size"]))
+        self.assertTrue(df_table["partial"].isnull().all())
+
+    def test_update_on_same_path(self):
+        records = [
+            {"folder": ".", "name": "file1", "size": 1, "partial": "abc"},
+            {"folder": ".", "name": "file5", "size": 5},
+        ]
+        with self.engine.begin() as connection:
+            upsert_records(connection, self.table, pd.DataFrame(records))
+
+        df_table = self.read_table()
+        self.assertEqual(6, df_table.shape[0])
+        self.assertEqual("abc", df_table.at["file1", "partial"])
+        self.assertEqual(2, df_table.at["file1", "file_id"])
+
+    def test_delete(self):
+        df_paths = pd.DataFrame([{"folder": ".", "name": "file1"}])
+        with self.engine.begin() as connection:
+            delete_records(connection, self.table, df_paths)
+
+        self.assertEqual(
+            {"file0", "file2", "file3", "file4"}, set(self.read_table().index)
+        )
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import mock
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy import select
+
+from src.db_cache.db_cache_manager import DbCacheManager
+from src.files_cleaners import copy_recursive
+from src.io_files.hash_functions import FileHashManager
+from src.io_files.hash_functions import HASH_STAGES
+
+
+class TestContentIndex(TestCase):
+    def setUp(self) -> None:
+        super(TestContentIndex, self).setUp()
+        self.engine = create_engine("sqlite://")  # in-memory database
+        self.addCleanup(self.engine.dispose)
+        self.test_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_folder)
+        # 2 archive drives, and a folder to copy
+        self.drive_a = os.path.join(self.test_folder, "drive_a")
+        self.drive_b = os.path.join(self.test_folder, "drive_b")
+        self.folder_src = os.path.join(self.test_folder, "src")
+
+        self.write_file(self.drive_a, "photo1.jpg", "photo1" * 50000)
+        self.write_file(self.drive_a, "photo2.jpg", "photo2" * 50000)
+        self.write_file(
+            self.drive_a, os.path.join("2020", "photo2.jpg"), "photo2" * 50000
+        )
+        self.write_file(
+            self.drive_b, os.path.join("old", "photo1.jpg"), "photo1" * 50000
+        )
+        self.write_file(self.drive_b, "photo3.jpg", "photo3" * 50000)
+
+        patches = [
+            mock.patch(
+                "src.db_cache.db_cache_manager.create_engine", lambda _: self.engine
+            ),
+            mock.patch(
+                "src.db_cache.db_cache_manager.SNAPSHOT_FOLDER",
+                os.path.join(self.test_folder, "snapshots"),
+            ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    @classmethod
+    def write_file(cls, folder: str, name: str, content: str) -> str:
+        file_path = os.path.join(folder, name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as f:
+            f.write(content)
+        return file_path
+
+    def sync_root(self, folder: str) -> DbCacheManager:
+        db_cache = DbCacheManager(FileHashManager(folder))
+        _ = db_cache.index
+        db_cache.save_content_index()
+        return db_cache
+
+    def test_sync(self):
+        db_cache = self.sync_root(self.drive_a)
+        self.sync_root(self.drive_b)
+        table = db_cache.content_index.table
+        with self.engine.connect() as connection:
+            rows = connection.execute(select([table.c.folder_id, table.c.name]))
+            self.assertEqual(5, len(rows.fetchall()))
+
+        os.remove(os.path.join(self.drive_a, "photo1.jpg"))
+        db_cache = self.sync_root(self.drive_a)
+        query = select([table.c.name]).where(table.c.folder_id == db_cache.folder_id)
+        with self.engine.connect() as connection:
+            names = sorted(row[0] for row in connection.execute(query))
+        self.assertEqual(["photo2.jpg", "photo2.jpg"], names)
+
+    def test_find_file_in_roots(self):
+        db_cache = self.sync_root(self.drive_a)
+        self.sync_root(self.drive_b)
+        source_path = self.write_file(self.folder_src, "copy.jpg", "photo1" * 50000)
+        other_path = self.write_file(self.folder_src, "other.jpg", "photo4" * 50000)
+        hash_gen = FileHashManager(self.folder_src)
+        roots = db_cache.registered_roots([self.drive_b])
+
+        root, folder, name = db_cache.find_file_in_roots(
+            source_path, hash_gen, {}, roots
+        )
+        self.assertEqual((self.drive_b, "old", "photo1.jpg"), (root, folder, name))
+        self.assertEqual(
+            ("", "", ""), db_cache.find_file_in_roots(other_path, hash_gen, {}, roots)
+        )
+
+        # drive_b unplugged : can't be checked, only matched on demand
+        os.rename(self.drive_b, self.drive_b + "_unplugged")
+        self.assertEqual(
+            ("", "", ""), db_cache.find_file_in_roots(source_path, hash_gen, {}, roots)
+        )
+        # found from the hashs computed by the previous lookup
+        root, _, name = db_cache.find_file_in_roots(
+            source_path, hash_gen, {}, roots, accept_unmounted=True
+        )
+        self.assertEqual((self.drive_b, "photo1.jpg"), (root, name))
+        # the hashs of photo3 were never computed
+        source_path = self.write_file(self.folder_src, "copy3.jpg", "photo3" * 50000)
+        self.assertEqual(
+            ("", "", ""),
+            db_cache.find_file_in_roots(
+                source_path, hash_gen, {}, roots, accept_unmounted=True
+            ),
+        )
+
+    def test_hashs_saved_in_root_table(self):
+        db_cache = self.sync_root(self.drive_a)
+        source_path = self.write_file(self.folder_src, "copy.jpg", "photo1" * 50000)
+        db_cache.find_file_in_roots(
+            source_path,
+            FileHashManager(self.folder_src),
+            {},
+            db_cache.registered_roots(),
+        )
+
+        hash_key = list(HASH_STAGES)[-1][0]
+        table = db_cache.cache_table
+        query = select([table.c.name]).where(table.c[hash_key].isnot(None))
+        with self.engine.connect() as connection:
+            self.assertEqual(
+                ["photo1.jpg"], [row[0] for row in connection.execute(query)]
+            )
+
+    def test_duplicated_files_across_roots(self):
+        db_cache = self.sync_root(self.drive_a)
+        self.sync_root(self.drive_b)
+
+        groups = list(
+            db_cache.iter_duplicated_files_across_roots(db_cache.registered_roots())
+        )
+        # photo2 is twice in drive_a only
+        self.assertEqual(1, len(groups))
+        paths = sorted(
+            os.path.join(record["root"], record["folder"], record["name"])
+            for record in groups[0]
+        )
+        self.assertEqual(
+            [
+                os.path.join(self.drive_a, ".", "photo1.jpg"),
+                os.path.join(self.drive_b, "old", "photo1.jpg"),
+            ],
+            paths,
+        )
+
+    def test_copy_check_roots(self):
+        self.sync_root(self.drive_a)
+        self.sync_root(self.drive_b)
+        folder_dst = os.path.join(self.test_folder, "dst")
+        os.makedirs(folder_dst)
+        self.write_file(self.folder_src, "copy1.jpg", "photo1" * 50000)
+        self.write_file(self.folder_src, "copy4.jpg", "photo4" * 50000)
+        self.write_file(self.folder_src, "small.txt", "photo3" * 10)
+
+        with mock.patch.dict(os.environ, {"COPY_CHECK_ROOTS": "all"}):
+            copy_recursive(self.folder_src, folder_dst)
+        self.assertEqual(["copy4.jpg", "small.txt"], sorted(os.listdir(folder_dst)))
+
+    def test_copy_check_unmounted_roots(self):
+        db_cache = self.sync_root(self.drive_b)
+        source_path = self.write_file(self.folder_src, "copy1.jpg", "photo1" * 50000)
+        roots = db_cache.registered_roots([self.drive_b])
+        hash_gen = FileHashManager(self.folder_src)
+        db_cache.find_file_in_roots(source_path, hash_gen, {}, roots)
+        os.rename(self.drive_b, self.drive_b + "_unplugged")
+
+        for trust_unmounted, expected in [(False, ["copy1.jpg"]), (True, [])]:
+            folder_dst = os.path.join(self.test_folder, f"dst_{trust_unmounted}")
+            os.makedirs(folder_dst)
+            with mock.patch.dict(os.environ, {"COPY_CHECK_ROOTS": self.drive_b}):
+                with mock.patch(
+                    "src.copy_pipeline.COPY_TRUST_UNMOUNTED", trust_unmounted
+                ):
+                    copy_recursive(self.folder_src, folder_dst)
+            self.assertEqual(expected, os.listdir(folder_dst))
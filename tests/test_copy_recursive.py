@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import io
 import os
 import shutil
 from tempfile import mkdtemp
@@ -9,7 +10,10 @@ from unittest import TestCase
 from freezegun import freeze_time
 from sqlalchemy import create_engine
 
+from src.copy_pipeline import CopyPipeline
 from src.files_cleaners import copy_recursive
+from src.io_files import io_wrappers
+from src.io_files.hash_functions import FileHashManager
 
 
 class TestCopyResursive(TestCase):
@@ -92,6 +96,37 @@ class TestCopyResursive(TestCase):
         all_files = self.list_files_in_folder(self.folder_dst)
         self.assertEqual(all_files, self.files_dst_before_cp, all_files)
 
+    def test_copy_small_files(self):
+        with open(os.path.join(self.folder_dst, "subfolder3", "small.txt"), "w") as f:
+            f.write("small")
+        for i in range(3):
+            with open(os.path.join(self.subfolder2, f"small{i}.txt"), "w") as f:
+                f.write("small" if i == 0 else f"new small {i}")
+
+        copy_recursive(self.folder_src, self.folder_dst)
+
+        all_files = self.list_files_in_folder(self.folder_dst)
+        expected = {
+            "subfolder3/small.txt",
+            "subfolder2/small1.txt",
+            "subfolder2/small2.txt",
+        }
+        self.assertEqual(all_files, self.files_dst_before_cp | expected, all_files)
+
+    def test_copy_hard_link(self):
+        os.link(
+            os.path.join(self.folder_dst, "subfolder3", "file5.txt"),
+            os.path.join(self.subfolder2, "file5_link.txt"),
+        )
+
+        patch_stage = "src.io_files.hash_functions.FileHashManager.get_hashs_for_stage"
+        with mock.patch(patch_stage) as get_hashs_for_stage:
+            copy_recursive(self.folder_src, self.folder_dst)
+            get_hashs_for_stage.assert_not_called()
+
+        all_files = self.list_files_in_folder(self.folder_dst)
+        self.assertEqual(all_files, self.files_dst_before_cp, all_files)
+
     @freeze_time("2020-06-18")
     def test_copy_same_name_different_content__date(self):
         with open(os.path.join(self.subfolder1, "file3.txt"), "w") as f:
@@ -151,3 +186,128 @@ class TestCopyResursive(TestCase):
         after_cp = self.list_files_in_folder(self.folder_dst)
         expected = before_cp | {"subfolder2/file4.txt"}
         self.assertEqual(after_cp, expected, after_cp)
+
+    def test_copy_cache_error(self):
+        for i in range(2):
+            with open(os.path.join(self.subfolder2, f"file{i}_new.txt"), "w") as f:
+                f.write(f"file{i}_new" * 50000)
+
+        patch_add = "src.db_cache.db_cache_manager.DbCacheManager.add_file"
+        with mock.patch(patch_add, side_effect=ValueError("not unique")):
+            copy_recursive(self.folder_src, self.folder_dst)
+
+        all_files = self.list_files_in_folder(self.folder_dst)
+        expected = {f"subfolder2/file{i}_new.txt" for i in range(2)}
+        self.assertEqual(all_files, self.files_dst_before_cp | expected, all_files)
+
+    def test_copy_to_new_folder(self):
+        with open(os.path.join(self.subfolder2, "file4.txt"), "w") as f:
+            f.write("file4" * 50000)
+        folder_dst = os.path.join(self.test_folder, "new_folder")
+
+        copy_recursive(self.folder_src, folder_dst)
+
+        all_files = self.list_files_in_folder(folder_dst)
+        self.assertEqual({"subfolder2/file4.txt"}, all_files)
+
+    def test_copy_empty_folder(self):
+        folder_src = os.path.join(self.test_folder, "empty")
+        os.makedirs(folder_src)
+        folder_dst = os.path.join(self.test_folder, "new_folder")
+
+        with mock.patch("src.db_cache.db_cache_manager.CACHE_SIDECAR", True):
+            copy_recursive(folder_src, folder_dst)
+
+        self.assertEqual(set(), self.list_files_in_folder(folder_dst))
+
+    def test_copy_dry_run(self):
+        with open(os.path.join(self.subfolder2, "file4.txt"), "w") as f:
+            f.write("file4" * 50000)
+
+        copy_recursive(self.folder_src, self.folder_dst, "dry_run")
+
+        all_files = self.list_files_in_folder(self.folder_dst)
+        self.assertEqual(all_files, self.files_dst_before_cp, all_files)
+
+    def test_copy_ordered(self):
+        with open(os.path.join(self.subfolder1, "file1.txt"), "w") as f:
+            f.write("file1" * 50000)
+        for i in range(3):
+            with open(os.path.join(self.subfolder2, f"file{i}_new.txt"), "w") as f:
+                f.write(f"file{i}_new" * (50000 if i else 1))
+
+        for order in ["inode", "extent"]:
+            with mock.patch("src.copy_pipeline.COPY_ORDER", order):
+                copy_recursive(self.folder_src, self.folder_dst)
+
+        all_files = self.list_files_in_folder(self.folder_dst)
+        expected = {f"subfolder2/file{i}_new.txt" for i in range(3)}
+        self.assertEqual(all_files, self.files_dst_before_cp | expected, all_files)
+
+    def write_planned_files(self):
+        """New files, and their position on the disk : None without FIEMAP"""
+        for folder, name in [
+            (self.subfolder1, "c.txt"),
+            (self.subfolder1, "d.txt"),
+            (self.subfolder2, "a.txt"),
+            (self.subfolder2, "b.txt"),
+        ]:
+            with open(os.path.join(folder, name), "w") as f:
+                f.write(name * 50000)
+        offsets = {"a.txt": 300, "b.txt": 100, "d.txt": 200}
+        return mock.patch(
+            "src.copy_pipeline.get_physical_offset",
+            lambda path: offsets.get(os.path.basename(path)),
+        )
+
+    def test_plan_reads(self):
+        with self.write_planned_files():
+            for order, expected in [
+                ("extent", ["b.txt", "d.txt", "a.txt", "c.txt"]),
+                ("inode", None),
+            ]:
+                pipeline = CopyPipeline(
+                    mock.Mock(),
+                    mock.Mock(),
+                    FileHashManager(self.folder_src),
+                    self.folder_dst,
+                    order=order,
+                )
+                entries = pipeline._plan_reads()
+                if expected is None:
+                    inodes = {e.path: os.stat(e.path).st_ino for e in entries}
+                    expected = [
+                        os.path.basename(path)
+                        for path in sorted(inodes, key=inodes.get)
+                    ]
+                self.assertEqual(expected, [entry.name for entry in entries], order)
+
+    def test_planned_copies_order(self):
+        copy_file = io_wrappers.FileManager.copy_file
+        with self.write_planned_files(), mock.patch(
+            "src.copy_pipeline.COPY_ORDER", "extent"
+        ):
+            with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                copy_recursive(self.folder_src, self.folder_dst, "dry_run")
+            with mock.patch.object(
+                io_wrappers.FileManager,
+                "copy_file",
+                autospec=True,
+                side_effect=copy_file,
+            ) as copied:
+                copy_recursive(self.folder_src, self.folder_dst)
+
+        # folder by folder, in the order of the disk inside each folder
+        expected = [
+            "subfolder1/d.txt",
+            "subfolder1/c.txt",
+            "subfolder2/b.txt",
+            "subfolder2/a.txt",
+        ]
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(
+            expected, [line.split()[1] for line in lines if line.startswith("cp ")]
+        )
+        size = sum(os.path.getsize(os.path.join(self.folder_src, p)) for p in expected)
+        self.assertIn(f"Dry run : 4 files to copy, {size / 1024 ** 2:.1f} MiB", lines)
+        self.assertEqual(expected, [call[0][3] for call in copied.call_args_list])
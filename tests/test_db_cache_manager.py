@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import sys
+from tempfile import mkdtemp
+from unittest import mock
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy import inspect
+from sqlalchemy import text
+
+from src.db_cache import db_cache_manager
+from src.db_cache.db_cache_manager import DbCacheManager
+from src.db_cache.sql_hash_index import SqlHashIndex
+from src.io_files.hash_functions import FileHashManager
+from src.io_files import io_wrappers
+from src.io_files.hash_functions import HASH_FUNCTIONS
+from src.io_files.hash_functions import HASH_STAGES
+
+
+class TestDbCacheManager(TestCase):
+    def setUp(self) -> None:
+        super(TestDbCacheManager, self).setUp()
+        self.engine = create_engine("sqlite://")  # in-memory database
+        self.test_folder = mkdtemp()
+
+        patch_func = "src.db_cache.db_cache_manager.create_engine"
+        self.patch_query = mock.patch(patch_func, lambda _: self.engine)
+        self.patch_query.start()
+        self.addCleanup(self.patch_query.stop)
+
+        snapshot_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_folder)
+        patch_snapshot = "src.db_cache.db_cache_manager.SNAPSHOT_FOLDER"
+        self.patch_snapshot = mock.patch(patch_snapshot, snapshot_folder)
+        self.patch_snapshot.start()
+        self.addCleanup(self.patch_snapshot.stop)
+
+        for name in ["file1.txt", "file2.txt", "file3.txt"]:
+            self.write_file(name, "same content" * 5000)
+
+    def tearDown(self) -> None:
+        super(TestDbCacheManager, self).tearDown()
+        self.engine.dispose()
+        shutil.rmtree(self.test_folder)
+
+    def write_file(self, name: str, content: str) -> str:
+        file_path = os.path.join(self.test_folder, name)
+        with open(file_path, "w") as f:
+            f.write(content)
+        return file_path
+
+    def load_cache(self) -> DbCacheManager:
+        db_cache = DbCacheManager(FileHashManager(self.test_folder))
+        db_cache.find_duplicated_files()
+        return db_cache
+
+    def hashed_files(self, db_cache: DbCacheManager):
+        df_cache = db_cache.index.to_dataframe()
+        hash_key = list(HASH_STAGES)[-1][0]
+        labels = df_cache[df_cache[hash_key].notnull()].index
+        return set(db_cache.index.records(labels)["name"])
+
+    def test_refresh_keeps_unchanged_files(self):
+        db_cache = self.load_cache()
+        self.assertEqual(
+            {"file1.txt", "file2.txt", "file3.txt"}, self.hashed_files(db_cache)
+        )
+
+        self.write_file("file2.txt", "other content" * 5000)
+        os.remove(os.path.join(self.test_folder, "file3.txt"))
+        self.write_file("file4.txt", "new content")
+
+        db_cache = DbCacheManager(FileHashManager(self.test_folder))
+        df_cache = db_cache.db_cache
+        self.assertEqual({"file1.txt", "file2.txt", "file4.txt"}, set(df_cache["name"]))
+        self.assertEqual({"file1.txt"}, self.hashed_files(db_cache))
+
+    def test_refresh_hard_link(self):
+        db_cache = self.load_cache()
+        os.link(
+            os.path.join(self.test_folder, "file1.txt"),
+            os.path.join(self.test_folder, "link1.txt"),
+        )
+
+        db_cache = DbCacheManager(FileHashManager(self.test_folder))
+        self.assertEqual(
+            {"file1.txt", "file2.txt", "file3.txt", "link1.txt"},
+            self.hashed_files(db_cache),
+        )
+
+    def test_refresh_without_inodes(self):
+        """Ex on Windows : files with the same stat values are not links"""
+        create_record = FileHashManager.create_record_from_entry
+
+        def without_inode(hash_gen, entry):
+            return dict(create_record(hash_gen, entry), inode=0)
+
+        with mock.patch.object(
+            FileHashManager, "create_record_from_entry", without_inode
+        ):
+            self.load_cache()
+            # same size and mtime as file1.txt, other content
+            stat = os.stat(os.path.join(self.test_folder, "file1.txt"))
+            file_path = self.write_file("file4.txt", "other content" * 5000)
+            os.truncate(file_path, stat.st_size)
+            os.utime(file_path, ns=(stat.st_mtime_ns, stat.st_mtime_ns))
+
+            db_cache = DbCacheManager(FileHashManager(self.test_folder))
+            _ = db_cache.index
+        self.assertEqual(
+            {"file1.txt", "file2.txt", "file3.txt"}, self.hashed_files(db_cache)
+        )
+
+    def test_refresh_paths(self):
+        self.write_file("file4.txt", "other content" * 5000)
+        os.makedirs(os.path.join(self.test_folder, "sub", "sub2"))
+        self.write_file(os.path.join("sub", "sub2", "file5.txt"), "file5")
+        db_cache = self.load_cache()
+        self.assertEqual(
+            {"file1.txt", "file2.txt", "file3.txt"}, self.hashed_files(db_cache)
+        )
+
+        file2 = self.write_file("file2.txt", "modified content" * 5000)
+        file3 = os.path.join(self.test_folder, "file3.txt")
+        os.remove(file3)
+        file6 = self.write_file("file6.txt", "new content")
+        shutil.rmtree(os.path.join(self.test_folder, "sub"))
+        paths = [
+            file2,
+            file3,
+            file6,
+            os.path.join(self.test_folder, "file1.txt"),  # unchanged
+            os.path.join(self.test_folder, "sub"),
+        ]
+
+        self.assertEqual((2, 2), db_cache.refresh_paths(paths))
+        db_cache = DbCacheManager(FileHashManager(self.test_folder), refresh=False)
+        self.assertEqual(
+            {"file1.txt", "file2.txt", "file4.txt", "file6.txt"},
+            set(db_cache.db_cache["name"]),
+        )
+        self.assertEqual({"file1.txt"}, self.hashed_files(db_cache))
+
+    def test_watched_folder_not_refreshed(self):
+        db_cache = self.load_cache()
+        db_cache.set_watched(True)
+        self.write_file("file4.txt", "new content")
+
+        db_cache = DbCacheManager(FileHashManager(self.test_folder))
+        self.assertTrue(db_cache.is_watched())
+        self.assertNotIn("file4.txt", set(db_cache.db_cache["name"]))
+
+        db_cache.set_watched(False)
+        db_cache = DbCacheManager(FileHashManager(self.test_folder))
+        self.assertIn("file4.txt", set(db_cache.db_cache["name"]))
+
+    def test_find_same_file(self):
+        db_cache = self.load_cache()
+        file_path = os.path.join(self.test_folder, "file1.txt")
+        link_folder = mkdtemp(dir=os.path.dirname(self.test_folder))
+        self.addCleanup(shutil.rmtree, link_folder)
+        os.link(file_path, os.path.join(link_folder, "link.txt"))
+
+        entry = next(io_wrappers.iter_file_entries(link_folder))
+        self.assertEqual((".", "file1.txt"), db_cache.find_same_file(entry))
+
+    def test_add_copied_file(self):
+        db_cache = self.load_cache()
+
+        file_path = self.write_file("file4.txt", "new content")
+        db_cache.add_file(file_path)
+        db_cache.save_cache()
+
+        db_cache = DbCacheManager(FileHashManager(self.test_folder), refresh=False)
+        self.assertIn("file4.txt", set(db_cache.db_cache["name"]))
+
+    def test_iter_duplicated_files(self):
+        self.write_file("file4.txt", "other content" * 5000)
+        self.write_file("file5.txt", "diff content" * 5000)  # same size
+        db_cache = DbCacheManager(FileHashManager(self.test_folder))
+
+        groups = list(db_cache.iter_duplicated_files())
+
+        self.assertEqual(1, len(groups))
+        self.assertEqual(
+            {"file1.txt", "file2.txt", "file3.txt"},
+            {record["name"] for record in groups[0]},
+        )
+
+    def test_compare_file(self):
+        db_cache = DbCacheManager(FileHashManager(self.test_folder))
+        len(db_cache.index)  # the cache is loaded before file4 is written
+        source_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, source_folder)
+        source_path = os.path.join(source_folder, "source.txt")
+        with open(source_path, "w") as f:
+            f.write("same content" * 5000)
+        target_path = os.path.join(self.test_folder, "file1.txt")
+        other_path = self.write_file("file4.txt", "different" * 5000)
+        db_cache.add_file(other_path)
+
+        hash_info = {}
+        src_hash_gen = FileHashManager(source_folder)
+        self.assertTrue(
+            db_cache.compare_file(target_path, source_path, src_hash_gen, hash_info)
+        )
+        self.assertFalse(
+            db_cache.compare_file(other_path, source_path, src_hash_gen, hash_info)
+        )
+        unknown_path = os.path.join(self.test_folder, "file5.txt")
+        self.assertIsNone(
+            db_cache.compare_file(unknown_path, source_path, src_hash_gen, hash_info)
+        )
+        self.assertTrue(all(key in hash_info for key in list(HASH_STAGES)[-1]))
+
+    def test_hash_algorithm_changed(self):
+        """
+        The hash columns are created when the modules are imported : the cache is
+        read with the other algorithm in another process
+        """
+        db_path = os.path.join(mkdtemp(dir=self.test_folder), "files_hash.db")
+        engine = create_engine(f"sqlite:///{db_path}")
+        self.addCleanup(engine.dispose)
+        with mock.patch(
+            "src.db_cache.db_cache_manager.create_engine", lambda _: engine
+        ):
+            db_cache = self.load_cache()
+            table_name = db_cache.table_name
+        algorithm = "sha1" if "sha1" not in HASH_FUNCTIONS else "blake2b"
+
+        script = (
+            "import sys\n"
+            "from src.db_cache.db_cache_manager import DbCacheManager\n"
+            "from src.io_files.hash_functions import FileHashManager\n"
+            "db_cache = DbCacheManager(FileHashManager(sys.argv[1]))\n"
+            "keys, df_duplicated = db_cache.find_duplicated_files()\n"
+            "print(df_duplicated.shape[0])\n"
+        )
+        env = dict(
+            os.environ,
+            HASH_ALGORITHM=algorithm,
+            CACHE_BACKEND="sqlite",
+            CACHE_INDEX=db_cache_manager.CACHE_INDEX,
+            SQLITE_PATH=db_path,
+            CACHE_SNAPSHOT_FOLDER=os.path.join(self.test_folder, "snapshots"),
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", script, self.test_folder],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env=env,
+            stdout=subprocess.PIPE,
+            check=True,
+            universal_newlines=True,
+        )
+
+        self.assertIn(f"migrate to {algorithm}", result.stdout)
+        self.assertEqual("2", result.stdout.split()[-1])
+        columns = {column["name"] for column in inspect(engine).get_columns(table_name)}
+        self.assertIn(algorithm, columns)
+        with engine.connect() as connection:
+            nb_hashed = connection.execute(
+                text(f'SELECT COUNT("{algorithm}") FROM "{table_name}"')
+            ).scalar()
+            hash_algorithm = connection.execute(
+                text("SELECT hash_algorithm FROM folders")
+            ).scalar()
+        self.assertEqual(3, nb_hashed)
+        self.assertEqual(algorithm, hash_algorithm)
+
+    def test_migration_error_raised(self):
+        table_name = self.load_cache().table_name
+        index_name = inspect(self.engine).get_indexes(table_name)[0]["name"]
+        with self.engine.begin() as connection:
+            connection.execute(text(f'DROP INDEX "{index_name}"'))
+
+        write_error = mock.Mock(side_effect=ValueError("write failed"))
+        with mock.patch("src.db_cache.db_cache_manager.upsert_records", write_error):
+            with self.assertRaises(ValueError):
+                self.load_cache()
+        self.assertFalse(os.path.exists(table_name + ".csv"))
+
+    def test_resume_interrupted_build(self):
+        for folder in ["folder_a", "folder_b"]:
+            os.makedirs(os.path.join(self.test_folder, folder))
+            self.write_file(os.path.join(folder, "file.txt"), folder)
+
+        create_record = FileHashManager.create_record_from_entry
+        folders_seen = []
+
+        def interrupt_in_last_folder(hash_gen, entry):
+            # the third folder listed, whatever the order of the walk
+            if entry.root not in folders_seen:
+                folders_seen.append(entry.root)
+            if len(folders_seen) == 3:
+                raise KeyboardInterrupt()
+            return create_record(hash_gen, entry)
+
+        patch_checkpoint = "src.db_cache.db_cache_manager.SIZE_CHECKPOINT"
+        patch_record = (
+            "src.io_files.hash_functions.FileHashManager.create_record_from_entry"
+        )
+        with mock.patch(patch_checkpoint, 1):
+            with mock.patch(patch_record, interrupt_in_last_folder):
+                with self.assertRaises(KeyboardInterrupt):
+                    DbCacheManager(FileHashManager(self.test_folder)).db_cache
+
+            db_cache = DbCacheManager(FileHashManager(self.test_folder))
+            with mock.patch.object(db_cache, "_write_records") as write_records:
+                db_cache.index
+            written = [
+                record["folder"]
+                for call in write_records.call_args_list
+                for record in call[0][0]
+            ]
+            # the folder interrupted, and the previous one : its end is only known
+            # from the first file of the next one. The first one was committed
+            last_folders = folders_seen[1:]
+            nb_files = sum(
+                os.path.isfile(os.path.join(folder, name))
+                for folder in last_folders
+                for name in os.listdir(folder)
+            )
+            self.assertEqual(nb_files, len(written))
+            self.assertEqual(
+                {os.path.relpath(folder, self.test_folder) for folder in last_folders},
+                set(written),
+            )
+
+        db_cache = DbCacheManager(FileHashManager(self.test_folder))
+        self.assertEqual(5, len(db_cache.index))
+
+
+class TestDbCacheManagerSqlIndex(TestDbCacheManager):
+    def setUp(self) -> None:
+        super(TestDbCacheManagerSqlIndex, self).setUp()
+        patch_index = mock.patch("src.db_cache.db_cache_manager.CACHE_INDEX", "sql")
+        patch_index.start()
+        self.addCleanup(patch_index.stop)
+
+    def test_table_indexes(self):
+        db_cache = self.load_cache()
+
+        self.assertIsInstance(db_cache.index, SqlHashIndex)
+        indexes = inspect(self.engine).get_indexes(db_cache.table_name)
+        self.assertEqual(
+            {("size", list(HASH_STAGES)[-1][0]), ("folder", "name")},
+            {tuple(index["column_names"]) for index in indexes},
+        )
+
+    def test_refresh_by_chunks(self):
+        os.makedirs(os.path.join(self.test_folder, "sub"))
+        self.write_file(os.path.join("sub", "file5.txt"), "sub content")
+        self.load_cache()
+        self.write_file("file2.txt", "other content" * 5000)
+        os.remove(os.path.join(self.test_folder, "file3.txt"))
+        shutil.rmtree(os.path.join(self.test_folder, "sub"))
+        self.write_file("file4.txt", "new content")
+
+        not_loaded = mock.Mock(side_effect=AssertionError("whole table loaded"))
+        with mock.patch("src.db_cache.db_cache_manager.SIZE_CHECKPOINT", 1):
+            with mock.patch("pandas.read_sql_table", not_loaded), mock.patch.object(
+                DbCacheManager, "_read_files_info", not_loaded
+            ):
+                db_cache = DbCacheManager(FileHashManager(self.test_folder))
+                db_cache.index
+        df_cache = db_cache.index.to_dataframe()
+        self.assertEqual({"file1.txt", "file2.txt", "file4.txt"}, set(df_cache["name"]))
+        self.assertEqual({"file1.txt"}, self.hashed_files(db_cache))
+
+
+class TestDbCacheManagerArrayIndex(TestDbCacheManager):
+    def setUp(self) -> None:
+        super(TestDbCacheManagerArrayIndex, self).setUp()
+        patch_index = mock.patch("src.db_cache.db_cache_manager.CACHE_INDEX", "array")
+        patch_index.start()
+        self.addCleanup(patch_index.stop)
+
+    def test_snapshot_removed_on_refresh(self):
+        db_cache = self.load_cache()
+        self.assertTrue(os.path.exists(db_cache.snapshot_path))
+
+        DbCacheManager(FileHashManager(self.test_folder)).index
+        self.assertTrue(os.path.exists(db_cache.snapshot_path))
+
+        self.write_file("file4.txt", "new content")
+        with mock.patch(
+            "src.db_cache.db_cache_manager.remove_snapshot"
+        ) as remove_snapshot:
+            DbCacheManager(FileHashManager(self.test_folder)).index
+            remove_snapshot.assert_called_with(db_cache.snapshot_path)
+
+    def test_find_duplicated_files(self):
+        self.write_file("file4.txt", "other content" * 5000)
+        keys, df_duplicated = self.load_cache().find_duplicated_files()
+
+        self.assertEqual(2, df_duplicated.shape[0])
+        self.assertTrue(
+            set(df_duplicated["name"]) < {"file1.txt", "file2.txt", "file3.txt"}
+        )
+
+
+class TestSqliteBackend(TestCase):
+    def setUp(self) -> None:
+        super(TestSqliteBackend, self).setUp()
+        self.test_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_folder)
+
+        db_path = os.path.join(self.test_folder, "cache", "files_hash.db")
+        for name, value in [("CACHE_BACKEND", "sqlite"), ("SQLITE_PATH", db_path)]:
+            patch_config = mock.patch(f"src.db_cache.db_cache_manager.{name}", value)
+            patch_config.start()
+            self.addCleanup(patch_config.stop)
+
+    def test_wal_mode(self):
+        db_cache = DbCacheManager(FileHashManager(self.test_folder))
+        self.addCleanup(db_cache.engine.dispose)
+
+        with db_cache.engine.connect() as connection:
+            journal_mode = connection.execute(text("PRAGMA journal_mode")).scalar()
+        self.assertEqual("wal", journal_mode)
+        self.assertTrue(os.path.exists(os.path.join(self.test_folder, "cache")))
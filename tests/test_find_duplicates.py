@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import mock
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from src.files_cleaners import find_duplicates
+
+
+class TestFindDuplicates(TestCase):
+    def setUp(self) -> None:
+        super(TestFindDuplicates, self).setUp()
+        self.engine = create_engine("sqlite://")  # in-memory database
+        self.addCleanup(self.engine.dispose)
+        self.test_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_folder)
+        self.folder = os.path.join(self.test_folder, "folder")
+        self.trash_folder = os.path.join(self.test_folder, "trash")
+
+        patch_func = "src.db_cache.db_cache_manager.create_engine"
+        self.patch_query = mock.patch(patch_func, lambda _: self.engine)
+        self.patch_query.start()
+        self.addCleanup(self.patch_query.stop)
+        patch_env = mock.patch.dict(os.environ, {"TRASH_FOLDER": self.trash_folder})
+        patch_env.start()
+        self.addCleanup(patch_env.stop)
+
+        for relative_path, content in [
+            ("photo.jpg", "photo" * 5000),
+            ("backup/photo_copy.jpg", "photo" * 5000),
+            ("backup/old/photo.jpg", "photo" * 5000),
+            ("other.jpg", "other" * 5000),
+        ]:
+            file_path = os.path.join(self.folder, relative_path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w") as f:
+                f.write(content)
+
+    def inode(self, relative_path: str) -> int:
+        return os.stat(os.path.join(self.folder, relative_path)).st_ino
+
+    def test_list(self):
+        find_duplicates(self.folder)
+
+        self.assertEqual(4, len({self.inode(path) for path in self.paths()}))
+
+    def test_trash(self):
+        find_duplicates(self.folder, "trash")
+
+        self.assertEqual({"photo.jpg", "other.jpg"}, self.paths())
+        self.assertEqual(
+            {"backup/photo_copy.jpg", "backup/old/photo.jpg"},
+            self.paths(self.trash_folder),
+        )
+
+    def test_trash_in_folder(self):
+        trash_folder = os.path.join(self.folder, "duplicated")
+        with mock.patch.dict(os.environ, {"TRASH_FOLDER": trash_folder}):
+            for _ in range(3):
+                find_duplicates(self.folder, "trash")
+
+        self.assertEqual(
+            {
+                "photo.jpg",
+                "other.jpg",
+                "duplicated/backup/photo_copy.jpg",
+                "duplicated/backup/old/photo.jpg",
+            },
+            self.paths(),
+        )
+
+    def test_hardlink(self):
+        find_duplicates(self.folder, "hardlink")
+
+        self.assertEqual(4, len(self.paths()))
+        self.assertEqual(self.inode("photo.jpg"), self.inode("backup/old/photo.jpg"))
+        self.assertEqual(self.inode("photo.jpg"), self.inode("backup/photo_copy.jpg"))
+        self.assertNotEqual(self.inode("photo.jpg"), self.inode("other.jpg"))
+
+    def test_hardlink_hash_collision(self):
+        """The files are compared before being replaced, the hashs could collide"""
+        with mock.patch("src.io_files.io_wrappers.files_equals", return_value=False):
+            find_duplicates(self.folder, "hardlink")
+
+        self.assertEqual(4, len({self.inode(path) for path in self.paths()}))
+
+    def test_unknown_action(self):
+        with self.assertRaises(ValueError):
+            find_duplicates(self.folder, "delete")
+
+    def paths(self, folder: str = None):
+        folder = folder or self.folder
+        return {
+            os.path.relpath(os.path.join(root, name), folder)
+            for root, _, files in os.walk(folder)
+            for name in files
+        }
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import sys
+from tempfile import mkdtemp
+from unittest import mock
+from unittest import skipUnless
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from src.db_cache.db_cache_manager import DbCacheManager
+from src.folder_watcher import FolderWatcher
+from src.io_files.hash_functions import FileHashManager
+
+
+@skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+class TestFolderWatcher(TestCase):
+    def setUp(self) -> None:
+        super(TestFolderWatcher, self).setUp()
+        self.engine = create_engine("sqlite://")  # in-memory database
+        self.test_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_folder)
+
+        patch_func = "src.db_cache.db_cache_manager.create_engine"
+        self.patch_query = mock.patch(patch_func, lambda _: self.engine)
+        self.patch_query.start()
+        self.addCleanup(self.patch_query.stop)
+
+        self.write_file("file1.txt", "file1")
+        self.db_cache = DbCacheManager(FileHashManager(self.test_folder))
+        self.db_cache.read_or_create_cache()
+        self.watcher = FolderWatcher(self.db_cache, debounce=0.05)
+        self.watcher.start()
+        self.addCleanup(self.watcher.close)
+
+    def tearDown(self) -> None:
+        super(TestFolderWatcher, self).tearDown()
+        self.engine.dispose()
+
+    def write_file(self, name: str, content: str) -> str:
+        file_path = os.path.join(self.test_folder, name)
+        with open(file_path, "w") as f:
+            f.write(content)
+        return file_path
+
+    def cached_files(self):
+        db_cache = DbCacheManager(FileHashManager(self.test_folder), refresh=False)
+        df_cache = db_cache.db_cache
+        return set(df_cache["folder"] + "/" + df_cache["name"])
+
+    def apply_events(self):
+        self.assertEqual((0, 0), self.watcher.poll(1))  # events received
+        return self.watcher.poll(1)  # no other event within the debounce
+
+    def test_files_changed(self):
+        self.write_file("file2.txt", "file2")
+        os.remove(os.path.join(self.test_folder, "file1.txt"))
+
+        self.assertEqual((1, 1), self.apply_events())
+        self.assertEqual({"./file2.txt"}, self.cached_files())
+
+    def test_folder_moved_in(self):
+        folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+        os.makedirs(os.path.join(folder, "sub"))
+        with open(os.path.join(folder, "sub", "file3.txt"), "w") as f:
+            f.write("file3")
+
+        shutil.move(folder, os.path.join(self.test_folder, "moved"))
+        self.assertEqual((1, 0), self.apply_events())
+
+        # the new folders are watched
+        self.write_file(os.path.join("moved", "sub", "file4.txt"), "file4")
+        self.assertEqual((1, 0), self.apply_events())
+        self.assertEqual(
+            {"./file1.txt", "moved/sub/file3.txt", "moved/sub/file4.txt"},
+            self.cached_files(),
+        )
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import mock
+from unittest import TestCase
+
+from src.io_files import hash_functions
+from src.io_files.hash_workers import HashWorkers
+
+
+class TestHashFunctions(TestCase):
+    def setUp(self) -> None:
+        super(TestHashFunctions, self).setUp()
+        self.test_folder = mkdtemp()
+
+    def tearDown(self) -> None:
+        super(TestHashFunctions, self).tearDown()
+        shutil.rmtree(self.test_folder)
+
+    def write_file(self, name: str, content: bytes) -> str:
+        file_path = os.path.join(self.test_folder, name)
+        with open(file_path, "wb") as f:
+            f.write(content)
+        return file_path
+
+    def test_partial_hash_reads_samples(self):
+        size = 10 * hash_functions.SIZE_SAMPLE
+        content = b"a" * size
+        file_1 = self.write_file("file1", content)
+        # differs outside of the head / middle / tail samples
+        file_2 = self.write_file(
+            "file2",
+            b"a" * 2 * hash_functions.SIZE_SAMPLE
+            + b"b"
+            + content[: size - 1 - 2 * hash_functions.SIZE_SAMPLE],
+        )
+        file_3 = self.write_file("file3", content[:-1] + b"b")
+
+        partial_1 = hash_functions.get_partial_hash_for_file(file_1)
+        self.assertEqual(partial_1, hash_functions.get_partial_hash_for_file(file_2))
+        self.assertNotEqual(partial_1, hash_functions.get_partial_hash_for_file(file_3))
+        self.assertNotEqual(
+            hash_functions.get_hashs_for_file(file_1),
+            hash_functions.get_hashs_for_file(file_2),
+        )
+
+    def test_record_without_hash(self):
+        self.write_file("file1", b"content")
+        hash_gen = hash_functions.FileHashManager(self.test_folder)
+
+        record = hash_gen.create_record(self.test_folder, "file1")
+        self.assertEqual(7, record["size"])
+        for key in hash_functions.HASH_FUNCTIONS:
+            self.assertIsNone(record[key])
+        self.assertIsNone(record[hash_functions.PARTIAL_HASH])
+
+    def test_hash_files_in_parallel(self):
+        file_paths = [self.write_file(f"file{i}", b"content" * i) for i in range(10)]
+        file_paths.append(os.path.join(self.test_folder, "missing_file"))
+        hash_gen = hash_functions.FileHashManager(self.test_folder, HashWorkers(4))
+
+        keys = list(hash_functions.HASH_STAGES)[-1]
+        hashs = dict(hash_gen.hash_files(file_paths, keys))
+        hash_gen.workers.close()
+
+        self.assertEqual(set(file_paths[:-1]), set(hashs))
+        for file_path in file_paths[:-1]:
+            self.assertEqual(
+                hash_functions.get_hashs_for_file(file_path, keys), hashs[file_path]
+            )
+
+    def test_hash_big_file(self):
+        content = os.urandom(3 * hash_functions.SIZE_READ + 123)
+        file_path = self.write_file("file1", content)
+
+        hashs = hash_functions.get_hashs_for_file(file_path)
+
+        self.assertEqual(len(content), hashs["size"])
+        for name, hash_function in hash_functions.HASH_FUNCTIONS.items():
+            expected = hash_function()
+            expected.update(content)
+            self.assertEqual(expected.hexdigest(), hashs[name])
+
+    def test_algorithms(self):
+        # variable length digests, without hexdigest()
+        self.assertNotIn("shake_128", hash_functions.ALGORITHMS)
+        for name, hash_function in hash_functions.ALGORITHMS.items():
+            hash_func = hash_function()
+            hash_func.update(b"content")
+            self.assertTrue(hash_func.hexdigest(), name)
+
+    def test_hard_links_hashed_once(self):
+        file_path = self.write_file("file1", b"content" * 1000)
+        link_paths = [os.path.join(self.test_folder, f"link{i}") for i in range(3)]
+        for link_path in link_paths:
+            os.link(file_path, link_path)
+        other_path = self.write_file("file2", b"content" * 1000)
+        hash_gen = hash_functions.FileHashManager(self.test_folder, HashWorkers(1))
+
+        keys = list(hash_functions.HASH_STAGES)[-1]
+        hash_stage = mock.Mock(side_effect=hash_functions.HASH_STAGES[keys])
+        with mock.patch.dict(hash_functions.HASH_STAGES, {keys: hash_stage}):
+            hashs = dict(hash_gen.hash_files([file_path] + link_paths[:2], keys))
+            self.assertEqual(1, hash_stage.call_count)
+
+            # the links of a file already hashed are not read
+            hash_gen.hash_file(link_paths[2], keys)
+            dict(hash_gen.hash_files([link_paths[2], other_path], keys))
+            self.assertEqual(2, hash_stage.call_count)
+
+        self.assertEqual(3, len(hashs))
+        self.assertEqual(1, len({hashs[path][keys[0]] for path in hashs}))
+
+    def test_small_file_all_stages(self):
+        file_path = self.write_file("file1", b"content" * 100)
+
+        hash_info = hash_functions.get_hashs_for_small_file(file_path, 700)
+
+        expected = {}
+        for func in hash_functions.HASH_STAGES.values():
+            expected.update(func(file_path))
+        self.assertEqual(expected, hash_info)
+
+    def test_small_file_short_reads(self):
+        file_path = self.write_file("file1", b"content" * 100)
+        os_read = os.read
+
+        with mock.patch("os.read", lambda fd, size: os_read(fd, min(size, 64))):
+            hash_info = hash_functions.get_hashs_for_small_file(file_path, 700)
+
+        self.assertEqual(
+            hash_functions.get_hashs_for_small_file(file_path, 700), hash_info
+        )
+        self.assertEqual(700, hash_info["size"])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+from unittest import TestCase
+
+import pandas as pd
+
+from src.db_cache.hash_index import HashIndex
+
+
+class TestHashIndex(TestCase):
+    def setUp(self) -> None:
+        super(TestHashIndex, self).setUp()
+        self.df_files_info = pd.DataFrame(
+            [
+                {
+                    "folder": "a",
+                    "name": "f1",
+                    "size": 10,
+                    "partial": "p1",
+                    "md5": "m1",
+                    "sha256": "s1",
+                },
+                {
+                    "folder": "b",
+                    "name": "f2",
+                    "size": 10,
+                    "partial": "p1",
+                    "md5": None,
+                    "sha256": None,
+                },
+                {
+                    "folder": "c",
+                    "name": "f3",
+                    "size": 20,
+                    "partial": None,
+                    "md5": None,
+                    "sha256": None,
+                },
+            ]
+        )
+        self.index = HashIndex(self.df_files_info)
+
+    def test_find_by_size(self):
+        self.assertEqual([0, 1], self.index.find({"size": 10}))
+        self.assertEqual([2], self.index.find({"size": 20}))
+        self.assertEqual([], self.index.find({"size": 30}))
+
+    def test_find_by_digest(self):
+        hash_info = {"size": 10, "partial": "p1", "md5": "m1", "sha256": "s1"}
+        self.assertEqual([0], self.index.find(hash_info))
+        self.assertEqual([], self.index.find(dict(hash_info, size=20)))
+
+    def test_update(self):
+        self.assertEqual([1], self.index.missing([0, 1], ["md5", "sha256"]))
+
+        self.index.update(1, {"md5": "m1", "sha256": "s1"})
+
+        self.assertEqual([], self.index.missing([0, 1], ["md5", "sha256"]))
+        self.assertEqual(
+            [0, 1], self.index.find({"size": 10, "md5": "m1", "sha256": "s1"})
+        )
+        self.assertEqual("m1", self.index.to_dataframe().at[1, "md5"])
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import filecmp
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import mock
+from unittest import TestCase
+
+from src.io_files import io_wrappers
+from src.io_files.copy_engine import copy_file_data
+
+
+class TestIterFileEntries(TestCase):
+    def setUp(self) -> None:
+        super(TestIterFileEntries, self).setUp()
+        self.test_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_folder)
+
+        for relative_path in [
+            "a/b/file1",
+            "a/file2",
+            "c/file3",
+            "file4",
+            "a/.DS_Store",
+        ]:
+            file_path = os.path.join(self.test_folder, relative_path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w") as f:
+                f.write(relative_path)
+
+    def relative_paths(self, entries):
+        return [os.path.relpath(entry.path, self.test_folder) for entry in entries]
+
+    def test_bottom_up(self):
+        entries = list(io_wrappers.iter_file_entries(self.test_folder, nb_workers=1))
+
+        relative_paths = self.relative_paths(entries)
+        self.assertEqual(
+            {"a/b/file1", "a/file2", "c/file3", "file4"}, set(relative_paths)
+        )
+        self.assertLess(
+            relative_paths.index("a/b/file1"), relative_paths.index("a/file2")
+        )
+        self.assertEqual("file4", relative_paths[-1])
+
+        entry = entries[-1]
+        stat = os.stat(entry.path)
+        self.assertEqual((stat.st_size, stat.st_ino), (entry.size, entry.inode))
+
+    def test_parallel(self):
+        entries = io_wrappers.iter_file_entries(self.test_folder, nb_workers=4)
+
+        self.assertEqual(
+            {"a/b/file1", "a/file2", "c/file3", "file4"},
+            set(self.relative_paths(entries)),
+        )
+
+    def test_iter_in_background(self):
+        def scan():
+            yield from range(10)
+            raise OSError("disk removed")
+
+        items = []
+        with self.assertRaises(OSError):
+            for item in io_wrappers.iter_in_background(scan(), 2):
+                items.append(item)
+        self.assertEqual(list(range(10)), items)
+
+
+class TestFileManager(TestCase):
+    def setUp(self) -> None:
+        super(TestFileManager, self).setUp()
+        self.test_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_folder)
+
+        self.folder_src = os.path.join(self.test_folder, "src")
+        self.folder_dst = os.path.join(self.test_folder, "dst")
+        os.makedirs(self.folder_src)
+        for i in range(20):
+            with open(os.path.join(self.folder_src, f"file{i}"), "wb") as f:
+                f.write(os.urandom(i * 1000))
+
+    def test_copy_file_data(self):
+        source_path = os.path.join(self.folder_src, "file19")
+        target_path = os.path.join(self.test_folder, "copy")
+
+        copy_file_data(source_path, target_path)
+
+        self.assertTrue(filecmp.cmp(source_path, target_path, shallow=False))
+        self.assertEqual(
+            os.stat(source_path).st_mtime_ns, os.stat(target_path).st_mtime_ns
+        )
+
+    def test_copy_source_shrank(self):
+        source_path = os.path.join(self.folder_src, "file19")
+        target_path = os.path.join(self.test_folder, "copy")
+
+        def copy_half(source_fd: int, target_fd: int, size: int) -> bool:
+            os.write(target_fd, os.read(source_fd, size // 2))
+            return True
+
+        with mock.patch("src.io_files.copy_engine._clone", return_value=False):
+            with mock.patch("src.io_files.copy_engine._copy_in_kernel", copy_half):
+                copy_file_data(source_path, target_path)
+
+        # no preallocated zeros after the bytes copied
+        self.assertEqual(
+            os.path.getsize(source_path) // 2, os.path.getsize(target_path)
+        )
+
+    def test_copy_in_parallel(self):
+        file_manager = io_wrappers.FileManager(nb_workers=4)
+        for i in range(20):
+            source_path = os.path.join(self.folder_src, f"file{i}")
+            file_manager.copy_file(source_path, self.folder_dst, f"file{i}")
+        file_manager.wait()
+
+        self.assertEqual([], file_manager.errors)
+        self.assertEqual(20, len(file_manager.pop_copied()))
+        for i in range(20):
+            self.assertTrue(
+                filecmp.cmp(
+                    os.path.join(self.folder_src, f"file{i}"),
+                    os.path.join(self.folder_dst, f"file{i}"),
+                    shallow=False,
+                )
+            )
+
+    def test_copy_with_known_hashs(self):
+        source_path = os.path.join(self.folder_src, "file1")
+        for target_name in ["file1", "file1_other"]:
+            os.makedirs(self.folder_dst, exist_ok=True)
+            shutil.copy(source_path, os.path.join(self.folder_dst, target_name))
+
+        file_manager = io_wrappers.FileManager()
+        with mock.patch("src.io_files.io_wrappers.files_equals") as files_equals:
+            # the hashs say the existing target is different
+            target_path = file_manager.copy_file(
+                source_path, self.folder_dst, "file1", compare=lambda _: False
+            )
+            files_equals.assert_not_called()
+
+            file_manager.copy_file(
+                source_path, self.folder_dst, "file1_other", compare=lambda _: None
+            )
+            files_equals.assert_called_once()
+
+        self.assertNotEqual(os.path.join(self.folder_dst, "file1"), target_path)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import mock
+from unittest import TestCase
+
+from src.metrics import Metrics
+
+
+class TestMetrics(TestCase):
+    def setUp(self) -> None:
+        super(TestMetrics, self).setUp()
+        self.metrics = Metrics(progress_interval=0)
+
+    def test_measure(self):
+        with self.metrics.measure("hash") as measure:
+            measure.nb_bytes = 100
+        with self.assertRaises(OSError):
+            with self.metrics.measure("hash"):
+                raise OSError("unreadable")
+
+        stats = self.metrics.report()["stages"]["hash"]
+        self.assertEqual(2, stats["count"])
+        self.assertEqual(1, stats["errors"])
+        self.assertEqual(100, stats["bytes"])
+        self.assertEqual(2, sum(stats["latency"]["histogram"].values()))
+
+    def test_wall_time(self):
+        self.metrics.add("copy", 0.0, 2.0, 10)
+        self.metrics.add("copy", 1.0, 4.0, 20)
+
+        stats = self.metrics.report()["stages"]["copy"]
+        self.assertEqual(5.0, stats["busy_time"])
+        self.assertEqual(4.0, stats["wall_time"])
+        self.assertEqual(30 / 4.0, stats["bytes_per_second"])
+        self.assertEqual(3.0, stats["latency"]["max"])
+        self.assertEqual(2, stats["latency"]["histogram"]["10s"])
+
+    def test_paused(self):
+        # start of the lookup, start and end of the hashing, end of the lookup
+        with mock.patch("time.perf_counter", side_effect=[0.0, 1.0, 3.0, 4.0]):
+            with self.metrics.measure("lookup"):
+                with self.metrics.paused():
+                    pass
+
+        stats = self.metrics.report()["stages"]["lookup"]
+        self.assertEqual(2.0, stats["busy_time"])
+        self.assertEqual(2.0, stats["latency"]["max"])
+
+    def test_timed(self):
+        @self.metrics.timed("lookup")
+        def lookup(value):
+            return value
+
+        self.assertEqual(3, lookup(3))
+        self.assertEqual(1, self.metrics.report()["stages"]["lookup"]["count"])
+
+    def test_export(self):
+        folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.metrics.add("scan", 0.0, 1.0, 10)
+
+        path = os.path.join(folder, "metrics.json")
+        self.metrics.export(path)
+
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(10, report["stages"]["scan"]["bytes"])
+
+    def test_reset(self):
+        self.metrics.add("scan", 0.0, 1.0)
+        self.metrics.reset()
+        self.assertEqual({}, self.metrics.report()["stages"])
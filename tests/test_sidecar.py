@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import mock
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from src.db_cache.db_cache_manager import DbCacheManager
+from src.io_files.hash_functions import FileHashManager
+from src.io_files.hash_functions import HASH_STAGES
+from src.io_files.io_wrappers import SIDECAR_NAME
+
+
+class TestSidecar(TestCase):
+    def setUp(self) -> None:
+        super(TestSidecar, self).setUp()
+        self.test_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_folder)
+        # the volume, mounted at mount_1 then at mount_2
+        self.mount_point = os.path.join(self.test_folder, "mount_1")
+        self.data_folder = os.path.join(self.mount_point, "photos")
+        os.makedirs(os.path.join(self.data_folder, "sub"))
+        self.uuid = "1234-ABCD"
+
+        for name in ["file1.txt", "file2.txt", os.path.join("sub", "file3.txt")]:
+            self.write_file(name, "same content" * 5000)
+        self.write_file("file4.txt", "other content" * 5000)
+
+        self.patches = [
+            mock.patch("src.db_cache.db_cache_manager.CACHE_SIDECAR", True),
+            mock.patch("src.db_cache.sidecar.volume_root", lambda _: self.mount_point),
+            mock.patch("src.db_cache.sidecar.volume_uuid", lambda _: self.uuid),
+        ]
+        for patch in self.patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def write_file(self, name: str, content: str) -> str:
+        file_path = os.path.join(self.data_folder, name)
+        with open(file_path, "w") as f:
+            f.write(content)
+        return file_path
+
+    def new_db_cache(self, engine=None) -> DbCacheManager:
+        """engine : None for the cache database of another computer"""
+        if engine is None:
+            engine = create_engine("sqlite://")  # in-memory database
+            self.addCleanup(engine.dispose)
+        patch_func = "src.db_cache.db_cache_manager.create_engine"
+        with mock.patch(patch_func, lambda _: engine):
+            db_cache = DbCacheManager(FileHashManager(self.data_folder))
+            db_cache.engine
+        return db_cache
+
+    def move_volume(self) -> None:
+        """Same inodes and mtimes, another mount point"""
+        new_mount_point = os.path.join(self.test_folder, "mount_2")
+        os.rename(self.mount_point, new_mount_point)
+        self.mount_point = new_mount_point
+        self.data_folder = os.path.join(new_mount_point, "photos")
+
+    def hashed_files(self, db_cache: DbCacheManager):
+        hash_key = list(HASH_STAGES)[-1][0]
+        df_cache = db_cache.db_cache
+        return set(df_cache[df_cache[hash_key].notnull()]["name"])
+
+    def test_volume_moved(self):
+        db_cache = self.new_db_cache()
+        db_cache.find_duplicated_files()
+        db_cache.save_sidecar()
+        self.assertTrue(os.path.isfile(os.path.join(self.mount_point, SIDECAR_NAME)))
+
+        self.move_volume()
+        self.write_file("file2.txt", "modified content" * 5000)
+
+        db_cache = self.new_db_cache()
+        self.assertEqual({"file1.txt", "file3.txt"}, self.hashed_files(db_cache))
+
+    def test_new_inodes(self):
+        """FAT / exFAT : the inodes change on each mount"""
+        db_cache = self.new_db_cache()
+        db_cache.find_duplicated_files()
+        db_cache.save_sidecar()
+
+        self.move_volume()
+        file_path = os.path.join(self.data_folder, "file1.txt")
+        inode = os.stat(file_path).st_ino
+        shutil.copy2(file_path, file_path + ".tmp")
+        os.replace(file_path + ".tmp", file_path)
+        self.assertNotEqual(inode, os.stat(file_path).st_ino)
+
+        db_cache = self.new_db_cache()
+        self.assertEqual(
+            {"file1.txt", "file2.txt", "file3.txt"}, self.hashed_files(db_cache)
+        )
+
+    def test_refresh_from_sidecar(self):
+        db_cache = self.new_db_cache()
+        self.assertEqual(set(), self.hashed_files(db_cache))
+        # the files are hashed on another computer
+        other_db_cache = self.new_db_cache()
+        other_db_cache.find_duplicated_files()
+        other_db_cache.save_sidecar()
+
+        db_cache = self.new_db_cache(db_cache.engine)
+        self.assertEqual(
+            {"file1.txt", "file2.txt", "file3.txt"}, self.hashed_files(db_cache)
+        )
+
+    def test_sidecar_of_another_volume(self):
+        db_cache = self.new_db_cache()
+        db_cache.find_duplicated_files()
+        db_cache.save_sidecar()
+
+        self.uuid = "5678-EFGH"
+        db_cache = self.new_db_cache()
+        self.assertEqual(set(), self.hashed_files(db_cache))
+
+    def test_sidecar_not_scanned(self):
+        db_cache = self.new_db_cache()
+        db_cache.find_duplicated_files()
+        db_cache.save_sidecar()
+        os.rename(
+            os.path.join(self.mount_point, SIDECAR_NAME),
+            os.path.join(self.data_folder, SIDECAR_NAME),
+        )
+
+        db_cache = self.new_db_cache()
+        self.assertNotIn(SIDECAR_NAME, set(db_cache.db_cache["name"]))
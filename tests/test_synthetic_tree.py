@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import filecmp
+import os
+import shutil
+from collections import Counter
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from benchmarks.run_benchmarks import compare
+from benchmarks.run_benchmarks import run_benchmarks
+from benchmarks.synthetic_tree import copy_share
+from benchmarks.synthetic_tree import generate_tree
+from src.io_files.hash_functions import get_hashs_for_file
+from src.io_files.hash_functions import HASH_STAGES
+
+
+class TestSyntheticTree(TestCase):
+    def setUp(self) -> None:
+        super(TestSyntheticTree, self).setUp()
+        self.test_folder = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_folder)
+
+    def generate(self, name: str, **kwargs):
+        folder = os.path.join(self.test_folder, name)
+        kwargs = dict(dict(nb_files=50, size_distribution=[(4096, 1)]), **kwargs)
+        return folder, generate_tree(folder, **kwargs)
+
+    def test_same_tree(self):
+        folder_1, files_1 = self.generate("tree_1")
+        folder_2, files_2 = self.generate("tree_2")
+
+        self.assertEqual(files_1, files_2)
+        _, mismatch, errors = filecmp.cmpfiles(
+            folder_1, folder_2, files_1, shallow=False
+        )
+        self.assertEqual(([], []), (mismatch, errors))
+
+    def test_duplicates_and_collisions(self):
+        folder, files = self.generate("tree", duplicate_ratio=0.5, collision_ratio=0.5)
+
+        self.assertEqual(50, len(set(files)))
+        hash_key = list(HASH_STAGES)[-1][0]
+        hashs = Counter(
+            get_hashs_for_file(os.path.join(folder, file))[hash_key] for file in files
+        )
+        self.assertLess(len(hashs), 40)
+        names = Counter(os.path.basename(file) for file in files)
+        self.assertLess(len(names), 40)
+
+    def test_copy_share(self):
+        folder, files = self.generate("tree")
+        folder_dst = os.path.join(self.test_folder, "dst")
+
+        copied = copy_share(folder, files, folder_dst, 0.5)
+
+        self.assertTrue(0 < len(copied) < len(files))
+        for relative_path in copied:
+            self.assertTrue(os.path.isfile(os.path.join(folder_dst, relative_path)))
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(self.test_folder, nb_files=20, repeat=1)
+
+        self.assertEqual(
+            {"scan", "hash", "cache_build", "cache_lookup", "copy_recursive"},
+            set(results["results"]),
+        )
+        self.assertEqual(20, results["results"]["scan"]["files"])
+        self.assertEqual([], compare(results, results))